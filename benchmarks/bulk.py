@@ -0,0 +1,63 @@
+"""Benchmark for parsing a bulk payload and checking it against a group.
+
+Seeds a group like benchmarks.commands and times parse_codes_in_bulk and
+queries.add_codes on a payload of the codes the group already holds, so
+add_codes only does the duplicate check and inserts nothing.
+
+    python -m benchmarks.bulk --size 1000000"""
+import argparse
+import logging
+import sys
+import time
+
+from benchmarks.commands import seed
+from model import PromoCodeGroup
+import queries
+from tests.utils import DBTestCase
+from utils import parse_codes_in_bulk
+
+
+def payload(size):
+    """The codes seed() creates, a few separators apart."""
+    return '\n'.join('CODE-{}, '.format(index) for index in range(1, size + 1))
+
+
+def benchmark(size, repeats=3):
+    """Returns the best (parse, check) seconds for a payload of `size`
+    codes against a group already holding them."""
+    case = DBTestCase()
+    case.setUp()
+    try:
+        seed(case.test_db, size)
+        group = PromoCodeGroup.get()
+        code_bulk = payload(size)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            parsed = parse_codes_in_bulk(code_bulk)
+            parsed_at = time.perf_counter()
+            with case.test_db.atomic():
+                inserted, existing = queries.add_codes(group, parsed.codes)
+            timings.append((parsed_at - start,
+                            time.perf_counter() - parsed_at))
+            assert (inserted, existing) == (0, size)
+    finally:
+        case.tearDown()
+    return min(timings, key=sum)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    parse, check = benchmark(args.size, args.repeats)
+    print('{} codes: parse {:.0f}ms  check {:.0f}ms  total {:.0f}ms'.format(
+        args.size, parse * 1000, check * 1000, (parse + check) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
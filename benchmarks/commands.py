@@ -0,0 +1,283 @@
+"""Benchmarks for the command handlers.
+
+Seeds the test database (an in-memory SQLite, see tests.utils.DBTestCase)
+with synthetic codes and times each command called with the test fakes.
+Run from the repository root:
+
+    python -m benchmarks.commands --sizes 1000,100000,1000000
+
+Results are compared against benchmarks/baseline.json, and the run fails
+if a command got slower than the baseline by more than --max-regression.
+Both runs also time a fixed calibration workload, and p50s are compared as
+multiples of it, so a baseline saved on one machine still means something
+on another. Each command is timed for --rounds rounds, each one scaled by
+a calibration taken right before it, and keeps its best round. p50s less
+than --min-delta-ms over the baseline never count as a regression, so
+scheduler noise on sub-millisecond commands doesn't fail the run.
+--save-baseline stores the results as the new baseline instead."""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from main import add_code_bulk, list_code, my_codes, send_code
+from model import PromoCodeGroup
+from tests.utils import (DBTestCase,
+                         FakeContext,
+                         FakeGuild,
+                         FakeUser,
+                         ReceivesMessages,
+                         returns_true)
+
+SIZES = (1000, 100000, 1000000)
+GROUP_NAME = 'bench'
+USERS_PER_SEND = 5
+BULK_SIZE = 100
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+CALIBRATION_ROWS = 10000
+CALIBRATION_LOOKUPS = 2000
+
+
+class BenchUser(ReceivesMessages):
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = 'user-{}'.format(user_id)
+
+
+def seed(database, size):
+    """Creates the bench group with `size` codes. Every third code was
+    already sent, a few of them to FakeUser."""
+    group = PromoCodeGroup.create(guild_id=FakeGuild.id, name=GROUP_NAME)
+    database.execute_sql(
+        'WITH RECURSIVE seq(x) AS ('
+        '  SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?'
+        ') '
+        'INSERT INTO promocode (group_id, code) '
+        'SELECT ?, \'CODE-\' || x FROM seq', (size, group.id))
+    database.execute_sql(
+        'INSERT INTO redemption (promo_code_id, group_id, code, user_id, '
+        '                        user_name, redeemed_at) '
+        'SELECT id, group_id, code, 100 + id % 1000, \'user\', '
+        '       \'2021-01-01 12:00:00+00:00\' '
+        'FROM promocode WHERE group_id = ? AND id % 3 = 0', (group.id,))
+    database.execute_sql(
+        'DELETE FROM freecode WHERE group_id = ? AND promo_code_id % 3 = 0',
+        (group.id,))
+    database.execute_sql('ANALYZE')
+
+
+async def no_page_turn(message):  # pylint: disable=unused-argument
+    raise asyncio.TimeoutError()
+
+
+def run_send_code(iteration):
+    users = [BenchUser(1000000 + iteration * USERS_PER_SEND + index)
+             for index in range(USERS_PER_SEND)]
+    return send_code(FakeContext(), GROUP_NAME, users,
+                     is_authorized_or_owner=returns_true)
+
+
+def run_add_code_bulk(iteration):
+    codes = ' '.join('BULK-{}-{}'.format(iteration, index)
+                     for index in range(BULK_SIZE))
+    return add_code_bulk(FakeContext(), GROUP_NAME, code_bulk=codes)
+
+
+def run_list_code(iteration):  # pylint: disable=unused-argument
+    return list_code(FakeContext(), GROUP_NAME,
+                     wait_for_page_turn=no_page_turn)
+
+
+def run_my_codes(iteration):  # pylint: disable=unused-argument
+    return my_codes(FakeContext(author=FakeUser()))
+
+
+# name -> function returning the command call for an iteration
+COMMANDS = {
+    'send_code': run_send_code,
+    'add_code_bulk': run_add_code_bulk,
+    'list_code': run_list_code,
+    'my_codes': run_my_codes,
+}
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    index = max(0, min(len(samples) - 1,
+                       int(round(fraction * len(samples))) - 1))
+    return samples[index]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    summary = {
+        'ops_per_second': len(samples) / sum(samples),
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p95_ms': percentile(samples, 0.95) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+    return {key: round(value, 3) for key, value in summary.items()}
+
+
+def rescale(summary, factor):
+    """The summary of a run `factor` times as slow."""
+    return {name: round(value * factor, 3) if name.endswith('_ms')
+            else round(value / factor, 3)
+            for name, value in summary.items()}
+
+
+async def time_command(make_call, iterations):
+    samples = []
+    for iteration in range(iterations):
+        call = make_call(iteration)
+        start = time.perf_counter()
+        await call
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def benchmark(size, iterations, commands=None, rounds=1,
+              calibration_ms=None):
+    """Returns {command name: summary} for a database of `size` codes.
+
+    Every round of a command gets a freshly seeded database, and the
+    command keeps the summary of the round with the lowest p50. With
+    calibration_ms, each round is calibrated right before it runs and
+    rescaled to calibration_ms, so a slow spell of the machine doesn't
+    skew it."""
+    results = {}
+    for name, make_call in COMMANDS.items():
+        if commands and name not in commands:
+            continue
+        summaries = []
+        for _ in range(rounds):
+            case = DBTestCase()
+            case.setUp()
+            try:
+                seed(case.test_db, size)
+                factor = (1 if calibration_ms is None
+                          else calibration_ms / calibrate())
+                samples = asyncio.run(time_command(make_call, iterations))
+            finally:
+                case.tearDown()
+            summaries.append(rescale(summarize(samples), factor))
+        results[name] = min(summaries, key=lambda summary: summary['p50_ms'])
+    return results
+
+
+def calibrate(repeats=5):
+    """Milliseconds a fixed SQLite and Python workload takes at best, a
+    yardstick for how fast this machine runs the handlers."""
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE code (id INTEGER PRIMARY KEY, '
+                       'group_id INTEGER, code TEXT)')
+    connection.execute('CREATE INDEX code_group_id ON code (group_id)')
+    connection.executemany('INSERT INTO code (group_id, code) VALUES (?, ?)',
+                           ((index % 100, 'CODE-{}'.format(index))
+                            for index in range(CALIBRATION_ROWS)))
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for lookup in range(CALIBRATION_LOOKUPS):
+            rows = connection.execute(
+                'SELECT id, code FROM code WHERE group_id = ? AND id > ? '
+                'ORDER BY id LIMIT 20', (lookup % 100, lookup)).fetchall()
+            '\n'.join('{} {}'.format(*row) for row in rows)
+        samples.append(time.perf_counter() - start)
+    connection.close()
+    return round(min(samples) * 1000, 3)
+
+
+def compare(results, baseline, max_regression, calibration_ms,
+            min_delta_ms=0.0):
+    """Returns the lines describing each result against its baseline and
+    whether any p50 regressed by more than max_regression, and by at least
+    min_delta_ms.
+
+    p50s are divided by the calibration time of their own run first, so
+    the ratio holds up when the baseline came from another machine."""
+    lines = []
+    regressed = False
+    commands = baseline.get('commands', {})
+    speedup = baseline.get('calibration_ms', calibration_ms) / calibration_ms
+    for key, summary in sorted(results.items()):
+        line = '{0:<24} {1:>9.1f} ops/s  p50 {2:>8.2f}ms  p95 {3:>8.2f}ms  ' \
+               'p99 {4:>8.2f}ms'.format(key,
+                                        summary['ops_per_second'],
+                                        summary['p50_ms'],
+                                        summary['p95_ms'],
+                                        summary['p99_ms'])
+        previous = commands.get(key)
+        if previous:
+            p50_ms = summary['p50_ms'] * speedup
+            ratio = p50_ms / previous['p50_ms']
+            line += '  {:.2f}x baseline'.format(ratio)
+            if (ratio > max_regression
+                    and p50_ms - previous['p50_ms'] >= min_delta_ms):
+                regressed = True
+                line += ' (REGRESSION)'
+        lines.append(line)
+    return lines, regressed
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated numbers of seeded codes')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='rounds per command, the best one is kept')
+    parser.add_argument('--commands', default='',
+                        help='comma separated commands (default: all)')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, default=1.25,
+                        help='allowed p50 ratio over the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                        help='p50 increase below which nothing regressed')
+    args = parser.parse_args(argv)
+    commands = [name for name in args.commands.split(',') if name]
+
+    logging.disable(logging.WARNING)
+    calibration_ms = calibrate()
+    results = {}
+    for size in (int(size) for size in args.sizes.split(',')):
+        for name, summary in benchmark(size, args.iterations, commands,
+                                       args.rounds, calibration_ms).items():
+            results['{}@{}'.format(name, size)] = summary
+
+    baseline = load_baseline(args.baseline)
+    lines, regressed = compare(results, baseline, args.max_regression,
+                               calibration_ms, args.min_delta_ms)
+    print('calibration {:.2f}ms (baseline: {}ms)'.format(
+        calibration_ms, baseline.get('calibration_ms', '-')))
+    print('\n'.join(lines))
+    if args.save_baseline:
+        # baseline entries missing from this run are rescaled to it
+        factor = (calibration_ms
+                  / baseline.get('calibration_ms', calibration_ms))
+        commands = {key: rescale(summary, factor)
+                    for key, summary in baseline.get('commands', {}).items()}
+        commands.update(results)
+        baseline = {'calibration_ms': calibration_ms, 'commands': commands}
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        return 0
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
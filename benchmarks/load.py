@@ -0,0 +1,300 @@
+"""End-to-end load generator.
+
+Members and an admin send commands as stub Discord messages through the
+bot's real command path (on_message, the guild command queues, checks
+and converters) on the bot's own event loop, against an on-disk database
+seeded like benchmarks.commands. Every message the bot sends, to a
+channel or a DM, waits on an artificial latency that stands in for
+Discord's HTTP API.
+
+    python -m benchmarks.load --members 300 --recipients 100 --duration 10
+
+Members spam $my_codes while the admin runs $send_code to `recipients`
+people over and over. list_code is left out: it waits for reactions."""
+import argparse
+import asyncio
+from collections import defaultdict
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.commands import GROUP_NAME, percentile, seed
+from cache import clear_caches
+from constants import MODELS
+from dispatcher import QueueFull
+import main as bot_main
+from migrations import setup_schema
+from storage import open_database
+from tests.utils import FakeGuild, FakeSentMessage
+
+BOT_USER_ID = 1
+ADMIN_ID = 2
+CHANNEL_ID = 3
+# seed() sends codes to the users 100 to 1099
+FIRST_MEMBER_ID = 100
+# how long a member waits after the bot says its queue is full
+RETRY_AFTER = 1.0
+
+
+def constant_latency(milliseconds):
+    return lambda: milliseconds / 1000
+
+
+def uniform_latency(low, high, rng=None):
+    rng = random.Random(0) if rng is None else rng
+    return lambda: rng.uniform(low, high) / 1000
+
+
+class FakeDiscordAPI():
+    """Counts the messages the bot sends and delays each one."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+        self.send_time = 0.0
+
+    async def send(self, destination_id, content):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency())
+        self.sent += 1
+        self.send_time += time.perf_counter() - start
+        return {'id': self.sent,
+                'channel_id': destination_id,
+                'content': content}
+
+
+class FakeHTTP():
+    def __init__(self, api):
+        self.api = api
+
+    async def send_message(self, channel_id, content, **kwargs):
+        # pylint: disable=unused-argument
+        return await self.api.send(channel_id, content)
+
+    async def send_files(self, channel_id, content=None, **kwargs):
+        # pylint: disable=unused-argument
+        return await self.api.send(channel_id, content)
+
+
+class FakeState():
+    """The bits of discord's ConnectionState that Messageable.send uses."""
+    allowed_mentions = None
+
+    def __init__(self, api):
+        self.http = FakeHTTP(api)
+
+    def create_message(self, channel, data):  # pylint: disable=unused-argument
+        return FakeSentMessage(data['content'])
+
+
+class LoadUser():
+    bot = False
+
+    def __init__(self, user_id, api):
+        self.id = user_id
+        self.name = 'user-{}'.format(user_id)
+        self.discriminator = '0001'
+        self.api = api
+
+    async def send(self, content, file=None):
+        # pylint: disable=unused-argument
+        data = await self.api.send(self.id, content)
+        return FakeSentMessage(data['content'])
+
+
+class LoadChannel():
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+
+
+class LoadMessage():
+    def __init__(self, content, author, channel, state, mentions=()):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = list(mentions)
+        self.attachments = []
+        self._state = state
+
+
+class LoadReport():
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.elapsed = 0.0
+
+    def completed(self):
+        return sum(len(samples) for samples in self.latencies.values())
+
+    def lines(self):
+        lines = ['{} comandos em {:.1f}s: {:.1f} comandos/s'.format(
+            self.completed(), self.elapsed,
+            self.completed() / self.elapsed if self.elapsed else 0)]
+        for name, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            lines.append(
+                '{0:<12} {1:>6} cmds {2:>4} erros {3:>6} recusados  '
+                'p50 {4:>8.2f}ms  p95 {5:>8.2f}ms  p99 {6:>8.2f}ms  '
+                'max {7:>8.2f}ms'.format(
+                    name, len(samples), self.errors[name],
+                    self.rejected[name],
+                    percentile(samples, 0.50) * 1000,
+                    percentile(samples, 0.95) * 1000,
+                    percentile(samples, 0.99) * 1000,
+                    samples[-1] * 1000))
+        return lines
+
+
+class LoadGenerator():
+    def __init__(self, bot, api, members, recipients, delivery=None):
+        self.bot = bot
+        self.api = api
+        # the DeliveryWorker that sends send_code's DMs, run alongside
+        self.delivery = delivery
+        self.state = FakeState(api)
+        self.channel = LoadChannel(CHANNEL_ID, FakeGuild())
+        self.admin = LoadUser(ADMIN_ID, api)
+        self.members = [LoadUser(FIRST_MEMBER_ID + index, api)
+                        for index in range(members)]
+        self.recipients = recipients
+        self.report = LoadReport()
+        # members whose last command was refused by the guild queue
+        self.rejected_ids = set()
+        self._next_recipient = 10 ** 6
+
+    def message(self, author, content, mentions=()):
+        return LoadMessage(content, author, self.channel, self.state,
+                           mentions)
+
+    def send_code_message(self):
+        users = [LoadUser(self._next_recipient + index, self.api)
+                 for index in range(self.recipients)]
+        self._next_recipient += self.recipients
+        content = '$send_code {} {}'.format(
+            GROUP_NAME, ' '.join('<@{}>'.format(user.id) for user in users))
+        return self.message(self.admin, content, users)
+
+    async def resolve_users(self, user_ids):
+        return {user_id: LoadUser(user_id, self.api) for user_id in user_ids}
+
+    async def invoke(self, name, message):
+        start = time.perf_counter()
+        await self.bot.on_message(message)
+        self.report.latencies[name].append(time.perf_counter() - start)
+        # commands that fail their checks never yield; let the rest run
+        await asyncio.sleep(0)
+
+    async def member_loop(self, member, deadline):
+        while time.perf_counter() < deadline:
+            await self.invoke('my_codes', self.message(member, '$my_codes'))
+            if member.id in self.rejected_ids:
+                self.rejected_ids.discard(member.id)
+                await asyncio.sleep(RETRY_AFTER)
+
+    async def admin_loop(self, deadline):
+        while time.perf_counter() < deadline:
+            await self.invoke('send_code', self.send_code_message())
+
+    async def run(self, duration):
+        async def record_error(ctx, error):
+            if isinstance(error, QueueFull):
+                self.report.rejected[ctx.command.name] += 1
+                self.rejected_ids.add(ctx.author.id)
+            else:
+                self.report.errors[ctx.command.name] += 1
+        self.bot.add_listener(record_error, 'on_command_error')
+        if self.delivery is not None:
+            self.delivery.resolve_users = self.resolve_users
+            delivery_task = asyncio.ensure_future(self.delivery.run())
+        start = time.perf_counter()
+        deadline = start + duration
+        try:
+            await asyncio.gather(
+                self.admin_loop(deadline),
+                *[self.member_loop(member, deadline)
+                  for member in self.members])
+        finally:
+            self.bot.remove_listener(record_error, 'on_command_error')
+            if self.delivery is not None:
+                delivery_task.cancel()
+                await asyncio.gather(delivery_task, return_exceptions=True)
+        self.report.elapsed = time.perf_counter() - start
+        return self.report
+
+
+class FakeBotUser():
+    id = BOT_USER_ID
+
+
+def run_load(database_path,
+             codes,
+             members,
+             recipients,
+             duration,
+             latency,
+             bot=bot_main.bot):
+    """Seeds a database at database_path and runs the load against it.
+
+    Returns the LoadReport and the FakeDiscordAPI."""
+    database = open_database(database_path)
+    database.bind(MODELS)
+    setup_schema(database, MODELS)
+    seed(database, codes)
+    clear_caches()
+    connection = bot._connection  # pylint: disable=protected-access
+    previous_user, previous_owner_id = connection.user, bot.owner_id
+    connection.user = FakeBotUser()
+    bot.owner_id = ADMIN_ID
+    api = FakeDiscordAPI(latency)
+    delivery = bot_main.delivery
+    previous_resolve_users = delivery.resolve_users
+    generator = LoadGenerator(bot, api, members, recipients, delivery)
+    try:
+        report = bot.loop.run_until_complete(generator.run(duration))
+    finally:
+        connection.user, bot.owner_id = previous_user, previous_owner_id
+        delivery.resolve_users = previous_resolve_users
+        bot_main.storage.shutdown()
+        database.close()
+    return report, api
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--codes', type=int, default=100000)
+    parser.add_argument('--members', type=int, default=300)
+    parser.add_argument('--recipients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--latency-ms', type=float, default=50.0,
+                        help='mean artificial latency of every send')
+    parser.add_argument('--jitter-ms', type=float, default=0.0,
+                        help='sends take latency +- jitter, uniformly')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    if args.jitter_ms:
+        latency = uniform_latency(args.latency_ms - args.jitter_ms,
+                                  args.latency_ms + args.jitter_ms)
+    else:
+        latency = constant_latency(args.latency_ms)
+    with tempfile.TemporaryDirectory() as directory:
+        report, api = run_load(os.path.join(directory, 'load.sqlite'),
+                               args.codes,
+                               args.members,
+                               args.recipients,
+                               args.duration,
+                               latency)
+    print('\n'.join(report.lines()))
+    print('{} mensagens enviadas, {:.1f}ms em média'.format(
+        api.sent, api.send_time / api.sent * 1000 if api.sent else 0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import time
+
+_CACHES = []
+
+
+def clear_caches():
+    """Empties every cache created in this process (used by the tests)."""
+    for cache in _CACHES:
+        cache.clear()
+
+
+class WriteVersions():
+    """Lets a cache refuse values read before a concurrent write.
+
+    Read-through code takes version() before awaiting the database and
+    stores the result with fill(key, value, version): if set() or
+    invalidate() ran in the meantime, the value may predate that write and
+    is dropped, so the next lookup reads again. The counter is per cache,
+    not per key, to stay bounded; writes are rare next to reads."""
+
+    _writes = 0
+
+    def version(self):
+        return self._writes
+
+    def fill(self, key, value, version):
+        """set(), unless the cache was written since version()."""
+        if version != self._writes:
+            return False
+        self._store(key, value)
+        return True
+
+    def set(self, key, value):
+        self._writes += 1
+        self._store(key, value)
+
+    def invalidate(self, key):
+        self._writes += 1
+        self._entries.pop(key, None)
+
+
+class TTLCache(WriteVersions):
+    """Dict-like cache whose entries expire after ttl seconds.
+
+    A ttl of None keeps entries until they are invalidated. Expired entries
+    are swept every ttl seconds, and past max_size entries the oldest ones
+    are dropped."""
+
+    def __init__(self, ttl=None, clock=time.monotonic, max_size=None):
+        self.ttl = ttl
+        self.clock = clock
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._next_sweep = None if ttl is None else clock() + ttl
+        _CACHES.append(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _ = entry
+        if expires_at is not None and expires_at <= self.clock():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def _store(self, key, value):
+        now = self.clock()
+        if self._next_sweep is not None and now >= self._next_sweep:
+            self.sweep()
+        expires_at = None if self.ttl is None else now + self.ttl
+        # re-inserted, so the dict stays in insertion (oldest first) order
+        self._entries.pop(key, None)
+        self._entries[key] = (expires_at, value)
+        if self.max_size is not None:
+            while len(self._entries) > self.max_size:
+                del self._entries[next(iter(self._entries))]
+
+    def sweep(self):
+        """Drops the expired entries."""
+        now = self.clock()
+        self._entries = {key: entry for key, entry in self._entries.items()
+                         if entry[0] is None or entry[0] > now}
+        if self.ttl is not None:
+            self._next_sweep = now + self.ttl
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class LRUCache(WriteVersions):
+    """Dict-like cache that keeps only the max_size most recently used
+    entries."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        _CACHES.append(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
@@ -1,7 +1,14 @@
 import pytz
 
-from model import AuthorizedUser, PromoCodeGroup, PromoCode
+from model import (AuthorizedUser,
+                   FreeCode,
+                   PendingMessage,
+                   PromoCodeGroup,
+                   PromoCode,
+                   Redemption,
+                   RedemptionRelease)
 
 DATETIME_FORMAT = '%d/%m/%Y %H:%M'
 LOCAL_TIMEZONE = pytz.timezone('America/Sao_Paulo')
-MODELS = [AuthorizedUser, PromoCodeGroup, PromoCode]
+MODELS = [AuthorizedUser, PromoCodeGroup, PromoCode, FreeCode, Redemption,
+          RedemptionRelease, PendingMessage]
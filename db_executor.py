@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+from constants import MODELS
+from tracing import span
+
+
+def bound_database():
+    """Returns the database the models are currently bound to."""
+    return MODELS[0]._meta.database  # pylint: disable=protected-access
+
+
+class QueryStats():
+    """Latency bookkeeping for a single kind of query."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'avg_time': self.total_time / self.count if self.count else 0.0,
+            'max_time': self.max_time,
+        }
+
+
+class DBExecutor():
+    """Runs peewee queries on bounded thread pools.
+
+    Writes go through a single writer thread, so they never fight over
+    SQLite's write lock. Reads run on a pool of max_workers reader threads;
+    with a storage.SplitSqliteDatabase their connections are read-only.
+    Each thread keeps its own connection (peewee connections are thread
+    local), so the event loop never blocks on SQLite. In-memory databases
+    only exist inside the connection that created them, so work against
+    them runs inline instead.
+
+    initializer, if given, is called once in every new thread before it
+    runs any query."""
+
+    def __init__(self,
+                 max_workers=4,
+                 slow_query_threshold=0.5,
+                 get_database=bound_database,
+                 initializer=None):
+        self.max_workers = max_workers
+        self.slow_query_threshold = slow_query_threshold
+        self.get_database = get_database
+        self.initializer = initializer
+        self.queue_depth = 0
+        self.running = 0
+        self.query_stats = {}
+        self._lock = threading.Lock()
+        self._reader_pool = None
+        self._writer_pool = None
+
+    def _init_writer(self):
+        if self.initializer is not None:
+            self.initializer()
+
+    def _init_reader(self):
+        self._init_writer()
+        database = self.get_database()
+        if hasattr(database, 'mark_read_only'):
+            database.mark_read_only()
+
+    def _get_pool(self, read_only):
+        if read_only:
+            if self._reader_pool is None:
+                self._reader_pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='db-reader',
+                    initializer=self._init_reader)
+            return self._reader_pool
+        if self._writer_pool is None:
+            self._writer_pool = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix='db-writer',
+                initializer=self._init_writer)
+        return self._writer_pool
+
+    def _record(self, name, elapsed):
+        with self._lock:
+            stats = self.query_stats.setdefault(name, QueryStats())
+            stats.record(elapsed)
+            queue_depth = self.queue_depth
+        if elapsed > self.slow_query_threshold:
+            logging.warning(
+                "Consulta lenta %s: %.3fs (fila: %s)",
+                name, elapsed, queue_depth)
+
+    def _execute(self, function, args, kwargs, atomic, queued):
+        if queued:
+            with self._lock:
+                self.queue_depth -= 1
+                self.running += 1
+        start = time.perf_counter()
+        try:
+            if atomic:
+                with self.get_database().atomic():
+                    return function(*args, **kwargs)
+            return function(*args, **kwargs)
+        finally:
+            self._record(function.__name__, time.perf_counter() - start)
+            if queued:
+                with self._lock:
+                    self.running -= 1
+
+    async def _submit(self, function, args, kwargs, atomic, read_only=False):
+        with span('db', function.__name__):
+            if self.get_database().database == ':memory:':
+                return self._execute(function, args, kwargs, atomic, False)
+            with self._lock:
+                self.queue_depth += 1
+            call = functools.partial(self._execute,
+                                     function, args, kwargs, atomic, True)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_pool(read_only),
+                                              call)
+
+    async def read(self, function, *args, **kwargs):
+        """Runs function(*args, **kwargs) on a reader thread. The function
+        must not write."""
+        return await self._submit(function, args, kwargs, False, True)
+
+    async def run(self, function, *args, **kwargs):
+        """Runs function(*args, **kwargs) on the writer thread."""
+        return await self._submit(function, args, kwargs, False)
+
+    async def atomic(self, function, *args, **kwargs):
+        """Same as run, but wraps the call in a transaction."""
+        return await self._submit(function, args, kwargs, True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'running': self.running,
+                'queries': {name: stats.as_dict()
+                            for name, stats in self.query_stats.items()},
+            }
+
+    def shutdown(self):
+        for pool in (self._reader_pool, self._writer_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self._reader_pool = None
+        self._writer_pool = None
@@ -0,0 +1,225 @@
+"""Background delivery of the DMs queued in PendingMessage.
+
+send_code queues the DM with each code in the same transaction that claims
+the code, and returns without waiting for Discord. A DeliveryWorker then
+sends the queued messages, retrying failed sends with exponential backoff.
+Messages live in the database until they are delivered or given up on,
+so they survive restarts: run() starts by looking for leftovers.
+
+A taken message is leased to the worker that took it. The lease is renewed
+before the message is sent if less than half of it is left, so a worker
+in another process never sends a message this one is still sending."""
+import asyncio
+import logging
+import time
+
+import discord
+
+from messaging import deliver
+import queries
+
+
+class LeaseLost(Exception):
+    """Another worker took the message after its lease ran out."""
+
+
+def is_permanent(error):
+    """Closed DMs and unknown users won't get better with time."""
+    return isinstance(error, (discord.Forbidden, discord.NotFound,
+                              LookupError))
+
+
+class DeliveryWorker():
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self,
+                 storage,
+                 resolve_users,
+                 concurrency=5,
+                 batch_size=50,
+                 base_delay=1.0,
+                 max_delay=300.0,
+                 max_attempts=8,
+                 lease=60.0,
+                 on_failure=None,
+                 observe_send=None,
+                 observe_delivery=None,
+                 clock=time.time):
+        self.storage = storage
+        # [user_id] -> {user_id: User, None or the fetch's error}, e.g.
+        # UserResolver's
+        self.resolve_users = resolve_users
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.lease = lease
+        # async (message, error), for messages given up on
+        self.on_failure = on_failure
+        # (seconds) for every send, like deliver()'s observe
+        self.observe_send = observe_send
+        # (outcome, seconds since the message was queued)
+        self.observe_delivery = observe_delivery
+        self.clock = clock
+        # guilds whose database may have messages waiting
+        self.guild_ids = set()
+        self.in_flight = 0
+        self._notifications = 0
+        self._wake = None
+
+    def notify(self, guild_id):
+        """Tells the worker guild_id has new messages waiting."""
+        self.guild_ids.add(guild_id)
+        self._notifications += 1
+        if self._wake is not None:
+            self._wake.set()
+
+    def backoff(self, attempts):
+        """Seconds to wait before the next attempt."""
+        return min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+
+    async def recover(self):
+        """Picks up the messages left behind by earlier runs."""
+        for guild_ids in await self.storage.read_all(
+                queries.pending_message_guilds):
+            self.guild_ids.update(guild_ids)
+
+    async def run(self):
+        """Delivers messages until cancelled."""
+        self._wake = asyncio.Event()
+        await self.recover()
+        while True:
+            self._wake.clear()
+            try:
+                next_due = await self.deliver_due()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Erro ao entregar mensagens pendentes")
+                next_due = self.clock() + self.base_delay
+            timeout = (None if next_due is None
+                       else max(0.0, next_due - self.clock()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def deliver_due(self):
+        """Sends every message that is due. Returns when the next one is
+        due, or None if nothing is waiting."""
+        # shared by every guild, so there are never more than
+        # `concurrency` sends in flight
+        semaphore = asyncio.Semaphore(self.concurrency)
+        next_dues = await asyncio.gather(*[self._drain(guild_id, semaphore)
+                                           for guild_id in self.guild_ids])
+        return min([due for due in next_dues if due is not None],
+                   default=None)
+
+    async def _drain(self, guild_id, semaphore):
+        notifications = self._notifications
+        while True:
+            messages, next_due = await self.storage.atomic(
+                guild_id,
+                queries.take_due_messages,
+                guild_id,
+                self.clock(),
+                self.batch_size,
+                self.lease)
+            if not messages:
+                break
+            await self._deliver(guild_id, messages, semaphore)
+        if next_due is None and notifications == self._notifications:
+            self.guild_ids.discard(guild_id)
+        return next_due
+
+    async def _renew(self, guild_id, message):
+        now = self.clock()
+        if now < message.next_attempt_at - self.lease / 2:
+            return
+        if not await self.storage.run(guild_id,
+                                      queries.renew_lease,
+                                      message.id,
+                                      message.next_attempt_at,
+                                      now + self.lease):
+            raise LeaseLost()
+        message.next_attempt_at = now + self.lease
+
+    async def _deliver(self, guild_id, messages, semaphore):
+        self.in_flight += len(messages)
+        try:
+            users = await self.resolve_users(
+                [message.recipient_id for message in messages])
+            errors = {}
+            lost = set()
+            sendable = []
+            for message in messages:
+                user = users.get(message.recipient_id)
+                if user is None:
+                    errors[message.id] = LookupError(
+                        "Usuário {} não encontrado".format(
+                            message.recipient_id))
+                elif isinstance(user, Exception):
+                    # retried like a failed send
+                    errors[message.id] = user
+                else:
+                    sendable.append((message, user))
+            send_errors = await deliver(
+                [(user, message.content) for message, user in sendable],
+                semaphore=semaphore,
+                observe=self.observe_send,
+                before_send=lambda index: self._renew(guild_id,
+                                                      sendable[index][0]))
+            for (message, _), error in zip(sendable, send_errors):
+                if isinstance(error, LeaseLost):
+                    # the worker that took it over sends it
+                    lost.add(message.id)
+                elif error is not None:
+                    errors[message.id] = error
+            delivered = [message for message in messages
+                         if message.id not in errors
+                         and message.id not in lost]
+            if delivered:
+                await self.storage.run(guild_id,
+                                       queries.delete_messages,
+                                       [message.id for message in delivered])
+            now = self.clock()
+            for message in delivered:
+                self._observe('delivered', now - message.created_at)
+            for message in messages:
+                if message.id in errors:
+                    await self._failed(guild_id, message,
+                                       errors[message.id])
+        finally:
+            self.in_flight -= len(messages)
+
+    async def _failed(self, guild_id, message, error):
+        # take_due_messages already counted this attempt
+        attempts = message.attempts + 1
+        if is_permanent(error) or attempts >= self.max_attempts:
+            await self.storage.atomic(guild_id,
+                                      queries.drop_message,
+                                      message.id)
+            self._observe('failed', self.clock() - message.created_at)
+            if self.on_failure is not None:
+                try:
+                    await self.on_failure(message, error)
+                except Exception:  # pylint: disable=broad-except
+                    # the rest of the batch still has to be settled
+                    logging.exception(
+                        "Erro ao avisar da falha na entrega da mensagem %s",
+                        message.id)
+            return
+        delay = self.backoff(attempts)
+        logging.info("Nova tentativa de enviar a mensagem %s em %.0fs: %s",
+                     message.id, delay, error)
+        await self.storage.run(guild_id,
+                               queries.retry_message,
+                               message.id,
+                               self.clock() + delay,
+                               str(error))
+        self._observe('retried', self.clock() - message.created_at)
+
+    def _observe(self, outcome, elapsed):
+        if self.observe_delivery is not None:
+            self.observe_delivery(outcome, elapsed)
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'guilds': len(self.guild_ids)}
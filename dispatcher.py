@@ -0,0 +1,114 @@
+"""Per-guild command queues.
+
+At most `concurrency` commands of a guild run at once, and its write
+commands run one at a time, so they don't fight over SQLite's write lock.
+Waiting commands sit in one of two lanes: the priority lane (the owner and
+authorized users) is always served before the normal one. A lane that
+already has `max_queued` commands waiting refuses new ones with QueueFull,
+instead of letting them pile up until they time out."""
+import asyncio
+from collections import deque
+
+from discord.ext import commands
+
+PRIORITY = 0
+NORMAL = 1
+
+
+class QueueFull(commands.CommandError):
+    def __init__(self):
+        super().__init__(
+            "Há comandos demais na fila deste servidor, "
+            "tente novamente em alguns instantes")
+
+
+class GuildQueue():
+    """The running slots, lanes and write lock of one guild."""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.running = 0
+        # commands waiting for the write lock or a slot, per lane
+        self.pending = [0, 0]
+        self.waiters = (deque(), deque())
+        self.write_lock = asyncio.Lock()
+
+    def idle(self):
+        return not self.running and not any(self.pending)
+
+    async def acquire(self, lane):
+        if self.running < self.concurrency and not any(self.waiters):
+            self.running += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters[lane].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release()
+            elif waiter in self.waiters[lane]:
+                self.waiters[lane].remove(waiter)
+            raise
+
+    def release(self):
+        """Hands the slot to the next waiter, priority lane first."""
+        for waiters in self.waiters:
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.running -= 1
+
+
+class CommandDispatcher():
+    def __init__(self, concurrency=64, max_queued=100):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.queues = {}
+        self.rejected = 0
+
+    async def run(self, guild_id, function, priority=False, write=False):
+        """Awaits function() once the guild's queue lets it run.
+
+        Raises QueueFull if too many commands are already waiting in its
+        lane."""
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = GuildQueue(self.concurrency)
+        lane = PRIORITY if priority else NORMAL
+        if queue.pending[lane] >= self.max_queued:
+            self.rejected += 1
+            raise QueueFull()
+        queue.pending[lane] += 1
+        waiting = True
+
+        async def run_in_slot():
+            nonlocal waiting
+            await queue.acquire(lane)
+            queue.pending[lane] -= 1
+            waiting = False
+            try:
+                return await function()
+            finally:
+                queue.release()
+
+        try:
+            if write:
+                async with queue.write_lock:
+                    return await run_in_slot()
+            return await run_in_slot()
+        finally:
+            if waiting:
+                queue.pending[lane] -= 1
+            if queue.idle() and self.queues.get(guild_id) is queue:
+                del self.queues[guild_id]
+
+    def stats(self):
+        return {'queued': sum(sum(queue.pending)
+                              for queue in self.queues.values()),
+                'running': sum(queue.running
+                               for queue in self.queues.values()),
+                'rejected': self.rejected}
@@ -0,0 +1,107 @@
+"""Runs the bot as several processes, each holding a slice of the Discord
+shards.
+
+Discord sends every event of a guild to the shard (guild_id >> 22) %
+shard_count, so each guild is served by exactly one process and the
+per-guild caches in main stay consistent. DMs go to shard 0. The processes
+share the SQLite storage, which is safe across processes in WAL mode.
+
+Usage: python launcher.py, with DISCORD_PROCESSES (default: number of CPUs)
+and DISCORD_SHARD_COUNT (default: the count Discord recommends). With
+METRICS_PORT set, process N serves its metrics on METRICS_PORT + N."""
+import asyncio
+import logging
+import multiprocessing
+import os
+
+from discord.http import HTTPClient
+from dotenv import load_dotenv
+
+
+def parse_shard_ids(value):
+    """Parses "0,1,4-7" into [0, 1, 4, 5, 6, 7]. Empty means all shards,
+    which is returned as None."""
+    shard_ids = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids or None
+
+
+def shard_ids_for(process_index, processes, shard_count):
+    return list(range(process_index, shard_count, processes))
+
+
+async def recommended_shard_count(token):
+    http = HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        shard_count, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shard_count
+
+
+def process_environment(shard_ids, shard_count, process_index, environ):
+    """The environment variables that set up one of the processes."""
+    variables = {'DISCORD_SHARD_COUNT': str(shard_count),
+                 'DISCORD_SHARD_IDS': ','.join(map(str, shard_ids))}
+    metrics_port = int(environ.get('METRICS_PORT', '0'))
+    if metrics_port:
+        # every process serves its own metrics, on consecutive ports
+        variables['METRICS_PORT'] = str(metrics_port + process_index)
+    return variables
+
+
+def run_process(shard_ids, shard_count, process_index):
+    os.environ.update(process_environment(shard_ids,
+                                          shard_count,
+                                          process_index,
+                                          os.environ))
+    import main  # pylint: disable=import-outside-toplevel
+    main.run()
+
+
+def launch(processes,
+           shard_count,
+           target=run_process,
+           context=multiprocessing.get_context('spawn')):
+    """Starts one process per slice of shards and waits for all of them.
+
+    Returns the processes' exit codes."""
+    slices = [shard_ids_for(index, processes, shard_count)
+              for index in range(processes)]
+    workers = [context.Process(target=target,
+                               args=(shard_ids, shard_count, index),
+                               name='bot-{}'.format(index))
+               for index, shard_ids in enumerate(slices)]
+    for worker, shard_ids in zip(workers, slices):
+        worker.start()
+        logging.info("Processo %s iniciado com os shards %s",
+                     worker.name, shard_ids)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+    return [worker.exitcode for worker in workers]
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    SHARD_COUNT = (int(os.getenv('DISCORD_SHARD_COUNT', '0'))
+                   or asyncio.run(recommended_shard_count(
+                       os.getenv('BOT_TOKEN'))))
+    PROCESSES = min(int(os.getenv('DISCORD_PROCESSES', os.cpu_count())),
+                    SHARD_COUNT)
+    logging.info("Iniciando %s shard(s) em %s processo(s)",
+                 SHARD_COUNT, PROCESSES)
+    EXIT_CODES = launch(PROCESSES, SHARD_COUNT)
+    raise SystemExit(max(abs(code or 0) for code in EXIT_CODES))
@@ -1,19 +1,37 @@
-from datetime import datetime, timezone
+from itertools import chain
+import asyncio
 import logging
 import os
+from tempfile import TemporaryFile
+import time
 
-from discord import User
+from discord import File, User
 from discord.ext import commands
 from dotenv import load_dotenv
-from peewee import SqliteDatabase, IntegrityError
-import sentry_sdk
 
+from cache import LRUCache, TTLCache
 from constants import MODELS, DATETIME_FORMAT, LOCAL_TIMEZONE
-from model import AuthorizedUser, PromoCodeGroup, PromoCode
+from db_executor import DBExecutor
+from delivery import DeliveryWorker
+from dispatcher import CommandDispatcher, QueueFull
+from launcher import parse_shard_ids
+from messaging import Outbox
+from metrics import Metrics
+from migrations import setup_schema
+from sharding import ShardedStorage, SingleStorage
+from storage import QUERY_HOOKS, open_database
+from viewer import KeysetPager, PAGE_TURNS, run_pager
+from model import ALREADY_RECEIVED
+import queries
+import tracing
+from user_resolver import UserResolver
 from utils import (validate_group_name,
                    parse_codes_in_bulk,
                    validate_code,
+                   read_attachment,
+                   stream_tokens,
                    sqlite_datetime_hack,
+                   send_lines,
                    send_long_message_array)
 
 load_dotenv()
@@ -21,56 +39,306 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 SENTRY_URL = os.getenv('SENTRY_URL')
 SENTRY_ENVIRONMENT = os.getenv('SENTRY_ENVIRONMENT', 'unknown')
+SENTRY_ERROR_SAMPLE_RATE = float(os.getenv('SENTRY_ERROR_SAMPLE_RATE', '1.0'))
+SENTRY_TRACES_SAMPLE_RATE = float(
+    os.getenv('SENTRY_TRACES_SAMPLE_RATE', '0.1'))
+# per-command traces sample rates, e.g. "send_code=1,my_codes=0.01"
+SENTRY_COMMAND_SAMPLE_RATES = tracing.parse_sample_rates(
+    os.getenv('SENTRY_COMMAND_SAMPLE_RATES', ''))
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'database.sqlite')
+DB_MAX_WORKERS = int(os.getenv('DB_MAX_WORKERS', '4'))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '300'))
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '100000'))
+GROUP_CACHE_SIZE = int(os.getenv('GROUP_CACHE_SIZE', '1024'))
+DM_CONCURRENCY = int(os.getenv('DM_CONCURRENCY', '5'))
+# failed DMs are retried after 1, 2, 4... seconds, up to DM_MAX_ATTEMPTS
+DM_RETRY_BASE_DELAY = float(os.getenv('DM_RETRY_BASE_DELAY', '1'))
+DM_RETRY_MAX_DELAY = float(os.getenv('DM_RETRY_MAX_DELAY', '300'))
+DM_MAX_ATTEMPTS = int(os.getenv('DM_MAX_ATTEMPTS', '8'))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '5000'))
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '1000'))
+LIST_CODE_PAGE_ROWS = int(os.getenv('LIST_CODE_PAGE_ROWS', '20'))
+LIST_CODE_TIMEOUT = float(os.getenv('LIST_CODE_TIMEOUT', '300'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '3600'))
+USER_FETCH_CONCURRENCY = int(os.getenv('USER_FETCH_CONCURRENCY', '5'))
+# one database file per guild (or per bucket of guilds) in this directory
+SHARD_DIRECTORY = os.getenv('SHARD_DIRECTORY')
+SHARD_BUCKETS = int(os.getenv('SHARD_BUCKETS', '0'))
+SHARD_IDLE_TIMEOUT = float(os.getenv('SHARD_IDLE_TIMEOUT', '300'))
+# Discord shards held by this process (see launcher.py); by default, all
+DISCORD_SHARD_COUNT = int(os.getenv('DISCORD_SHARD_COUNT', '0')) or None
+DISCORD_SHARD_IDS = parse_shard_ids(os.getenv('DISCORD_SHARD_IDS', ''))
+# serves Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# commands of a guild that run at once, and how many may wait per lane
+GUILD_COMMAND_CONCURRENCY = int(os.getenv('GUILD_COMMAND_CONCURRENCY', '64'))
+GUILD_QUEUE_SIZE = int(os.getenv('GUILD_QUEUE_SIZE', '100'))
+# replies to a channel or user that queue up while the previous one is
+# being sent are merged; this waits as many more seconds before each send
+MESSAGE_COALESCE_WINDOW = float(os.getenv('MESSAGE_COALESCE_WINDOW', '0'))
+# Discord's upload limit for bots outside boosted guilds
+MAX_UPLOAD_SIZE = 8 * 1024 * 1024
+# commands that change a guild's data; they run one at a time per guild
+WRITE_COMMANDS = frozenset({'add_user', 'remove_user', 'add_group',
+                            'remove_group', 'add_code', 'add_code_bulk',
+                            'import_codes', 'remove_code', 'send_code'})
+# list_code waits minutes for reactions, it would hold a slot all along
+UNQUEUED_COMMANDS = frozenset({'list_code'})
+CODE_MESSAGE = "Olá! Você ganhou um código: {}"
+
+bot = commands.AutoShardedBot(command_prefix='$',
+                              shard_count=DISCORD_SHARD_COUNT,
+                              shard_ids=DISCORD_SHARD_IDS)
+
+# the database is only opened by bootstrap(); until then, queries go to
+# whatever the models are bound to (the tests bind them to their own)
+db = None
+storage = SingleStorage(DBExecutor(max_workers=DB_MAX_WORKERS))
+
+# (guild_id, user_id) -> whether the user is in AuthorizedUser
+authorization_cache = TTLCache(ttl=AUTH_CACHE_TTL, max_size=AUTH_CACHE_SIZE)
+
+user_resolver = UserResolver(bot.get_user,
+                             bot.fetch_user,
+                             ttl=USER_CACHE_TTL,
+                             concurrency=USER_FETCH_CONCURRENCY)
+
+# guild_id -> {group name: group id}, for the most recently used guilds
+group_cache = LRUCache(max_size=GROUP_CACHE_SIZE)
+
+
+dispatcher = CommandDispatcher(concurrency=GUILD_COMMAND_CONCURRENCY,
+                               max_queued=GUILD_QUEUE_SIZE)
+
+outbox = Outbox(window=MESSAGE_COALESCE_WINDOW)
+
+
+def gauges():
+    storage_stats = storage.stats()
+    dispatcher_stats = dispatcher.stats()
+    return {'db_queue_depth': storage_stats['queue_depth'],
+            'db_running': storage_stats['running'],
+            'commands_queued': dispatcher_stats['queued'],
+            'commands_running': dispatcher_stats['running'],
+            'commands_rejected': dispatcher_stats['rejected'],
+            'outbox_messages': outbox.messages,
+            'outbox_requests': outbox.requests,
+            'dm_in_flight': delivery.in_flight,
+            'authorization_cache_hits': authorization_cache.hits,
+            'authorization_cache_misses': authorization_cache.misses,
+            'group_cache_hits': group_cache.hits,
+            'group_cache_misses': group_cache.misses}
+
+
+metrics = Metrics(gauges=gauges)
+QUERY_HOOKS.append(metrics.observe_query)
+metrics_runner = None
+
+
+async def report_failed_delivery(message, error):
+    """Tells whoever sent the code that it could not be delivered."""
+    logging.warning("Falha ao enviar código para %s (ID %s): %s",
+                    message.recipient_name, message.recipient_id, error)
+    if message.author_id is None:
+        return
+    author = await user_resolver.resolve(message.author_id)
+    if author is None or isinstance(author, Exception):
+        return
+    await outbox.send(
+        author,
+        "Código {} não pôde ser enviado para o usuário {}: {}".format(
+            message.code, message.recipient_name, error))
+
+
+delivery = DeliveryWorker(storage,
+                          user_resolver.resolve_many,
+                          concurrency=DM_CONCURRENCY,
+                          base_delay=DM_RETRY_BASE_DELAY,
+                          max_delay=DM_RETRY_MAX_DELAY,
+                          max_attempts=DM_MAX_ATTEMPTS,
+                          on_failure=report_failed_delivery,
+                          observe_send=metrics.observe_send,
+                          observe_delivery=metrics.observe_delivery)
+delivery_task = None
+
+# perf_counter() when run() was called, until the bot is ready
+started_at = None
+
+
+def bootstrap():
+    """Opens and migrates the database and sets up Sentry.
+
+    Returns how long each step took, in seconds."""
+    global db, storage  # pylint: disable=global-statement
+    timings = {}
+    start = time.perf_counter()
+    if SHARD_DIRECTORY:
+        storage = ShardedStorage(SHARD_DIRECTORY,
+                                 buckets=SHARD_BUCKETS,
+                                 max_workers=DB_MAX_WORKERS,
+                                 idle_timeout=SHARD_IDLE_TIMEOUT)
+        db = storage.router
+        db.bind(MODELS)
+        delivery.storage = storage
+    else:
+        db = open_database(DATABASE_PATH)
+        db.bind(MODELS)
+        setup_schema(db, MODELS, batch_size=MIGRATION_BATCH_SIZE)
+    timings['database'] = time.perf_counter() - start
+    if SENTRY_URL:
+        start = time.perf_counter()
+        tracing.init(SENTRY_URL,
+                     environment=SENTRY_ENVIRONMENT,
+                     traces_sample_rate=SENTRY_TRACES_SAMPLE_RATE,
+                     command_sample_rates=SENTRY_COMMAND_SAMPLE_RATES,
+                     error_sample_rate=SENTRY_ERROR_SAMPLE_RATE)
+        timings['sentry'] = time.perf_counter() - start
+    return timings
+
+
+@bot.before_invoke
+async def before_invoke(ctx):
+    await metrics.before_invoke(ctx)
+    if SENTRY_URL:
+        tracing.start_command(ctx)
+
+
+@bot.after_invoke
+async def after_invoke(ctx):
+    if SENTRY_URL:
+        tracing.finish_command(ctx)
+    await metrics.after_invoke(ctx)
 
-bot = commands.Bot(command_prefix='$')
 
-db = SqliteDatabase('database.sqlite', pragmas={'foreign_keys': 1})
+@bot.event
+async def on_ready():
+    # pylint: disable=global-statement
+    global delivery_task, metrics_runner, started_at
+    logging.info('Logged on as %s!', bot.user)
+    if started_at is not None:
+        logging.info("Bot pronto %.2fs após o início",
+                     time.perf_counter() - started_at)
+        started_at = None
+    if delivery_task is None:
+        delivery_task = asyncio.ensure_future(delivery.run())
+    await warm_authorization_cache([guild.id for guild in bot.guilds])
+    # last, so that a metrics problem can't keep DMs from being delivered
+    if METRICS_PORT and metrics_runner is None:
+        try:
+            metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as error:
+            logging.error("Não foi possível servir as métricas em %s:%s: %s",
+                          METRICS_HOST, METRICS_PORT, error)
+        else:
+            logging.info("Métricas em http://%s:%s/metrics",
+                         METRICS_HOST, METRICS_PORT)
 
-db.bind(MODELS)
-db.create_tables(MODELS)
 
-sentry_sdk.init(SENTRY_URL,
-                traces_sample_rate=1.0,
-                environment=SENTRY_ENVIRONMENT)
+@bot.event
+async def on_message(message):
+    if message.author.bot:
+        return
+    await dispatch(await bot.get_context(message))
 
 
-@bot.event
-async def on_ready():
-    logging.info('Logged on as %s!', bot.user)
+async def has_priority(ctx):
+    if ctx.guild is None:
+        return await bot.is_owner(ctx.author)
+    return await is_authorized_or_owner(ctx)
+
+
+def queue_key(ctx):
+    """The guild's id, or a key of the author's own for DMs, so that one
+    user's DM commands don't wait behind everyone else's."""
+    if ctx.guild is None:
+        return ('dm', ctx.author.id)
+    return ctx.guild.id
+
+
+async def dispatch(ctx, invoke=bot.invoke, has_priority=has_priority):
+    """Invokes the command through its guild's queue."""
+    if ctx.command is None or ctx.command.name in UNQUEUED_COMMANDS:
+        await invoke(ctx)
+        return
+    try:
+        await dispatcher.run(queue_key(ctx),
+                             lambda: invoke(ctx),
+                             priority=await has_priority(ctx),
+                             write=ctx.command.name in WRITE_COMMANDS)
+    except QueueFull as error:
+        logging.warning("Comando %s recusado: fila do servidor cheia",
+                        ctx.command.name)
+        bot.dispatch('command_error', ctx, error)
 
 
 @bot.event
 async def on_command_error(ctx, error):
-    sentry_sdk.add_breadcrumb(
-        category='discord.command_name',
-        message='Error on command %s' % ctx.command.qualified_name,
-        level='info'
-    )
-    sentry_sdk.capture_exception(error)
-    await ctx.send(str(error))
+    if SENTRY_URL:
+        tracing.capture_command_error(ctx, error)
+    metrics.observe_error(ctx)
+    await outbox.send(ctx, str(error))
+
+
+async def warm_authorization_cache(guild_ids):
+    version = authorization_cache.version()
+    authorized_users = list(chain.from_iterable(await storage.read_all(
+        queries.list_authorized_users, guild_ids)))
+    for guild_id, user_id in authorized_users:
+        authorization_cache.fill((guild_id, user_id), True, version)
+    logging.info("Cache de autorização carregado com %s usuário(s)",
+                 len(authorized_users))
 
 
 async def is_authorized_or_owner(ctx, is_owner=bot.is_owner):
     if await is_owner(ctx.author):
         return True
-    user = AuthorizedUser.get_or_none(
-        (AuthorizedUser.user_id == ctx.author.id)
-        &
-        (AuthorizedUser.guild_id == ctx.guild.id)
-    )
-    return user is not None
+    key = (ctx.guild.id, ctx.author.id)
+    authorized = authorization_cache.get(key)
+    if authorized is None:
+        # add_user/remove_user may commit while this read is in flight
+        version = authorization_cache.version()
+        authorized = await storage.read(ctx.guild.id,
+                                        queries.is_authorized,
+                                        *key)
+        authorization_cache.fill(key, authorized, version)
+    return authorized
+
+
+async def get_groups(guild_id):
+    """Returns the {name: id} dict of the guild's groups."""
+    groups = group_cache.get(guild_id)
+    if groups is None:
+        # add_group/remove_group may commit while this read is in flight
+        version = group_cache.version()
+        groups = await storage.read(guild_id, queries.list_groups, guild_id)
+        group_cache.fill(guild_id, groups, version)
+    return groups
+
+
+async def resolve_group(guild_id, group_name):
+    """Returns the id of the group, or None if it does not exist."""
+    groups = await get_groups(guild_id)
+    return groups.get(group_name)
 
 
 @bot.command()
 @commands.check(is_authorized_or_owner)
 async def echo(ctx, arg):
-    await ctx.send(arg)
+    await outbox.send(ctx, arg)
 
 
 @bot.command()
 @commands.check(is_authorized_or_owner)
 async def echo_dm(ctx, arg):
-    await ctx.author.send(arg)
+    await outbox.send(ctx.author, arg)
+
+
+@bot.command()
+@commands.is_owner()
+async def stats(ctx):
+    """Shows how long commands, queries and sends are taking."""
+    await send_lines(outbox.sender(ctx), metrics.summary_lines)
 
 
 # =======================================================
@@ -83,11 +351,15 @@ async def add_user(ctx, *, user: User):
     logging.info(
         "Estão tentando adicionar o usuário com ID %s aos usuários autorizados",  # noqa E501
         user.id)
-    try:
-        AuthorizedUser.create(guild_id=ctx.guild.id, user_id=user.id)
-        await ctx.send("Adicionado usuário {}".format(user.name))
-    except IntegrityError:
-        await ctx.send("Usuário já autorizado")
+    created = await storage.run(ctx.guild.id,
+                                queries.add_authorized_user,
+                                ctx.guild.id,
+                                user.id)
+    authorization_cache.set((ctx.guild.id, user.id), True)
+    if created:
+        await outbox.send(ctx, "Adicionado usuário {}".format(user.name))
+    else:
+        await outbox.send(ctx, "Usuário já autorizado")
 
 
 @bot.command()
@@ -97,16 +369,16 @@ async def remove_user(ctx, *, user: User):
     logging.info(
         "Estão tentando remover o usuário com ID %s dos usuários autorizados",
         user.id)
-    query = AuthorizedUser.delete().where(
-        (AuthorizedUser.user_id == user.id)
-        &
-        (AuthorizedUser.guild_id == ctx.guild.id)
-    )
-    rows_removed = query.execute()
+    rows_removed = await storage.run(ctx.guild.id,
+                                     queries.remove_authorized_user,
+                                     ctx.guild.id,
+                                     user.id)
+    authorization_cache.set((ctx.guild.id, user.id), False)
     if rows_removed > 0:
-        await ctx.send("Usuário {} desautorizado".format(user.name))
+        await outbox.send(ctx, "Usuário {} desautorizado".format(user.name))
     else:
-        await ctx.send("Usuário não estava autorizado: {}".format(user.name))
+        await outbox.send(
+            ctx, "Usuário não estava autorizado: {}".format(user.name))
 
 
 @bot.command()
@@ -114,16 +386,21 @@ async def remove_user(ctx, *, user: User):
 async def list_user(ctx, fetch_user=bot.fetch_user):
     """Lists the authorized users."""
     logging.info("Estão tentando listar os usuários autorizados")
-    authorized_users = AuthorizedUser.select().where(
-        AuthorizedUser.guild_id == ctx.guild.id)
-    if authorized_users.count() == 0:  # pylint: disable=no-value-for-parameter
-        await ctx.send("Não há usuários autorizados")
+    user_ids = await storage.read(ctx.guild.id,
+                                  queries.list_authorized_user_ids,
+                                  ctx.guild.id)
+    if not user_ids:
+        await outbox.send(ctx, "Não há usuários autorizados")
         return
-    output = "Estes são os usuários autorizados: "
-    for authorized_user in authorized_users:
-        discord_user = await fetch_user(authorized_user.user_id)
-        output += "\n- {}".format(discord_user.name)
-    await ctx.send(output)
+    users = await user_resolver.resolve_many(user_ids, fetch_user)
+    lines = ["Estes são os usuários autorizados: "]
+    for user_id in user_ids:
+        discord_user = users[user_id]
+        if discord_user is None or isinstance(discord_user, Exception):
+            lines.append("- Usuário desconhecido ({})".format(user_id))
+        else:
+            lines.append("- {}".format(discord_user.name))
+    await send_lines(outbox.sender(ctx), lambda: lines)
 
 
 # =======================================================
@@ -137,14 +414,19 @@ async def add_group(ctx, group_name):
     No code can live outside of a group (they get lonely!)."""
     logging.info("Tentando adicionar grupo '%s'", group_name)
     if not validate_group_name(group_name):
-        await ctx.send(
+        await outbox.send(
+            ctx,
             "Nome de grupo inválido. Use apenas letras, números, traços (-) e underscore (_)")  # noqa E501
         return
-    try:
-        PromoCodeGroup.create(guild_id=ctx.guild.id, name=group_name)
-        await ctx.send("Grupo {} criado".format(group_name))
-    except IntegrityError:
-        await ctx.send("Grupo já existente")
+    created = await storage.run(ctx.guild.id,
+                                queries.create_group,
+                                ctx.guild.id,
+                                group_name)
+    group_cache.invalidate(ctx.guild.id)
+    if created:
+        await outbox.send(ctx, "Grupo {} criado".format(group_name))
+    else:
+        await outbox.send(ctx, "Grupo já existente")
 
 
 @bot.command()
@@ -154,32 +436,65 @@ async def remove_group(ctx, group_name):
 
     Careful! All codes within it are brutally killed too!"""
     logging.info("Tentando remover grupo '%s'", group_name)
-    query = PromoCodeGroup.delete().where(
-        (PromoCodeGroup.guild_id == ctx.guild.id)
-        &
-        (PromoCodeGroup.name == group_name)
-    )
-    rows_removed = query.execute()
+    rows_removed = await storage.run(ctx.guild.id,
+                                     queries.delete_group,
+                                     ctx.guild.id,
+                                     group_name)
+    group_cache.invalidate(ctx.guild.id)
     if rows_removed > 0:
-        await ctx.send("Grupo {} removido".format(group_name))
+        await outbox.send(ctx, "Grupo {} removido".format(group_name))
     else:
-        await ctx.send("Grupo {} não existe!".format(group_name))
+        await outbox.send(ctx, "Grupo {} não existe!".format(group_name))
 
 
 @bot.command()
 @commands.check(is_authorized_or_owner)
 async def list_group(ctx):
-    """Let's you see the promo code groups."""
+    """Let's you see the promo code groups and how many codes they have
+    left."""
     logging.info("Tentando listar grupos")
-    groups = PromoCodeGroup.select().where(
-        PromoCodeGroup.guild_id == ctx.guild.id)
-    if groups.count() == 0:  # pylint: disable=no-value-for-parameter
-        await ctx.send("Não há grupos de código promocional cadastrados")
+    version = group_cache.version()
+    group_rows = await storage.read(ctx.guild.id,
+                                    queries.list_group_stats,
+                                    ctx.guild.id)
+    group_cache.fill(ctx.guild.id,
+                     {name: group_id for name, group_id, _, _ in group_rows},
+                     version)
+    if not group_rows:
+        await outbox.send(ctx,
+                          "Não há grupos de código promocional cadastrados")
         return
-    output = "Estes são os grupos de código promocional existentes: "
-    for group in groups:
-        output += "\n- {}".format(group.name)
-    await ctx.send(output)
+    await send_lines(outbox.sender(ctx), lambda: chain(
+        ["Estes são os grupos de código promocional existentes: "],
+        ("- {0} ({1} de {2} códigos disponíveis)".format(
+            name, available, total)
+         for name, _, total, available in group_rows)
+    ))
+
+
+@bot.command()
+@commands.check(is_authorized_or_owner)
+async def group_stats(ctx, group_name=None):
+    """Shows how many codes a group (or every group) has and how many were
+    already sent."""
+    logging.info("Tentando ver estatísticas do(s) grupo(s) %s", group_name)
+    group_rows = await storage.read(ctx.guild.id,
+                                    queries.list_group_stats,
+                                    ctx.guild.id)
+    if group_name is not None:
+        group_rows = [row for row in group_rows if row[0] == group_name]
+        if not group_rows:
+            await outbox.send(ctx, "Grupo {} não existe".format(group_name))
+            return
+    if not group_rows:
+        await outbox.send(ctx,
+                          "Não há grupos de código promocional cadastrados")
+        return
+    await send_lines(outbox.sender(ctx), lambda: (
+        "{0}: {1} códigos, {2} disponíveis, {3} enviados".format(
+            name, total, available, total - available)
+        for name, _, total, available in group_rows
+    ))
 
 
 # =======================================================
@@ -193,26 +508,26 @@ async def add_code(ctx, group_name, code):
                  code,
                  group_name)
     if not validate_code(code):
-        await ctx.send(
+        await outbox.send(
+            ctx,
             "Código inválido: o código deve ser apenas letras, números e traços (-)")  # noqa E501
         return
-    try:
-        group = PromoCodeGroup.get(
-            (PromoCodeGroup.guild_id == ctx.guild.id)
-            &
-            (PromoCodeGroup.name == group_name)
-        )
-        PromoCode.create(group=group, code=code)
-        await ctx.send(
+    group = await resolve_group(ctx.guild.id, group_name)
+    if group is None:
+        await outbox.send(
+            ctx,
+            "Grupo de códigos promocionais não encontrado: {}".format(
+                group_name))
+        return
+    if await storage.run(ctx.guild.id, queries.create_code, group, code):
+        await outbox.send(
+            ctx,
             "Código {0} cadastrado no grupo {1} com sucesso!".format(
                 code,
                 group_name))
-    except PromoCodeGroup.DoesNotExist:  # pylint: disable=no-member
-        await ctx.send(
-            "Grupo de códigos promocionais não encontrado: {}".format(
-                group_name))
-    except IntegrityError:
-        await ctx.send(
+    else:
+        await outbox.send(
+            ctx,
             "Código {0} já cadastrado no grupo {1}".format(code, group_name))
 
 
@@ -228,24 +543,94 @@ async def add_code_bulk(ctx, group_name, *, code_bulk):
     logging.info("Tentando adicionar códigos em massa ao grupo %s: %s",
                  group_name,
                  code_bulk)
-    group = PromoCodeGroup.get_or_none(
-        (PromoCodeGroup.guild_id == ctx.guild.id)
-        &
-        (PromoCodeGroup.name == group_name)
-    )
+    group = await resolve_group(ctx.guild.id, group_name)
     if group is None:
-        await ctx.send(
+        await outbox.send(
+            ctx,
             "Grupo de códigos promocionais não encontrado: {}".format(
                 group_name
             )
         )
         return
-    codes = parse_codes_in_bulk(code_bulk)
-    insert_bulk_data = [{'group': group, 'code': code} for code in codes]
-    with db.atomic() as transaction:
-        PromoCode.insert_many(insert_bulk_data).execute()  # noqa E501 pylint: disable=no-value-for-parameter
-        transaction.commit()
-    await ctx.send("Códigos adicionados ao grupo {}".format(group_name))
+    parsed = parse_codes_in_bulk(code_bulk)
+    _, existing = await storage.atomic(ctx.guild.id,
+                                       queries.add_codes,
+                                       group,
+                                       parsed.codes)
+    output = "Códigos adicionados ao grupo {}".format(group_name)
+    if existing:
+        output += "\n{} código(s) já cadastrado(s) ignorado(s)".format(
+            existing)
+    if parsed.repeated:
+        output += "\n{} código(s) repetido(s) ignorado(s)".format(
+            parsed.repeated)
+    if parsed.invalid:
+        output += "\nCódigos inválidos ignorados: {}".format(
+            ', '.join(parsed.invalid))
+    await send_long_message_array(outbox.sender(ctx),
+                                  output,
+                                  split_character=', ')
+
+
+@bot.command()
+@commands.check(is_authorized_or_owner)
+async def import_codes(ctx, group_name, read_attachment=read_attachment):
+    """Adds the codes from the attached text or CSV files to a group.
+
+    Codes are separated the same way as in add_code_bulk. Codes already in
+    the group are skipped."""
+    logging.info("Tentando importar códigos de arquivo para o grupo %s",
+                 group_name)
+    group = await resolve_group(ctx.guild.id, group_name)
+    if group is None:
+        await outbox.send(
+            ctx,
+            "Grupo de códigos promocionais não encontrado: {}".format(
+                group_name
+            )
+        )
+        return
+    attachments = ctx.message.attachments
+    if not attachments:
+        await outbox.send(ctx,
+                          "Anexe um arquivo de texto ou CSV com os códigos")
+        return
+    start = time.perf_counter()
+    total = inserted = invalid = 0
+    batch = []
+    for attachment in attachments:
+        async for code in stream_tokens(read_attachment(attachment)):
+            if not validate_code(code):
+                invalid += 1
+                continue
+            batch.append(code)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                inserted += await storage.atomic(ctx.guild.id,
+                                                 queries.insert_new_codes,
+                                                 group,
+                                                 batch)
+                total += len(batch)
+                batch = []
+    if batch:
+        inserted += await storage.atomic(ctx.guild.id,
+                                         queries.insert_new_codes,
+                                         group,
+                                         batch)
+        total += len(batch)
+    elapsed = time.perf_counter() - start
+    logging.info("Importados %s códigos para o grupo %s em %.2fs",
+                 inserted, group_name, elapsed)
+    await outbox.send(
+        ctx,
+        "Importação para o grupo {0}: {1} adicionados, {2} duplicados, "
+        "{3} inválidos ({4:.0f} códigos/s)".format(
+            group_name,
+            inserted,
+            total - inserted,
+            invalid,
+            (total + invalid) / elapsed if elapsed else 0
+        )
+    )
 
 
 @bot.command()
@@ -253,57 +638,124 @@ async def add_code_bulk(ctx, group_name, *, code_bulk):
 async def remove_code(ctx, group_name, code):
     """Removes a code from a code group."""
     logging.info("Tentando remover o código %s do grupo %s", code, group_name)
-    group = PromoCodeGroup.get_or_none(
-        (PromoCodeGroup.guild_id == ctx.guild.id)
-        &
-        (PromoCodeGroup.name == group_name)
-    )
+    group = await resolve_group(ctx.guild.id, group_name)
     if group is None:
-        await ctx.send(
+        await outbox.send(
+            ctx,
             "Código {0} não encontrado no grupo {1}".format(code, group_name)
         )
         return
-    query = PromoCode.delete().where(
-        (PromoCode.code == code) & (PromoCode.group == group)
-    )
-    rows_removed = query.execute()
+    rows_removed = await storage.run(ctx.guild.id,
+                                     queries.delete_code,
+                                     group,
+                                     code)
     if rows_removed > 0:
-        await ctx.send(
+        await outbox.send(
+            ctx,
             "Código {0} excluído do grupo {1}".format(code, group_name)
         )
     else:
-        await ctx.send(
+        await outbox.send(
+            ctx,
             "Código {0} não encontrado no grupo {1}".format(code, group_name)
         )
 
 
+def format_sent_at(sent_at):
+    sent_at = sqlite_datetime_hack(sent_at)
+    return sent_at.astimezone(LOCAL_TIMEZONE).strftime(DATETIME_FORMAT)
+
+
+def format_code_line(code, sent_to_name, sent_to_id, sent_at):
+    if not sent_to_id:
+        return "- {}".format(code)
+    return "- {0} enviado para o usuário {1} em {2}".format(
+        code,
+        sent_to_name,
+        format_sent_at(sent_at)
+    )
+
+
+async def wait_for_page_turn(message, timeout=LIST_CODE_TIMEOUT):
+    """Waits for a page turn reaction on message and returns its emoji.
+
+    The bot can't remove reactions in DMs, so removing one also turns the
+    page."""
+    def check(payload):
+        return (payload.message_id == message.id
+                and payload.user_id != bot.user.id
+                and str(payload.emoji) in PAGE_TURNS)
+    waits = [asyncio.ensure_future(bot.wait_for(event, check=check))
+             for event in ('raw_reaction_add', 'raw_reaction_remove')]
+    done, pending = await asyncio.wait(waits,
+                                       timeout=timeout,
+                                       return_when=asyncio.FIRST_COMPLETED)
+    for wait in pending:
+        wait.cancel()
+    if not done:
+        raise asyncio.TimeoutError()
+    return str(done.pop().result().emoji)
+
+
 @bot.command()
 @commands.check(is_authorized_or_owner)
-async def list_code(ctx, group_name):
-    """Lists all codes inside a code group."""
+async def list_code(ctx, group_name, wait_for_page_turn=wait_for_page_turn):
+    """Lists all codes inside a code group.
+
+    Use the reactions on the message to turn its pages."""
     logging.info("Tentando listar os códigos do grupo %s", group_name)
-    group = PromoCodeGroup.get_or_none(
-        (PromoCodeGroup.guild_id == ctx.guild.id)
-        &
-        (PromoCodeGroup.name == group_name)
-    )
+    group = await resolve_group(ctx.guild.id, group_name)
     if group is None:
-        await ctx.send("Grupo {} não existe".format(group_name))
+        await outbox.send(ctx, "Grupo {} não existe".format(group_name))
         return
-    codes = PromoCode.select().where((PromoCode.group == group))
-    if codes.count() == 0:  # pylint: disable=no-value-for-parameter
-        await ctx.send("Grupo {} não possui códigos".format(group_name))
+
+    async def fetch_rows(**kwargs):
+        return await storage.read(ctx.guild.id,
+                                  queries.list_codes_page,
+                                  group,
+                                  **kwargs)
+
+    pager = KeysetPager(fetch_rows,
+                        lambda row: format_code_line(*row[1:]),
+                        "Códigos para o grupo {}: ".format(group_name),
+                        rows_per_page=LIST_CODE_PAGE_ROWS)
+    content = await pager.first_page()
+    if content is None:
+        await outbox.send(
+            ctx, "Grupo {} não possui códigos".format(group_name))
         return
-    output = "Códigos para o grupo {}: ".format(group_name)
-    for code in codes:
-        output += "\n- {}".format(code.code)
-        sent_at = sqlite_datetime_hack(code.sent_at)
-        if code.sent_to_id:
-            output += " enviado para o usuário {0} em {1}".format(
-                code.sent_to_name,
-                sent_at.astimezone(LOCAL_TIMEZONE).strftime(DATETIME_FORMAT)
-            )
-    await send_long_message_array(ctx.author.send, output)
+    message = await outbox.send(ctx.author, content, merge=False)
+    await run_pager(pager, message, wait_for_page_turn)
+
+
+@bot.command()
+@commands.check(is_authorized_or_owner)
+async def export_codes(ctx, group_name):
+    """Sends you a CSV file with all codes of a group."""
+    logging.info("Tentando exportar os códigos do grupo %s", group_name)
+    group = await resolve_group(ctx.guild.id, group_name)
+    if group is None:
+        await outbox.send(ctx, "Grupo {} não existe".format(group_name))
+        return
+    with TemporaryFile() as csv_file:
+        count = await storage.read(ctx.guild.id,
+                                   queries.write_codes_csv,
+                                   group,
+                                   csv_file)
+        size = csv_file.tell()
+        if size > MAX_UPLOAD_SIZE:
+            await outbox.send(
+                ctx,
+                "Arquivo com os {0} códigos do grupo {1} é grande demais "
+                "para o Discord ({2:.1f} MB)".format(
+                    count, group_name, size / 1024 / 1024))
+            return
+        csv_file.seek(0)
+        await outbox.send(
+            ctx.author,
+            "Códigos do grupo {0} ({1} códigos)".format(group_name, count),
+            file=File(csv_file, filename='{}.csv'.format(group_name))
+        )
 
 
 @bot.command()
@@ -317,61 +769,48 @@ async def send_code(ctx,
         "Tentando enviar um código do grupo %s para o(s) usuário(s) %s",
         group_name, ', '.join([f'{user.name}({user.id})' for user in users])
     )
-    group = PromoCodeGroup.get_or_none(
-        (PromoCodeGroup.guild_id == ctx.guild.id)
-        &
-        (PromoCodeGroup.name == group_name)
-    )
+    group = await resolve_group(ctx.guild.id, group_name)
     if group is None:
-        await ctx.send("Grupo {} não existe".format(group_name))
+        await outbox.send(ctx, "Grupo {} não existe".format(group_name))
         return
+    once_per_user = not await is_authorized_or_owner(ctx)
+    claims = await storage.atomic(ctx.guild.id,
+                                  queries.claim_and_queue_codes,
+                                  group,
+                                  [(user.id, user.name) for user in users],
+                                  once_per_user,
+                                  ctx.guild.id,
+                                  ctx.author.id,
+                                  CODE_MESSAGE,
+                                  delivery.clock())
+    delivery.notify(ctx.guild.id)
     messages_author = []
     messages_channel = []
-    with db.atomic() as transaction:
-        for user in users:
-            if not await is_authorized_or_owner(ctx):
-                used_codes = PromoCode.select().where(
-                    (PromoCode.group == group)
-                    &
-                    (PromoCode.sent_to_id == user.id)
-                )
-                if used_codes.count() > 0:
-                    messages_channel.append(
-                        "Usuário {0} já resgatou código do grupo {1}".format(
-                            user.name, group_name)
-                        )
-                    continue
-            promo_code = PromoCode.select().where(
-                (PromoCode.group == group) & (PromoCode.sent_to_id == None) # noqa E501 pylint: disable=singleton-comparison
-            ).first()
-            if promo_code is None:
-                messages_channel.append(
-                    "Grupo {} não possui mais códigos disponíveis".format(
-                        group_name
-                    )
+    for user, promo_code in zip(users, claims):
+        if promo_code is ALREADY_RECEIVED:
+            messages_channel.append(
+                "Usuário {0} já resgatou código do grupo {1}".format(
+                    user.name, group_name)
                 )
-                break
-            promo_code.sent_to_name = user.name
-            promo_code.sent_to_id = user.id
-            promo_code.sent_at = datetime.now(timezone.utc)
-            promo_code.save()
-            await user.send(
-                "Olá! Você ganhou um código: {}".format(promo_code.code)
+            continue
+        messages_author.append(
+            "Código {} será enviado para o usuário {}".format(
+                promo_code.code, user.name
             )
-            # incluir essa linha nos testes!
-            messages_author.append(
-                "Código {} enviado para o usuário {}".format(
-                    promo_code.code, user.name
-                )
+        )
+        messages_channel.append(
+            "Código do grupo {} será enviado para o usuário {}".format(
+                group_name, user.name
             )
-            messages_channel.append(
-                "Enviado código do grupo {} para o usuário {}".format(
-                    group_name, user.name
-                )
+        )
+    if len(claims) < len(users):
+        messages_channel.append(
+            "Grupo {} não possui mais códigos disponíveis".format(
+                group_name
             )
-        await ctx.send("\n".join(messages_channel))
-        await ctx.author.send("\n".join(messages_author))
-        transaction.commit()
+        )
+    await outbox.send(ctx, "\n".join(messages_channel))
+    await outbox.send(ctx.author, "\n".join(messages_author))
 
 
 @bot.command()
@@ -381,24 +820,33 @@ async def my_codes(ctx):
         "O usuário %s (ID %s) está tentando listar os próprios códigos",
         ctx.author.name, ctx.author.id
     )
-    promo_codes = PromoCode.select().where(
-        (PromoCode.sent_to_id == ctx.author.id)
-    )
-    if promo_codes.count() == 0:
-        await ctx.author.send("Você não possui códigos")
+    promo_codes = list(chain.from_iterable(await storage.read_all(
+        queries.codes_sent_to, ctx.author.id)))
+    if not promo_codes:
+        await outbox.send(ctx.author, "Você não possui códigos")
         return
-    output = "Seus códigos: "
-    for promo_code in promo_codes:
-        sent_at = sqlite_datetime_hack(promo_code.sent_at)
-        output += "\n- {0} (recebido em {1})".format(
-            promo_code.code,
-            sent_at.astimezone(LOCAL_TIMEZONE).strftime(DATETIME_FORMAT)
-        )
-    await ctx.author.send(output)
+    await send_lines(outbox.sender(ctx.author), lambda: chain(
+        ["Seus códigos: "],
+        ("- {0} (recebido em {1})".format(code, format_sent_at(sent_at))
+         for code, sent_at in promo_codes)
+    ))
 
-if __name__ == '__main__':
+
+def run():
+    global started_at  # pylint: disable=global-statement
     logging.basicConfig(level=logging.INFO)
+    # CPU time so far: starting Python and importing this module
+    logging.info("Importação concluída em %.2fs de CPU", time.process_time())
+    started_at = time.perf_counter()
+    for step, elapsed in bootstrap().items():
+        logging.info("Inicialização (%s): %.2fs", step, elapsed)
     bot.run(BOT_TOKEN)
     logging.info('Disconnecting from DB...')
-    db.close()
+    storage.shutdown()
+    if not SHARD_DIRECTORY:
+        db.close()
     logging.info("DB disconnected!")
+
+
+if __name__ == '__main__':
+    run()
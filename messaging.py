@@ -0,0 +1,145 @@
+import asyncio
+from collections import deque
+from functools import partial
+import time
+
+from tracing import span
+
+# Discord's limit for a message's content
+MAX_MESSAGE_LENGTH = 2000
+
+
+def bucket_key(destination):
+    """Messages to the same destination share a Discord rate limit bucket
+    (the channel's route), so they are grouped by the destination id."""
+    return getattr(destination, 'id', id(destination))
+
+
+def destination_key(destination):
+    """Replies to a command context go to the context's channel."""
+    channel = getattr(destination, 'channel', None)
+    return bucket_key(destination if channel is None else channel)
+
+
+async def deliver(messages,
+                  concurrency=5,
+                  observe=None,
+                  semaphore=None,
+                  before_send=None):
+    """Sends a list of (destination, content) pairs concurrently.
+
+    At most `concurrency` sends are in flight at once, and messages for the
+    same destination go out one at a time and in order. discord.py already
+    waits out 429s per route; this keeps a single command from queueing
+    more requests than the bot can spend. Passing a `semaphore` instead
+    shares the limit with other deliver() calls.
+
+    observe, if given, is called with the duration in seconds of every send.
+    before_send, if given, is awaited with a message's index right before
+    it is sent; if it raises, the message fails without being sent.
+
+    Returns a list with None for every delivered message and the raised
+    exception for every failed one, in the same order as `messages`."""
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency)
+    bucket_locks = {}
+
+    async def send_one(index, destination, content):
+        lock = bucket_locks.setdefault(bucket_key(destination),
+                                       asyncio.Lock())
+        async with lock, semaphore:
+            try:
+                if before_send is not None:
+                    await before_send(index)
+            except Exception as error:  # pylint: disable=broad-except
+                return error
+            start = time.perf_counter()
+            try:
+                with span('discord.send', 'dm'):
+                    await destination.send(content)
+            except Exception as error:  # pylint: disable=broad-except
+                return error
+            finally:
+                if observe is not None:
+                    observe(time.perf_counter() - start)
+        return None
+
+    return await asyncio.gather(*[
+        send_one(index, destination, content)
+        for index, (destination, content) in enumerate(messages)])
+
+
+class Outbox():
+    """Merges the messages queued for the same destination into as few
+    messages of up to max_length characters as possible, joined by
+    newlines, and sends them in order.
+
+    Messages queue up while the previous send to their destination is in
+    flight, and for `window` extra seconds before every send. Without
+    this, every command replying on a busy channel spends one request of
+    the channel's rate limit on each reply."""
+
+    def __init__(self, window=0, max_length=MAX_MESSAGE_LENGTH):
+        self.window = window
+        self.max_length = max_length
+        self.messages = 0
+        self.requests = 0
+        # destination key -> deque of (destination, content, merge, kwargs,
+        # future) waiting to be sent
+        self._pending = {}
+        self._flushers = set()
+
+    async def send(self, destination, content, merge=True, **kwargs):
+        """Queues the message and waits until it is sent.
+
+        Returns the sent message, which other messages may share, or
+        raises whatever sending it raised. Messages with merge=False or
+        with keyword arguments (files, embeds) are sent on their own."""
+        future = asyncio.get_event_loop().create_future()
+        key = destination_key(destination)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = deque()
+            flusher = asyncio.ensure_future(self._flush(key, pending))
+            self._flushers.add(flusher)
+            flusher.add_done_callback(self._flushers.discard)
+        pending.append((destination, str(content), merge and not kwargs,
+                        kwargs, future))
+        self.messages += 1
+        return await future
+
+    def sender(self, destination, merge=True):
+        """send() bound to destination, for send_lines and the like."""
+        return partial(self.send, destination, merge=merge)
+
+    def _take_batch(self, pending):
+        destination, content, merge, kwargs, future = pending.popleft()
+        futures = [future]
+        while (merge and pending and pending[0][2]
+               and len(content) + 1 + len(pending[0][1]) <= self.max_length):
+            content += '\n' + pending[0][1]
+            futures.append(pending.popleft()[4])
+        return destination, content, kwargs, futures
+
+    async def _flush(self, key, pending):
+        try:
+            while pending:
+                await asyncio.sleep(self.window)
+                destination, content, kwargs, futures = self._take_batch(
+                    pending)
+                self.requests += 1
+                try:
+                    message = await destination.send(content, **kwargs)
+                except Exception as error:  # pylint: disable=broad-except
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                for future in futures:
+                    if not future.done():
+                        future.set_result(message)
+        finally:
+            del self._pending[key]
+
+    def stats(self):
+        return {'messages': self.messages, 'requests': self.requests}
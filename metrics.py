@@ -0,0 +1,199 @@
+"""Command, database, Discord send and DM delivery timings.
+
+Metrics keeps histograms that the bot's invoke hooks, the storage query
+hook, deliver() and the DeliveryWorker fill in, and renders them in
+Prometheus' text format for the local /metrics endpoint and the $stats
+command."""
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+import time
+
+# upper bounds, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+PREFIX = 'promo_bot'
+
+
+class Histogram():
+    """Counts observations per bucket, Prometheus style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.bucket_counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative_counts(self):
+        """Returns [(upper bound, observations <= bound)], ending with
+        +Inf."""
+        with self._lock:
+            counts = list(self.bucket_counts)
+        total = 0
+        cumulative = []
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile."""
+        cumulative = self.cumulative_counts()
+        target = fraction * cumulative[-1][1]
+        for bound, count in cumulative:
+            if count and count >= target:
+                return bound
+        return 0.0
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value)
+                          for name, value in labels) + '}'
+
+
+def render_histogram(name, histogram, labels=()):
+    lines = []
+    for bound, count in histogram.cumulative_counts():
+        lines.append('{}_bucket{} {}'.format(
+            name,
+            format_labels(tuple(labels) + (('le', format_bound(bound)),)),
+            count))
+    lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+                                      histogram.sum))
+    lines.append('{}_count{} {}'.format(name, format_labels(labels),
+                                        histogram.count))
+    return lines
+
+
+class Metrics():
+    def __init__(self, clock=time.perf_counter, gauges=None):
+        self.clock = clock
+        # () -> {name: value}, read when rendering
+        self.gauges = gauges
+        self.commands = defaultdict(Histogram)
+        self.command_errors = defaultdict(int)
+        self.db_queries = Histogram()
+        self.sends = defaultdict(Histogram)
+        # outcome -> seconds from queueing a DM to delivering, retrying or
+        # giving up on it
+        self.deliveries = defaultdict(Histogram)
+
+    def timed(self, send, kind):
+        """Wraps an async send function so its latency is observed."""
+        async def timed_send(*args, **kwargs):
+            start = self.clock()
+            try:
+                return await send(*args, **kwargs)
+            finally:
+                self.sends[kind].observe(self.clock() - start)
+        return timed_send
+
+    async def before_invoke(self, ctx):
+        ctx.metrics_start = self.clock()
+        ctx.send = self.timed(ctx.send, 'channel')
+
+    async def after_invoke(self, ctx):
+        self.commands[ctx.command.qualified_name].observe(
+            self.clock() - ctx.metrics_start)
+
+    def observe_error(self, ctx):
+        name = ctx.command.qualified_name if ctx.command else 'unknown'
+        self.command_errors[name] += 1
+
+    def observe_query(self, sql, elapsed):  # pylint: disable=unused-argument
+        self.db_queries.observe(elapsed)
+
+    def observe_send(self, elapsed):
+        self.sends['dm'].observe(elapsed)
+
+    def observe_delivery(self, outcome, elapsed):
+        self.deliveries[outcome].observe(elapsed)
+
+    def render(self):
+        """The metrics in Prometheus' text exposition format."""
+        lines = ['# TYPE {}_command_duration_seconds histogram'.format(
+            PREFIX)]
+        for name, histogram in sorted(self.commands.items()):
+            lines += render_histogram(
+                PREFIX + '_command_duration_seconds', histogram,
+                (('command', name),))
+        lines.append('# TYPE {}_command_errors_total counter'.format(PREFIX))
+        for name, errors in sorted(self.command_errors.items()):
+            lines.append('{}_command_errors_total{} {}'.format(
+                PREFIX, format_labels((('command', name),)), errors))
+        lines.append('# TYPE {}_db_query_duration_seconds histogram'.format(
+            PREFIX))
+        lines += render_histogram(PREFIX + '_db_query_duration_seconds',
+                                  self.db_queries)
+        lines.append('# TYPE {}_send_duration_seconds histogram'.format(
+            PREFIX))
+        for kind, histogram in sorted(self.sends.items()):
+            lines += render_histogram(PREFIX + '_send_duration_seconds',
+                                      histogram, (('kind', kind),))
+        lines.append('# TYPE {}_dm_delivery_seconds histogram'.format(PREFIX))
+        for outcome, histogram in sorted(self.deliveries.items()):
+            lines += render_histogram(PREFIX + '_dm_delivery_seconds',
+                                      histogram, (('outcome', outcome),))
+        for name, value in sorted((self.gauges or dict)().items()):
+            lines.append('# TYPE {}_{} gauge'.format(PREFIX, name))
+            lines.append('{}_{} {}'.format(PREFIX, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def summary_lines(self):
+        """Human readable summary, for $stats."""
+        lines = []
+        for name, histogram in sorted(self.commands.items()):
+            lines.append(
+                "{0}: {1} execuções, média {2:.1f}ms, p95 até {3:.0f}ms, "
+                "{4} erros".format(name,
+                                   histogram.count,
+                                   histogram.sum / histogram.count * 1000,
+                                   histogram.quantile(0.95) * 1000,
+                                   self.command_errors.get(name, 0)))
+        lines.append("Banco de dados: {0} consultas, {1:.2f}s no total".format(
+            self.db_queries.count, self.db_queries.sum))
+        for kind, histogram in sorted(self.sends.items()):
+            lines.append(
+                "Envios ({0}): {1}, média {2:.1f}ms, p95 até {3:.0f}ms".format(
+                    kind,
+                    histogram.count,
+                    histogram.sum / histogram.count * 1000,
+                    histogram.quantile(0.95) * 1000))
+        for outcome, histogram in sorted(self.deliveries.items()):
+            lines.append(
+                "DMs ({0}): {1}, {2:.1f}s após entrar na fila em média".format(
+                    outcome, histogram.count, histogram.sum / histogram.count))
+        return lines
+
+    async def serve(self, host='127.0.0.1', port=9100):
+        """Serves GET /metrics. Returns the aiohttp AppRunner; call its
+        cleanup() to stop."""
+        from aiohttp import web  # pylint: disable=import-outside-toplevel
+
+        async def handle_metrics(request):  # pylint: disable=unused-argument
+            return web.Response(text=self.render(),
+                                content_type='text/plain',
+                                charset='utf-8')
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError:
+            await runner.cleanup()
+            raise
+        return runner
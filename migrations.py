@@ -0,0 +1,413 @@
+"""Versioned schema migrations.
+
+The schema version lives in SQLite's user_version pragma. Each entry of
+MIGRATIONS takes the database from version N to N + 1, so new migrations
+are only ever appended. setup_schema() builds new databases straight from
+the models and starts them at the latest version; existing databases are
+migrated before create_tables adds the tables no migration creates.
+
+A migration is either a function of the database, run in one transaction,
+or a generator function of (database, batch_size) for migrations that
+rewrite many rows. The runner commits every time a generator yields, so a
+backfill of a large table holds the write lock one batch at a time. The
+version is bumped with the last batch, so an interrupted migration runs
+again from the start: every batch must be safe to repeat.
+
+Several processes may migrate the same database at once, e.g. when
+launcher.py starts them all together. Every transaction takes the write
+lock up front and checks the version again, so a batch of migration N
+only ever runs on a database at version N - 1, and a process that falls
+behind stops instead of redoing what the others finished."""
+import inspect
+import logging
+import time
+
+
+def add_column_if_missing(database, table, column, definition):
+    if column not in [info.name for info in database.get_columns(table)]:
+        database.execute_sql('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+            table, column, definition))
+
+
+def rowid_ranges(database, table, batch_size):
+    """Yields (first, last) rowid ranges that cover the table, batch_size
+    rowids at a time."""
+    first, last = database.execute_sql(
+        'SELECT min(rowid), max(rowid) FROM "{}"'.format(table)).fetchone()
+    if first is None:
+        return
+    for start in range(first, last + 1, batch_size):
+        yield start, start + batch_size - 1
+
+
+# Migrations keep their own copy of the SQL they run, so later changes to
+# the models can't change what an old migration does.
+
+# The counters as add_group_counters installed them, while a code was
+# available until sent_to_id was set
+SENT_TO_COUNTER_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS "promocode_counters_insert"
+    AFTER INSERT ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" + 1,
+            "available_codes" = "available_codes" + (NEW."sent_to_id" IS NULL)
+        WHERE "id" = NEW."group_id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "promocode_counters_delete"
+    AFTER DELETE ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" - 1,
+            "available_codes" = "available_codes" - (OLD."sent_to_id" IS NULL)
+        WHERE "id" = OLD."group_id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "promocode_counters_update"
+    AFTER UPDATE OF "sent_to_id" ON "promocode"
+    WHEN (OLD."sent_to_id" IS NULL) != (NEW."sent_to_id" IS NULL)
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "available_codes" = "available_codes"
+            + (NEW."sent_to_id" IS NULL) - (OLD."sent_to_id" IS NULL)
+        WHERE "id" = NEW."group_id";
+    END""",
+)
+
+# The counters once a code is available until it is claimed
+CLAIMED_COUNTER_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS "promocode_counters_insert"
+    AFTER INSERT ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" + 1,
+            "available_codes" = "available_codes" + (NEW."claimed" = 0)
+        WHERE "id" = NEW."group_id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "promocode_counters_delete"
+    AFTER DELETE ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" - 1,
+            "available_codes" = "available_codes" - (OLD."claimed" = 0)
+        WHERE "id" = OLD."group_id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "promocode_counters_update"
+    AFTER UPDATE OF "claimed" ON "promocode"
+    WHEN OLD."claimed" != NEW."claimed"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "available_codes" = "available_codes"
+            + (NEW."claimed" = 0) - (OLD."claimed" = 0)
+        WHERE "id" = NEW."group_id";
+    END""",
+)
+
+
+def add_promo_code_indexes(database, batch_size):
+    """Indexes for claiming free codes and for per-group redemptions."""
+    # pylint: disable=unused-argument
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "promocode_available" '
+        'ON "promocode" ("group_id") WHERE "sent_to_id" IS NULL')
+    yield
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "promocode_group_id_sent_to_id" '
+        'ON "promocode" ("group_id", "sent_to_id")')
+
+
+def add_group_counters(database, batch_size):
+    """Per-group code counters, kept up to date by triggers."""
+    add_column_if_missing(database, 'promocodegroup', 'total_codes',
+                          'INTEGER NOT NULL DEFAULT 0')
+    add_column_if_missing(database, 'promocodegroup', 'available_codes',
+                          'INTEGER NOT NULL DEFAULT 0')
+    for trigger in SENT_TO_COUNTER_TRIGGERS:
+        database.execute_sql(trigger)
+    for first, last in rowid_ranges(database, 'promocodegroup', batch_size):
+        yield
+        database.execute_sql(
+            'UPDATE "promocodegroup" SET '
+            '"total_codes" = (SELECT count(*) FROM "promocode" '
+            '                 WHERE "group_id" = "promocodegroup"."id"), '
+            '"available_codes" = (SELECT count(*) FROM "promocode" '
+            '                     WHERE "group_id" = "promocodegroup"."id" '
+            '                     AND "sent_to_id" IS NULL) '
+            'WHERE "id" BETWEEN ? AND ?', (first, last))
+
+
+REDEMPTION_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS "redemption" ('
+    '"id" INTEGER NOT NULL PRIMARY KEY, '
+    '"promo_code_id" INTEGER, '
+    '"group_id" INTEGER, '
+    '"code" VARCHAR(255) NOT NULL, '
+    '"user_id" INTEGER NOT NULL, '
+    '"user_name" VARCHAR(255), '
+    '"redeemed_at" DATETIME, '
+    '"released_at" DATETIME, '
+    'FOREIGN KEY ("promo_code_id") REFERENCES "promocode" ("id") '
+    'ON DELETE SET NULL, '
+    'FOREIGN KEY ("group_id") REFERENCES "promocodegroup" ("id") '
+    'ON DELETE SET NULL)',
+    'CREATE INDEX IF NOT EXISTS "redemption_promo_code_id" '
+    'ON "redemption" ("promo_code_id")',
+    'CREATE INDEX IF NOT EXISTS '
+    '"redemption_user_id_group_id_released_at_redeemed_at_code" '
+    'ON "redemption" '
+    '("user_id", "group_id", "released_at", "redeemed_at", "code")',
+    'CREATE INDEX IF NOT EXISTS "redemption_group_id_redeemed_at" '
+    'ON "redemption" ("group_id", "redeemed_at")',
+)
+
+
+# Kept the ledger in step with sent_to_* until add_claimed
+SENT_TO_REDEMPTION_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS "redemption_insert"
+    AFTER INSERT ON "promocode"
+    WHEN NEW."sent_to_id" IS NOT NULL
+    BEGIN
+        INSERT INTO "redemption" ("promo_code_id", "group_id", "code",
+                                  "user_id", "user_name", "redeemed_at")
+        VALUES (NEW."id", NEW."group_id", NEW."code",
+                NEW."sent_to_id", NEW."sent_to_name", NEW."sent_at");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "redemption_claim"
+    AFTER UPDATE OF "sent_to_id" ON "promocode"
+    WHEN OLD."sent_to_id" IS NULL AND NEW."sent_to_id" IS NOT NULL
+    BEGIN
+        INSERT INTO "redemption" ("promo_code_id", "group_id", "code",
+                                  "user_id", "user_name", "redeemed_at")
+        VALUES (NEW."id", NEW."group_id", NEW."code",
+                NEW."sent_to_id", NEW."sent_to_name", NEW."sent_at");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "redemption_release"
+    AFTER UPDATE OF "sent_to_id" ON "promocode"
+    WHEN OLD."sent_to_id" IS NOT NULL AND NEW."sent_to_id" IS NULL
+    BEGIN
+        UPDATE "redemption"
+        SET "released_at" = strftime('%Y-%m-%d %H:%M:%f+00:00', 'now')
+        WHERE "promo_code_id" = OLD."id" AND "released_at" IS NULL;
+    END""",
+)
+
+
+def add_redemptions(database, batch_size):
+    """The Redemption ledger, backfilled from the codes already sent."""
+    for statement in REDEMPTION_SCHEMA + SENT_TO_REDEMPTION_TRIGGERS:
+        database.execute_sql(statement)
+    for first, last in rowid_ranges(database, 'promocode', batch_size):
+        yield
+        database.execute_sql(
+            'INSERT INTO "redemption" ("promo_code_id", "group_id", "code", '
+            '                          "user_id", "user_name", "redeemed_at") '
+            'SELECT "id", "group_id", "code", '
+            '       "sent_to_id", "sent_to_name", "sent_at" '
+            'FROM "promocode" '
+            'WHERE "id" BETWEEN ? AND ? AND "sent_to_id" IS NOT NULL '
+            'AND NOT EXISTS (SELECT 1 FROM "redemption" '
+            '                WHERE "promo_code_id" = "promocode"."id")',
+            (first, last))
+
+
+def add_claimed(database, batch_size):
+    """Stops writing who got each code to PromoCode.
+
+    Codes already sent are marked claimed, and their sent_to_* cleared,
+    one batch at a time, then the counters and the index of free codes
+    switch over to claimed. The Redemption ledger no longer follows
+    sent_to_*. The emptied columns stay: dropping them would rewrite the
+    whole table."""
+    add_column_if_missing(database, 'promocode', 'claimed',
+                          'INTEGER NOT NULL DEFAULT 0')
+    # the old counters would count the backfill below as codes being
+    # sent, and the ledger must not follow sent_to_* anymore
+    for trigger in ('promocode_counters_insert',
+                    'promocode_counters_delete',
+                    'promocode_counters_update',
+                    'redemption_insert',
+                    'redemption_claim',
+                    'redemption_release'):
+        database.execute_sql(f'DROP TRIGGER IF EXISTS "{trigger}"')
+    for first, last in rowid_ranges(database, 'promocode', batch_size):
+        yield
+        database.execute_sql(
+            'UPDATE "promocode" SET "claimed" = 1, "sent_to_id" = NULL, '
+            '"sent_to_name" = NULL, "sent_at" = NULL '
+            'WHERE "id" BETWEEN ? AND ? AND "sent_to_id" IS NOT NULL',
+            (first, last))
+    yield
+    for index in ('promocode_available',
+                  'promocode_group_id_sent_to_id',
+                  'promocode_sent_to_id'):
+        database.execute_sql(f'DROP INDEX IF EXISTS "{index}"')
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "promocode_unclaimed" '
+        'ON "promocode" ("group_id") WHERE "claimed" = 0')
+    for trigger in CLAIMED_COUNTER_TRIGGERS:
+        database.execute_sql(trigger)
+
+
+FREE_CODE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS "freecode" ('
+    '"promo_code_id" INTEGER NOT NULL PRIMARY KEY, '
+    '"group_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("promo_code_id") REFERENCES "promocode" ("id") '
+    'ON DELETE CASCADE, '
+    'FOREIGN KEY ("group_id") REFERENCES "promocodegroup" ("id") '
+    'ON DELETE CASCADE)',
+    'CREATE INDEX IF NOT EXISTS "freecode_group_id" '
+    'ON "freecode" ("group_id")',
+    'CREATE TABLE IF NOT EXISTS "redemptionrelease" ('
+    '"redemption_id" INTEGER NOT NULL PRIMARY KEY, '
+    '"released_at" DATETIME NOT NULL, '
+    'FOREIGN KEY ("redemption_id") REFERENCES "redemption" ("id"))',
+)
+
+# The counters once free codes are kept in freecode
+FREE_CODE_COUNTER_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS "promocode_insert"
+    AFTER INSERT ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" + 1
+        WHERE "id" = NEW."group_id";
+        INSERT INTO "freecode" ("promo_code_id", "group_id")
+        VALUES (NEW."id", NEW."group_id");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "promocode_delete"
+    AFTER DELETE ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" - 1
+        WHERE "id" = OLD."group_id";
+        DELETE FROM "freecode" WHERE "promo_code_id" = OLD."id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "freecode_insert"
+    AFTER INSERT ON "freecode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "available_codes" = "available_codes" + 1
+        WHERE "id" = NEW."group_id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "freecode_delete"
+    AFTER DELETE ON "freecode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "available_codes" = "available_codes" - 1
+        WHERE "id" = OLD."group_id";
+    END""",
+)
+
+
+def add_free_codes(database, batch_size):
+    """Stops rewriting PromoCode and Redemption rows.
+
+    The unclaimed codes are copied to freecode and the released
+    redemptions to redemptionrelease, one batch at a time. sent_to_* is
+    cleared from rows an earlier add_claimed left it in. The counters then
+    switch over to freecode. The claimed and released_at columns stay,
+    unused: dropping them would rewrite the whole tables."""
+    for statement in FREE_CODE_SCHEMA:
+        database.execute_sql(statement)
+    # the backfill below must not count codes as being claimed
+    for trigger in ('promocode_counters_insert',
+                    'promocode_counters_delete',
+                    'promocode_counters_update'):
+        database.execute_sql(f'DROP TRIGGER IF EXISTS "{trigger}"')
+    for first, last in rowid_ranges(database, 'promocode', batch_size):
+        yield
+        database.execute_sql(
+            'INSERT OR IGNORE INTO "freecode" ("promo_code_id", "group_id") '
+            'SELECT "id", "group_id" FROM "promocode" '
+            'WHERE "id" BETWEEN ? AND ? AND "claimed" = 0', (first, last))
+        database.execute_sql(
+            'UPDATE "promocode" SET "sent_to_id" = NULL, '
+            '"sent_to_name" = NULL, "sent_at" = NULL '
+            'WHERE "id" BETWEEN ? AND ? AND "sent_to_id" IS NOT NULL',
+            (first, last))
+    for first, last in rowid_ranges(database, 'redemption', batch_size):
+        yield
+        database.execute_sql(
+            'INSERT OR IGNORE INTO "redemptionrelease" '
+            '("redemption_id", "released_at") '
+            'SELECT "id", "released_at" FROM "redemption" '
+            'WHERE "id" BETWEEN ? AND ? AND "released_at" IS NOT NULL',
+            (first, last))
+    yield
+    database.execute_sql('DROP INDEX IF EXISTS "promocode_unclaimed"')
+    database.execute_sql(
+        'DROP INDEX IF EXISTS '
+        '"redemption_user_id_group_id_released_at_redeemed_at_code"')
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS '
+        '"redemption_user_id_group_id_redeemed_at_code" '
+        'ON "redemption" ("user_id", "group_id", "redeemed_at", "code")')
+    for trigger in FREE_CODE_COUNTER_TRIGGERS:
+        database.execute_sql(trigger)
+
+
+MIGRATIONS = [
+    add_promo_code_indexes,
+    add_group_counters,
+    add_redemptions,
+    add_claimed,
+    add_free_codes,
+]
+
+
+def schema_version(database):
+    return database.pragma('user_version')
+
+
+def run_migration(database, migration, number, batch_size):
+    """Runs the migration unless another process already did, and returns
+    how many transactions it took."""
+    if not inspect.isgeneratorfunction(migration):
+        with database.atomic(lock_type='IMMEDIATE'):
+            if schema_version(database) >= number:
+                return 0
+            migration(database)
+            database.pragma('user_version', number)
+        return 1
+    batches = migration(database, batch_size)
+    done = False
+    count = 0
+    while not done:
+        with database.atomic(lock_type='IMMEDIATE'):
+            if schema_version(database) >= number:
+                batches.close()
+                return count
+            try:
+                next(batches)
+            except StopIteration:
+                database.pragma('user_version', number)
+                done = True
+        count += 1
+    return count
+
+
+def migrate(database, migrations=None, batch_size=1000):
+    """Applies every migration newer than the database's schema version."""
+    migrations = MIGRATIONS if migrations is None else migrations
+    version = schema_version(database)
+    for number, migration in enumerate(migrations[version:],
+                                       start=version + 1):
+        logging.info("Aplicando migração %s: %s", number, migration.__name__)
+        start = time.perf_counter()
+        batches = run_migration(database, migration, number, batch_size)
+        logging.info("Migração %s aplicada em %.2fs (%s lote(s))",
+                     number, time.perf_counter() - start, batches)
+    return schema_version(database)
+
+
+def setup_schema(database, models, batch_size=1000):
+    """Brings a new or existing database to the latest schema. Returns the
+    schema version."""
+    if not database.get_tables():
+        with database.atomic(lock_type='IMMEDIATE'):
+            database.create_tables(models)
+            database.pragma('user_version', len(MIGRATIONS))
+        return len(MIGRATIONS)
+    version = migrate(database, batch_size=batch_size)
+    database.create_tables(models)
+    return version
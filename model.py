@@ -1,8 +1,53 @@
+from datetime import datetime, timezone
+
 from peewee import (Model,
                     IntegerField,
                     CharField,
+                    FloatField,
                     ForeignKeyField,
-                    DateTimeField)
+                    DateTimeField,
+                    TextField)
+
+
+# Marks users skipped by PromoCode.claim because they already got a code
+ALREADY_RECEIVED = 'already_received'
+
+# Every new code starts out free, and PromoCodeGroup's counters follow
+# PromoCode (total_codes) and FreeCode (available_codes). Codes never move
+# between groups.
+PROMO_CODE_COUNTER_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS "promocode_insert"
+    AFTER INSERT ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" + 1
+        WHERE "id" = NEW."group_id";
+        INSERT INTO "freecode" ("promo_code_id", "group_id")
+        VALUES (NEW."id", NEW."group_id");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "promocode_delete"
+    AFTER DELETE ON "promocode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "total_codes" = "total_codes" - 1
+        WHERE "id" = OLD."group_id";
+        DELETE FROM "freecode" WHERE "promo_code_id" = OLD."id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "freecode_insert"
+    AFTER INSERT ON "freecode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "available_codes" = "available_codes" + 1
+        WHERE "id" = NEW."group_id";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "freecode_delete"
+    AFTER DELETE ON "freecode"
+    BEGIN
+        UPDATE "promocodegroup"
+        SET "available_codes" = "available_codes" - 1
+        WHERE "id" = OLD."group_id";
+    END""",
+)
 
 
 class AuthorizedUser(Model):
@@ -18,6 +63,9 @@ class AuthorizedUser(Model):
 class PromoCodeGroup(Model):
     guild_id = IntegerField()
     name = CharField()
+    # maintained by PROMO_CODE_COUNTER_TRIGGERS
+    total_codes = IntegerField(default=0)
+    available_codes = IntegerField(default=0)
 
     class Meta:
         indexes = (
@@ -26,15 +74,181 @@ class PromoCodeGroup(Model):
 
 
 class PromoCode(Model):
+    """A code of a group's inventory. Rows are written once.
+
+    Whether a code is free is kept in FreeCode, and who got it, and when,
+    in Redemption."""
     group = ForeignKeyField(PromoCodeGroup,
                             backref='codes',
                             on_delete='CASCADE')
     code = CharField()
-    sent_to_name = CharField(null=True)
-    sent_to_id = IntegerField(null=True, index=True)
-    sent_at = DateTimeField(null=True)
 
     class Meta:
         indexes = (
             (('group_id', 'code'), True),
         )
+
+    @classmethod
+    def claim(cls, group, users, once_per_user=False):
+        """Claims one free code of the group for each (user_id, user_name):
+        its FreeCode row is deleted and the claim appended to Redemption.
+
+        A single query picks the free codes and, with once_per_user, skips
+        the users that already hold a code from the group (or that are
+        repeated in `users`). Run it inside a transaction: its write lock
+        keeps concurrent claims from picking the same codes.
+
+        Returns one entry per user, in order: the new Redemption, or
+        ALREADY_RECEIVED for skipped users. The list is cut short when the
+        group runs out of codes."""
+        users = list(users)
+        if not users:
+            return []
+        group_id = getattr(group, 'id', group)
+        redeemed_at = datetime.now(timezone.utc)
+        sql, params = cls._claim_sql(group_id, users, once_per_user)
+        picks = cls._meta.database.execute_sql(sql, params).fetchall()
+        results = []
+        for (user_id, user_name), (eligible, promo_code_id, code) in zip(
+                users, picks):
+            if not eligible:
+                results.append(ALREADY_RECEIVED)
+                continue
+            if promo_code_id is None:
+                break
+            results.append(Redemption(promo_code=promo_code_id,
+                                      group=group_id,
+                                      code=code,
+                                      user_id=user_id,
+                                      user_name=user_name,
+                                      redeemed_at=redeemed_at))
+        redemptions = [result for result in results
+                       if result is not ALREADY_RECEIVED]
+        if redemptions:
+            (FreeCode
+             .delete()
+             .where(FreeCode.promo_code.in_([redemption.promo_code_id
+                                             for redemption in redemptions]))
+             .execute())
+            Redemption.bulk_create(redemptions)
+        return results
+
+    @classmethod
+    def _claim_sql(cls, group_id, users, once_per_user):
+        """(eligible, promo code id, code) for each user, in order. The code
+        is NULL for skipped users and once the free codes run out."""
+        # ?1-?3 are fixed, the recipients' values are numbered after them
+        params = [once_per_user, group_id, len(users)]
+        recipients = []
+        for position, (user_id, _) in enumerate(users):
+            first = len(params) + 1
+            recipients.append(f'(?{first}, ?{first + 1})')
+            params.extend([position, user_id])
+        return f"""
+            WITH recipients(position, user_id) AS (
+                VALUES {', '.join(recipients)}
+            ),
+            eligible AS (
+                SELECT position,
+                       row_number() OVER (ORDER BY position) AS rank
+                FROM recipients
+                WHERE NOT ?1 OR (
+                    position = (SELECT min(r.position) FROM recipients r
+                                WHERE r.user_id = recipients.user_id)
+                    AND NOT EXISTS (
+                        SELECT 1 FROM redemption r
+                        WHERE r.user_id = recipients.user_id
+                        AND r.group_id = ?2
+                        AND NOT EXISTS (
+                            SELECT 1 FROM redemptionrelease x
+                            WHERE x.redemption_id = r.id)))
+            ),
+            free AS (
+                SELECT f.promo_code_id AS id, p.code,
+                       row_number() OVER (ORDER BY f.promo_code_id) AS rank
+                FROM freecode f
+                JOIN promocode p ON p.id = f.promo_code_id
+                WHERE f.group_id = ?2
+                ORDER BY f.promo_code_id
+                LIMIT ?3
+            )
+            SELECT eligible.position IS NOT NULL, free.id, free.code
+            FROM recipients
+            LEFT JOIN eligible ON eligible.position = recipients.position
+            LEFT JOIN free ON free.rank = eligible.rank
+            ORDER BY recipients.position
+        """, params
+
+
+class FreeCode(Model):
+    """The codes no one holds: PromoCode.claim deletes a code's row and
+    queries.release_codes inserts it back.
+
+    A new code gets its row from PROMO_CODE_COUNTER_TRIGGERS. The rowid is
+    the code's id, so the group index lists each group's free codes in
+    claiming (id) order without touching PromoCode."""
+    promo_code = ForeignKeyField(PromoCode,
+                                 primary_key=True,
+                                 on_delete='CASCADE')
+    group = ForeignKeyField(PromoCodeGroup, on_delete='CASCADE')
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super().create_table(safe=safe, **options)
+        # promocode's triggers write to freecode, so they come with it
+        for trigger in PROMO_CODE_COUNTER_TRIGGERS:
+            cls._meta.database.execute_sql(trigger)
+
+
+class Redemption(Model):
+    """History of the codes handed out, appended by PromoCode.claim.
+
+    Rows are never deleted or changed: a claim undone because the code
+    never reached the user gets a RedemptionRelease instead. Only deleting
+    the code or its group clears the reference to it."""
+    promo_code = ForeignKeyField(PromoCode, null=True, on_delete='SET NULL')
+    # indexed by (group_id, redeemed_at)
+    group = ForeignKeyField(PromoCodeGroup,
+                            null=True,
+                            on_delete='SET NULL',
+                            index=False)
+    code = CharField()
+    user_id = IntegerField()
+    user_name = CharField(null=True)
+    redeemed_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            # covers my_codes and the once per user check of claims
+            (('user_id', 'group_id', 'redeemed_at', 'code'), False),
+            (('group_id', 'redeemed_at'), False),
+        )
+
+
+class RedemptionRelease(Model):
+    """Marks a Redemption undone, appended by queries.release_codes."""
+    redemption = ForeignKeyField(Redemption, primary_key=True)
+    released_at = DateTimeField()
+
+
+class PendingMessage(Model):
+    """A DM waiting to be sent by delivery.DeliveryWorker.
+
+    Times are Unix timestamps."""
+    guild_id = IntegerField(null=True)
+    recipient_id = IntegerField()
+    recipient_name = CharField(null=True)
+    # who is told if the message can't be delivered
+    author_id = IntegerField(null=True)
+    promo_code = ForeignKeyField(PromoCode, null=True, on_delete='CASCADE')
+    content = TextField()
+    attempts = IntegerField(default=0)
+    created_at = FloatField()
+    next_attempt_at = FloatField()
+    last_error = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            # each guild's messages in the order they are due
+            (('guild_id', 'next_attempt_at'), False),
+        )
@@ -0,0 +1,361 @@
+"""Synchronous data access used by the bot commands.
+
+Everything here blocks on SQLite, so the commands run these functions
+through a DBExecutor instead of calling them on the event loop."""
+import csv
+from datetime import datetime, timezone
+import io
+import json
+
+from peewee import JOIN, IntegrityError, fn
+
+from model import (ALREADY_RECEIVED,
+                   AuthorizedUser,
+                   FreeCode,
+                   PendingMessage,
+                   PromoCodeGroup,
+                   PromoCode,
+                   Redemption,
+                   RedemptionRelease)
+
+
+# =======================================================
+#               AUTHORIZED USERS
+# =======================================================
+def is_authorized(guild_id, user_id):
+    user = AuthorizedUser.get_or_none(
+        (AuthorizedUser.user_id == user_id)
+        &
+        (AuthorizedUser.guild_id == guild_id)
+    )
+    return user is not None
+
+
+def add_authorized_user(guild_id, user_id):
+    """Returns False if the user was already authorized."""
+    try:
+        AuthorizedUser.create(guild_id=guild_id, user_id=user_id)
+        return True
+    except IntegrityError:
+        return False
+
+
+def remove_authorized_user(guild_id, user_id):
+    query = AuthorizedUser.delete().where(
+        (AuthorizedUser.user_id == user_id)
+        &
+        (AuthorizedUser.guild_id == guild_id)
+    )
+    return query.execute()
+
+
+def list_authorized_users(guild_ids):
+    """Returns (guild_id, user_id) pairs for every authorized user."""
+    query = (AuthorizedUser
+             .select(AuthorizedUser.guild_id, AuthorizedUser.user_id)
+             .where(AuthorizedUser.guild_id.in_(guild_ids)))
+    return list(query.tuples())
+
+
+def list_authorized_user_ids(guild_id):
+    query = (AuthorizedUser
+             .select(AuthorizedUser.user_id)
+             .where(AuthorizedUser.guild_id == guild_id))
+    return [user_id for (user_id,) in query.tuples()]
+
+
+# =======================================================
+#               PROMO CODE GROUPS
+# =======================================================
+def create_group(guild_id, name):
+    """Returns False if the group already exists."""
+    try:
+        PromoCodeGroup.create(guild_id=guild_id, name=name)
+        return True
+    except IntegrityError:
+        return False
+
+
+def delete_group(guild_id, name):
+    query = PromoCodeGroup.delete().where(
+        (PromoCodeGroup.guild_id == guild_id)
+        &
+        (PromoCodeGroup.name == name)
+    )
+    return query.execute()
+
+
+def list_groups(guild_id):
+    """Returns a {name: id} dict with every group of the guild."""
+    query = (PromoCodeGroup
+             .select(PromoCodeGroup.name, PromoCodeGroup.id)
+             .where(PromoCodeGroup.guild_id == guild_id)
+             .order_by(PromoCodeGroup.id))
+    return dict(query.tuples())
+
+
+def list_group_stats(guild_id):
+    """Returns (name, id, total_codes, available_codes) for every group of
+    the guild, reading the counters instead of counting codes."""
+    query = (PromoCodeGroup
+             .select(PromoCodeGroup.name,
+                     PromoCodeGroup.id,
+                     PromoCodeGroup.total_codes,
+                     PromoCodeGroup.available_codes)
+             .where(PromoCodeGroup.guild_id == guild_id)
+             .order_by(PromoCodeGroup.id)
+             .tuples())
+    return list(query)
+
+
+# =======================================================
+#               PROMO CODES
+# =======================================================
+def create_code(group, code):
+    """Returns False if the code is already in the group."""
+    try:
+        PromoCode.create(group=group, code=code)
+        return True
+    except IntegrityError:
+        return False
+
+
+def add_codes(group, codes):
+    """Inserts the codes that are not in the group yet. The codes must not
+    repeat.
+
+    Returns (inserted, already_existing). Run it inside a transaction."""
+    inserted = insert_new_codes(group, codes)
+    return inserted, len(codes) - inserted
+
+
+def insert_new_codes(group, codes):
+    """Inserts the codes, skipping the ones already in the group.
+
+    The codes go in as a single JSON array parameter, so one statement
+    checks all of them against the (group_id, code) index. Returns how
+    many were inserted. Run it inside a transaction."""
+    database = PromoCode._meta.database  # pylint: disable=protected-access
+    cursor = database.execute_sql(
+        'INSERT OR IGNORE INTO "promocode" ("group_id", "code") '
+        'SELECT ?, "value" FROM json_each(?)',
+        (getattr(group, 'id', group), json.dumps(list(codes))))
+    return cursor.rowcount
+
+
+def delete_code(group, code):
+    query = PromoCode.delete().where(
+        (PromoCode.code == code) & (PromoCode.group == group)
+    )
+    return query.execute()
+
+
+def _not_released():
+    return ~fn.EXISTS(RedemptionRelease
+                      .select(RedemptionRelease.redemption)
+                      .where(RedemptionRelease.redemption == Redemption.id))
+
+
+def _current_redemption():
+    """Joins a code to the redemption of whoever holds it now, if anyone."""
+    return (Redemption.promo_code == PromoCode.id) & _not_released()
+
+
+def list_codes_page(group, after=None, before=None, limit=20):
+    """Keyset pagination over the group's codes.
+
+    Returns up to limit (id, code, user_name, user_id, redeemed_at)
+    tuples in id order: the first ones with id > after, or the last ones
+    with id < before."""
+    query = (PromoCode
+             .select(PromoCode.id,
+                     PromoCode.code,
+                     Redemption.user_name,
+                     Redemption.user_id,
+                     Redemption.redeemed_at)
+             .join(Redemption, JOIN.LEFT_OUTER, on=_current_redemption())
+             .where(PromoCode.group == group))
+    if before is not None:
+        query = query.where(PromoCode.id < before).order_by(
+            PromoCode.id.desc())
+    else:
+        if after is not None:
+            query = query.where(PromoCode.id > after)
+        query = query.order_by(PromoCode.id)
+    rows = list(query.limit(limit).tuples())
+    if before is not None:
+        rows.reverse()
+    return rows
+
+
+def write_codes_csv(group, binary_file):
+    """Writes the group's codes as CSV to binary_file, streaming rows from
+    the cursor. Returns how many codes were written."""
+    text_file = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+    writer = csv.writer(text_file)
+    writer.writerow(['code', 'sent_to_id', 'sent_to_name', 'sent_at'])
+    query = (PromoCode
+             .select(PromoCode.code,
+                     Redemption.user_id,
+                     Redemption.user_name,
+                     Redemption.redeemed_at)
+             .join(Redemption, JOIN.LEFT_OUTER, on=_current_redemption())
+             .where(PromoCode.group == group)
+             .order_by(PromoCode.id)
+             .tuples())
+    count = 0
+    for code, sent_to_id, sent_to_name, sent_at in query.iterator():
+        writer.writerow([code, sent_to_id, sent_to_name, sent_at])
+        count += 1
+    text_file.flush()
+    # keep binary_file open for the caller
+    text_file.detach()
+    return count
+
+
+def codes_sent_to(user_id):
+    """Returns (code, sent_at) tuples, oldest first, from the redemption
+    index and the primary key of the releases."""
+    query = (Redemption
+             .select(Redemption.code, Redemption.redeemed_at)
+             .where((Redemption.user_id == user_id) & _not_released())
+             .order_by(Redemption.redeemed_at)
+             .tuples())
+    return list(query)
+
+
+def release_codes(promo_code_ids, now=None):
+    """Puts claimed codes back in the pool, e.g. after a failed DM: their
+    FreeCode rows are inserted back and a RedemptionRelease is appended
+    for each of their redemptions. Run it inside a transaction.
+
+    Returns how many claims were undone."""
+    now = datetime.now(timezone.utc) if now is None else now
+    redemption_ids = [redemption_id for (redemption_id,) in Redemption
+                      .select(Redemption.id)
+                      .where(Redemption.promo_code.in_(promo_code_ids)
+                             & _not_released())
+                      .tuples()]
+    if redemption_ids:
+        (RedemptionRelease
+         .insert_many([{'redemption': redemption_id, 'released_at': now}
+                       for redemption_id in redemption_ids])
+         .execute())
+    (FreeCode
+     .insert_from(PromoCode
+                  .select(PromoCode.id, PromoCode.group)
+                  .where(PromoCode.id.in_(promo_code_ids)),
+                  [FreeCode.promo_code, FreeCode.group])
+     .on_conflict_ignore()
+     .execute())
+    return len(redemption_ids)
+
+
+def claim_and_queue_codes(group,
+                          users,
+                          once_per_user,
+                          guild_id,
+                          author_id,
+                          template,
+                          now):
+    """Claims codes like PromoCode.claim, and queues a DM with each claimed
+    code (template.format(code)) to its user in the same transaction.
+
+    Run it inside a transaction."""
+    claims = PromoCode.claim(group, users, once_per_user)
+    rows = [{'guild_id': guild_id,
+             'recipient_id': redemption.user_id,
+             'recipient_name': redemption.user_name,
+             'author_id': author_id,
+             'promo_code': redemption.promo_code_id,
+             'content': template.format(redemption.code),
+             'created_at': now,
+             'next_attempt_at': now}
+            for redemption in claims if redemption is not ALREADY_RECEIVED]
+    if rows:
+        PendingMessage.insert_many(rows).execute()
+    return claims
+
+
+# =======================================================
+#               PENDING MESSAGES
+# =======================================================
+def pending_message_guilds():
+    """Returns the ids of the guilds with messages waiting."""
+    query = (PendingMessage
+             .select(PendingMessage.guild_id)
+             .distinct()
+             .tuples())
+    return [guild_id for (guild_id,) in query]
+
+
+def take_due_messages(guild_id, now, limit, lease):
+    """Returns up to `limit` of the guild's messages due by `now`, with their
+    code as `code`, and when the guild's next message is due (or None if
+    none is left).
+
+    The taken messages are pushed `lease` seconds ahead and get one more
+    attempt counted, so nobody takes them again while they are being sent,
+    and they are retried if the bot stops before they are. Their
+    next_attempt_at is the end of the lease, which renew_lease() checks.
+    Run it inside a transaction."""
+    due = PendingMessage.guild_id == guild_id
+    messages = list(PendingMessage
+                    .select(PendingMessage, PromoCode.code)
+                    .join(PromoCode, JOIN.LEFT_OUTER)
+                    .where(due & (PendingMessage.next_attempt_at <= now))
+                    .order_by(PendingMessage.next_attempt_at,
+                              PendingMessage.id)
+                    .limit(limit)
+                    .objects())
+    if messages:
+        (PendingMessage
+         .update(next_attempt_at=now + lease,
+                 attempts=PendingMessage.attempts + 1)
+         .where(PendingMessage.id.in_([message.id
+                                       for message in messages]))
+         .execute())
+        for message in messages:
+            message.next_attempt_at = now + lease
+    next_due = (PendingMessage
+                .select(fn.MIN(PendingMessage.next_attempt_at))
+                .where(due)
+                .scalar())
+    return messages, next_due
+
+
+def renew_lease(message_id, leased_until, new_lease):
+    """Pushes a taken message's lease to new_lease, unless someone else
+    took it since its lease ended at leased_until. Returns whether the
+    lease was renewed."""
+    return bool(PendingMessage
+                .update(next_attempt_at=new_lease)
+                .where((PendingMessage.id == message_id)
+                       & (PendingMessage.next_attempt_at == leased_until))
+                .execute())
+
+
+def delete_messages(message_ids):
+    """Forgets delivered messages."""
+    return (PendingMessage
+            .delete()
+            .where(PendingMessage.id.in_(message_ids))
+            .execute())
+
+
+def retry_message(message_id, next_attempt_at, error):
+    return (PendingMessage
+            .update(next_attempt_at=next_attempt_at, last_error=error)
+            .where(PendingMessage.id == message_id)
+            .execute())
+
+
+def drop_message(message_id):
+    """Gives up on a message and puts its code back in the pool. Run it
+    inside a transaction."""
+    message = PendingMessage.get_or_none(PendingMessage.id == message_id)
+    if message is None:
+        return 0
+    if message.promo_code_id is not None:
+        release_codes([message.promo_code_id])
+    return message.delete_instance()
@@ -0,0 +1,264 @@
+"""Storage that is either one SQLite file or one file per guild.
+
+Every command goes through a Storage object with the guild it belongs to.
+SingleStorage sends everything to one DBExecutor. ShardedStorage keeps a
+database file and a DBExecutor (with its own writer thread) per guild, or
+per bucket of guilds, so a bulk import in one guild never waits on the
+write lock of another."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+import os
+import threading
+import time
+
+from peewee import DatabaseProxy
+
+from constants import MODELS
+from db_executor import DBExecutor
+from migrations import MIGRATIONS, schema_version, setup_schema
+from storage import open_database
+
+
+class ShardRouter(DatabaseProxy):
+    """Database proxy that each thread points at its own database.
+
+    Models are bound to the router once; every shard executor thread calls
+    use() with its shard's database before running queries."""
+    __slots__ = ('_local',)
+
+    def __init__(self):
+        object.__setattr__(self, '_local', threading.local())
+        super().__init__()
+
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+
+    @property
+    def obj(self):
+        return getattr(self._local, 'database', None)
+
+    @obj.setter
+    def obj(self, database):
+        self._local.database = database
+
+    def use(self, database):
+        self.obj = database
+
+    def bind(self, models, bind_refs=True, bind_backrefs=True):
+        for model in models:
+            model.bind(self, bind_refs=bind_refs, bind_backrefs=bind_backrefs)
+
+
+class SingleStorage():
+    """Every guild lives in the same database."""
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    async def read(self, guild_id, function, *args, **kwargs):
+        # pylint: disable=unused-argument
+        return await self.executor.read(function, *args, **kwargs)
+
+    async def run(self, guild_id, function, *args, **kwargs):
+        # pylint: disable=unused-argument
+        return await self.executor.run(function, *args, **kwargs)
+
+    async def atomic(self, guild_id, function, *args, **kwargs):
+        # pylint: disable=unused-argument
+        return await self.executor.atomic(function, *args, **kwargs)
+
+    async def read_all(self, function, *args, **kwargs):
+        """Runs a read in every database and returns the list of results."""
+        return [await self.executor.read(function, *args, **kwargs)]
+
+    def stats(self):
+        return self.executor.stats()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class Shard():
+    def __init__(self, path, database, executor):
+        self.path = path
+        self.database = database
+        self.executor = executor
+        self.ready = None
+        self.last_used = 0.0
+
+
+class ShardedStorage():
+    """One database file per guild (or per guild_id % buckets).
+
+    Shards are opened, created and migrated the first time a guild uses
+    them. Shards unused for idle_timeout seconds have their executor shut
+    down, which closes their connections (peewee keeps them in the
+    executor threads' locals)."""
+
+    def __init__(self,
+                 directory,
+                 buckets=0,
+                 max_workers=4,
+                 idle_timeout=300.0,
+                 router=None,
+                 open_shard=open_database,
+                 clock=time.monotonic):
+        self.directory = directory
+        self.buckets = buckets
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.router = ShardRouter() if router is None else router
+        self.open_shard = open_shard
+        self.clock = clock
+        self.shards = {}
+        self._scan_pool = None
+        self._last_sweep = clock()
+        os.makedirs(directory, exist_ok=True)
+
+    def shard_name(self, guild_id):
+        if self.buckets:
+            return 'bucket-{}.sqlite'.format(guild_id % self.buckets)
+        return 'guild-{}.sqlite'.format(guild_id)
+
+    def shard_names(self):
+        """Names of every shard file on disk."""
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith(('guild-', 'bucket-'))
+                      and name.endswith('.sqlite'))
+
+    def _setup_shard(self):
+        setup_schema(self.router.obj, MODELS)
+
+    def _open(self, name):
+        database = self.open_shard(os.path.join(self.directory, name))
+        executor = DBExecutor(max_workers=self.max_workers,
+                              get_database=lambda: database,
+                              initializer=lambda: self.router.use(database))
+        shard = Shard(name, database, executor)
+        shard.ready = asyncio.ensure_future(
+            executor.run(self._setup_shard))
+        return shard
+
+    async def executor_for(self, name):
+        """Returns the DBExecutor of a shard, opening it if needed."""
+        self.close_idle()
+        shard = self.shards.get(name)
+        if shard is None:
+            shard = self.shards[name] = self._open(name)
+        try:
+            await shard.ready
+        except Exception:
+            if self.shards.get(name) is shard:
+                del self.shards[name]
+                shard.executor.shutdown()
+            raise
+        shard.last_used = self.clock()
+        return shard.executor
+
+    async def read(self, guild_id, function, *args, **kwargs):
+        executor = await self.executor_for(self.shard_name(guild_id))
+        return await executor.read(function, *args, **kwargs)
+
+    async def run(self, guild_id, function, *args, **kwargs):
+        executor = await self.executor_for(self.shard_name(guild_id))
+        return await executor.run(function, *args, **kwargs)
+
+    async def atomic(self, guild_id, function, *args, **kwargs):
+        executor = await self.executor_for(self.shard_name(guild_id))
+        return await executor.atomic(function, *args, **kwargs)
+
+    async def read_all(self, function, *args, **kwargs):
+        """Runs a read in every shard on disk and returns the list of
+        results.
+
+        Open shards read on their own executors. The others are read one
+        after the other by a single thread, each through a read-only
+        connection closed right after, so reading every guild doesn't
+        open an executor per shard file."""
+        names = self.shard_names()
+        results = {}
+
+        async def read_shard(name):
+            executor = await self.executor_for(name)
+            results[name] = await executor.read(function, *args, **kwargs)
+        if self._scan_pool is None:
+            self._scan_pool = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='shard-scan')
+        scan = asyncio.get_event_loop().run_in_executor(
+            self._scan_pool,
+            self._scan,
+            [name for name in names if name not in self.shards],
+            partial(function, *args, **kwargs))
+        await asyncio.gather(*[read_shard(name)
+                               for name in names if name in self.shards])
+        scanned, outdated = await scan
+        results.update(scanned)
+        # shards from before the latest migration are opened (and
+        # migrated) the usual way
+        await asyncio.gather(*[read_shard(name) for name in outdated])
+        return [results[name] for name in names]
+
+    def _scan(self, names, read):
+        results = {}
+        outdated = []
+        for name in names:
+            database = self.open_shard(os.path.join(self.directory, name))
+            if hasattr(database, 'mark_read_only'):
+                database.mark_read_only()
+            self.router.use(database)
+            try:
+                with database.connection_context():
+                    if schema_version(database) < len(MIGRATIONS):
+                        outdated.append(name)
+                    else:
+                        results[name] = read()
+            finally:
+                self.router.use(None)
+        return results, outdated
+
+    def close_idle(self):
+        """Shuts down the shards nobody used in the last idle_timeout
+        seconds. Runs at most once every idle_timeout / 2 seconds."""
+        now = self.clock()
+        if now - self._last_sweep < self.idle_timeout / 2:
+            return
+        self._last_sweep = now
+        for name, shard in list(self.shards.items()):
+            stats = shard.executor.stats()
+            if (shard.ready.done()
+                    and now - shard.last_used >= self.idle_timeout
+                    and not stats['queue_depth']
+                    and not stats['running']):
+                del self.shards[name]
+                shard.executor.shutdown()
+
+    def stats(self):
+        shard_stats = [shard.executor.stats()
+                       for shard in self.shards.values()]
+        queries = {}
+        for name, stats in chain.from_iterable(
+                stats['queries'].items() for stats in shard_stats):
+            totals = queries.setdefault(
+                name,
+                {'count': 0, 'total_time': 0.0, 'max_time': 0.0})
+            totals['count'] += stats['count']
+            totals['total_time'] += stats['total_time']
+            totals['max_time'] = max(totals['max_time'], stats['max_time'])
+        for totals in queries.values():
+            totals['avg_time'] = totals['total_time'] / totals['count']
+        return {
+            'open_shards': len(shard_stats),
+            'queue_depth': sum(stats['queue_depth'] for stats in shard_stats),
+            'running': sum(stats['running'] for stats in shard_stats),
+            'queries': queries,
+        }
+
+    def shutdown(self):
+        for shard in self.shards.values():
+            shard.executor.shutdown()
+        self.shards = {}
+        if self._scan_pool is not None:
+            self._scan_pool.shutdown()
+            self._scan_pool = None
@@ -0,0 +1,100 @@
+"""SQLite storage configuration.
+
+The database runs in WAL mode so readers never block the writer. Commands
+that only read run on read-only connections, and every write goes through
+a single connection (see DBExecutor). Transactions take the write lock when
+they begin, so writers in other processes wait on busy_timeout instead of
+failing when a read turns into a write."""
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+from peewee import SENTINEL, SqliteDatabase
+
+# pragma name -> (environment variable, default)
+PRAGMA_SETTINGS = {
+    'journal_mode': ('SQLITE_JOURNAL_MODE', 'wal'),
+    'synchronous': ('SQLITE_SYNCHRONOUS', 'normal'),
+    'cache_size': ('SQLITE_CACHE_SIZE', '-65536'),  # in KiB: 64 MiB
+    'mmap_size': ('SQLITE_MMAP_SIZE', '268435456'),  # 256 MiB
+    'busy_timeout': ('SQLITE_BUSY_TIMEOUT', '5000'),  # in ms
+    'foreign_keys': ('SQLITE_FOREIGN_KEYS', '1'),
+}
+
+# these change the database file, which read-only connections can't do
+WRITER_ONLY_PRAGMAS = ('journal_mode',)
+
+# called with (sql, seconds) after every statement, in the thread that ran it
+QUERY_HOOKS = []
+
+
+def pragmas_from_env(environ=None):
+    environ = os.environ if environ is None else environ
+    return {pragma: environ.get(variable, default)
+            for pragma, (variable, default) in PRAGMA_SETTINGS.items()}
+
+
+class SplitSqliteDatabase(SqliteDatabase):
+    """SqliteDatabase whose connections are read-only in the threads that
+    called mark_read_only().
+
+    peewee keeps one connection per thread, so a pool of reader threads
+    and a single writer thread share this object while each uses the right
+    kind of connection."""
+
+    def __init__(self, database, *args, **kwargs):
+        self._local_mode = threading.local()
+        super().__init__(database, *args, **kwargs)
+
+    def mark_read_only(self):
+        self._local_mode.read_only = True
+
+    def is_read_only(self):
+        return getattr(self._local_mode, 'read_only', False)
+
+    def execute_sql(self, sql, params=None, commit=SENTINEL):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            elapsed = time.perf_counter() - start
+            for hook in QUERY_HOOKS:
+                hook(sql, elapsed)
+
+    def begin(self, lock_type=None):
+        if lock_type is None and not self.is_read_only():
+            lock_type = 'IMMEDIATE'
+        super().begin(lock_type)
+
+    def _connect(self):
+        if not self.is_read_only() or self.database == ':memory:':
+            return super()._connect()
+        conn = sqlite3.connect(
+            'file:{}?mode=ro'.format(quote(os.path.abspath(self.database))),
+            uri=True,
+            timeout=self._timeout,
+            isolation_level=None,
+            **self.connect_params)
+        try:
+            self._add_conn_hooks(conn)
+        except:  # noqa E722
+            conn.close()
+            raise
+        return conn
+
+    def _set_pragmas(self, conn):
+        if not self.is_read_only():
+            super()._set_pragmas(conn)
+            return
+        cursor = conn.cursor()
+        for pragma, value in self._pragmas:
+            if pragma not in WRITER_ONLY_PRAGMAS:
+                cursor.execute('PRAGMA %s = %s;' % (pragma, value))
+        cursor.close()
+
+
+def open_database(path, pragmas=None):
+    pragmas = pragmas_from_env() if pragmas is None else pragmas
+    return SplitSqliteDatabase(path, pragmas=pragmas)
@@ -0,0 +1,93 @@
+import unittest
+
+from benchmarks import bulk
+from benchmarks.commands import (benchmark,
+                                 calibrate,
+                                 compare,
+                                 percentile,
+                                 rescale)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_percentile(self):
+        samples = list(range(1, 101))
+
+        self.assertEqual(percentile(samples, 0.5), 50)
+        self.assertEqual(percentile(samples, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+
+    def test_compare_flags_regressions(self):
+        result = {'ops_per_second': 10, 'p50_ms': 3.0, 'p95_ms': 4.0,
+                  'p99_ms': 5.0, 'max_ms': 6.0}
+
+        baseline = {'calibration_ms': 50.0,
+                    'commands': {'send_code@10': {'p50_ms': 2.0}}}
+
+        lines, regressed = compare({'send_code@10': result}, baseline,
+                                   max_regression=1.25, calibration_ms=50.0)
+
+        self.assertTrue(regressed)
+        self.assertIn('1.50x baseline (REGRESSION)', lines[0])
+        _, regressed = compare({'send_code@10': result}, {}, 1.25, 50.0)
+        self.assertFalse(regressed)
+
+    def test_compare_scales_by_calibration(self):
+        result = {'ops_per_second': 10, 'p50_ms': 3.0, 'p95_ms': 4.0,
+                  'p99_ms': 5.0, 'max_ms': 6.0}
+        baseline = {'calibration_ms': 50.0,
+                    'commands': {'send_code@10': {'p50_ms': 2.0}}}
+
+        # this machine runs the calibration twice as slow
+        lines, regressed = compare({'send_code@10': result}, baseline,
+                                   max_regression=1.25, calibration_ms=100.0)
+
+        self.assertFalse(regressed)
+        self.assertIn('0.75x baseline', lines[0])
+
+    def test_rescale(self):
+        summary = {'ops_per_second': 100.0, 'p50_ms': 2.0, 'max_ms': 4.0}
+
+        self.assertEqual(rescale(summary, 2),
+                         {'ops_per_second': 50.0, 'p50_ms': 4.0,
+                          'max_ms': 8.0})
+
+    def test_compare_ignores_small_deltas(self):
+        result = {'ops_per_second': 1000, 'p50_ms': 0.6, 'p95_ms': 0.7,
+                  'p99_ms': 0.8, 'max_ms': 0.9}
+        baseline = {'calibration_ms': 50.0,
+                    'commands': {'list_code@10': {'p50_ms': 0.4}}}
+
+        lines, regressed = compare({'list_code@10': result}, baseline,
+                                   max_regression=1.25, calibration_ms=50.0,
+                                   min_delta_ms=0.5)
+
+        self.assertFalse(regressed)
+        self.assertIn('1.50x baseline', lines[0])
+        _, regressed = compare({'list_code@10': result}, baseline, 1.25,
+                               50.0, min_delta_ms=0.1)
+        self.assertTrue(regressed)
+
+    def test_calibrate(self):
+        self.assertGreater(calibrate(repeats=1), 0)
+
+    def test_every_command_runs_against_seeded_data(self):
+        results = benchmark(size=30, iterations=3)
+
+        self.assertEqual(sorted(results),
+                         ['add_code_bulk', 'list_code', 'my_codes',
+                          'send_code'])
+        for summary in results.values():
+            self.assertGreater(summary['ops_per_second'], 0)
+            self.assertLessEqual(summary['p50_ms'], summary['max_ms'])
+
+    def test_keeps_the_best_round(self):
+        results = benchmark(size=30, iterations=3, commands=['send_code'],
+                            rounds=2, calibration_ms=50.0)
+
+        self.assertEqual(sorted(results), ['send_code'])
+
+    def test_bulk_checks_the_whole_payload(self):
+        parse, check = bulk.benchmark(size=30, repeats=1)
+
+        self.assertGreater(parse, 0)
+        self.assertGreater(check, 0)
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+import main
+from migrations import MIGRATIONS, schema_version
+
+
+class TestBootstrap(unittest.TestCase):
+    def test_importing_main_does_not_open_the_database(self):
+        self.assertIsNone(main.db)
+
+    def test_bootstrap_creates_and_migrates_the_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bot.sqlite')
+            with mock.patch('main.DATABASE_PATH', path), \
+                    mock.patch('main.SENTRY_URL', None):
+                timings = main.bootstrap()
+            try:
+                self.assertEqual(list(timings), ['database'])
+                self.assertTrue(os.path.exists(path))
+                self.assertEqual(schema_version(main.db), len(MIGRATIONS))
+            finally:
+                main.db.close()
+                main.db = None
+
+    def test_metrics_port_in_use_does_not_stop_delivery(self):
+        async def run_delivery():
+            pass
+
+        async def warm(guild_ids):  # pylint: disable=unused-argument
+            pass
+        with socket.socket() as taken:
+            taken.bind(('127.0.0.1', 0))
+            taken.listen()
+            port = taken.getsockname()[1]
+            with mock.patch('main.METRICS_PORT', port), \
+                    mock.patch('main.delivery.run', run_delivery), \
+                    mock.patch('main.warm_authorization_cache', warm):
+                try:
+                    asyncio.run(main.on_ready())
+                    self.assertIsNotNone(main.delivery_task)
+                    self.assertIsNone(main.metrics_runner)
+                finally:
+                    main.delivery_task = None
@@ -0,0 +1,87 @@
+import unittest
+
+from cache import LRUCache, TTLCache, clear_caches
+
+from .utils import FakeClock
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_counts_hits_and_misses(self):
+        cache = TTLCache()
+        self.assertIsNone(cache.get('foo'))
+        cache.set('foo', False)
+        self.assertFalse(cache.get('foo'))
+
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1})
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = TTLCache(ttl=10, clock=clock)
+        cache.set('foo', True)
+        clock.now = 9
+        self.assertTrue(cache.get('foo'))
+        clock.now = 10
+        self.assertIsNone(cache.get('foo'))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_and_clear(self):
+        cache = TTLCache()
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.invalidate('foo')
+        self.assertNotIn('foo', cache)
+        self.assertIn('bar', cache)
+        clear_caches()
+        self.assertNotIn('bar', cache)
+
+    def test_sweeps_expired_entries(self):
+        clock = FakeClock()
+        cache = TTLCache(ttl=10, clock=clock)
+        cache.set('foo', 1)
+        clock.now = 5
+        cache.set('bar', 2)
+        clock.now = 11
+        cache.set('spam', 3)
+
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_max_size_drops_oldest_entries(self):
+        cache = TTLCache(max_size=2)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.set('foo', 3)
+        cache.set('spam', 4)
+
+        self.assertNotIn('bar', cache)
+        self.assertEqual(cache.get('foo'), 3)
+        self.assertIn('spam', cache)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.get('foo')
+        cache.set('spam', 3)
+
+        self.assertIn('foo', cache)
+        self.assertNotIn('bar', cache)
+        self.assertIn('spam', cache)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 0})
+
+    def test_fill_is_dropped_after_a_concurrent_write(self):
+        for cache in (TTLCache(), LRUCache()):
+            version = cache.version()
+            cache.set('foo', False)
+            self.assertFalse(cache.fill('foo', True, version))
+            self.assertFalse(cache.get('foo'))
+
+            version = cache.version()
+            cache.invalidate('bar')
+            self.assertFalse(cache.fill('foo', True, version))
+
+            version = cache.version()
+            self.assertTrue(cache.fill('foo', True, version))
+            self.assertTrue(cache.fill('spam', True, version))
+            self.assertTrue(cache.get('foo'))
@@ -1,11 +1,20 @@
 import asyncio
+from unittest import mock
 
-from main import is_authorized_or_owner
+from main import (is_authorized_or_owner,
+                  add_user,
+                  remove_user,
+                  authorization_cache,
+                  gauges,
+                  get_groups,
+                  warm_authorization_cache)
 from model import AuthorizedUser
 
 from .utils import (DBTestCase,
                     FakeGuild2,
                     FakeContext,
+                    FakeUser,
+                    RacingStorage,
                     returns_true,
                     returns_false)
 
@@ -37,3 +46,77 @@ class TestIsAuthorizedOrOwner(DBTestCase):
         result = asyncio.run(is_authorized_or_owner(ctx,
                                                     is_owner=returns_false))
         self.assertFalse(result)
+
+
+class TestAuthorizationCache(DBTestCase):
+    def test_read_racing_a_removal_is_not_cached(self):
+        ctx = FakeContext()
+        AuthorizedUser.create(guild_id=ctx.guild.id, user_id=ctx.author.id)
+        key = (ctx.guild.id, ctx.author.id)
+
+        async def remove():
+            authorization_cache.set(key, False)
+        with mock.patch('main.storage', RacingStorage(remove)):
+            asyncio.run(is_authorized_or_owner(ctx, is_owner=returns_false))
+
+        self.assertIs(authorization_cache.get(key), False)
+
+    def test_result_is_cached_after_first_use(self):
+        ctx = FakeContext()
+        AuthorizedUser.create(guild_id=ctx.guild.id, user_id=ctx.author.id)
+        asyncio.run(is_authorized_or_owner(ctx, is_owner=returns_false))
+        AuthorizedUser.delete().execute()  # noqa E501 pylint: disable=no-value-for-parameter
+        hits = authorization_cache.hits
+        result = asyncio.run(is_authorized_or_owner(ctx,
+                                                    is_owner=returns_false))
+        self.assertTrue(result)
+        self.assertEqual(authorization_cache.hits, hits + 1)
+
+    def test_add_and_remove_user_update_the_cache(self):
+        ctx = FakeContext()
+        user = FakeUser()
+        asyncio.run(is_authorized_or_owner(ctx, is_owner=returns_false))
+
+        asyncio.run(add_user(ctx, user=user))
+        result = asyncio.run(is_authorized_or_owner(ctx,
+                                                    is_owner=returns_false))
+        self.assertTrue(result)
+
+        asyncio.run(remove_user(ctx, user=user))
+        result = asyncio.run(is_authorized_or_owner(ctx,
+                                                    is_owner=returns_false))
+        self.assertFalse(result)
+
+    def test_warm_up_only_loads_given_guilds(self):
+        ctx = FakeContext()
+        guild2 = FakeGuild2()
+        AuthorizedUser.create(guild_id=ctx.guild.id, user_id=ctx.author.id)
+        AuthorizedUser.create(guild_id=guild2.id, user_id=ctx.author.id)
+        asyncio.run(warm_authorization_cache([ctx.guild.id]))
+
+        self.assertIn((ctx.guild.id, ctx.author.id), authorization_cache)
+        self.assertNotIn((guild2.id, ctx.author.id), authorization_cache)
+
+
+class TestCacheGauges(DBTestCase):
+    def test_cache_hits_and_misses_are_reported(self):
+        ctx = FakeContext()
+        before = gauges()
+
+        async def twice():
+            for _ in range(2):
+                await is_authorized_or_owner(ctx, is_owner=returns_false)
+                await get_groups(ctx.guild.id)
+        asyncio.run(twice())
+        after = gauges()
+
+        self.assertEqual(
+            {name: after[name] - before[name]
+             for name in ('authorization_cache_hits',
+                          'authorization_cache_misses',
+                          'group_cache_hits',
+                          'group_cache_misses')},
+            {'authorization_cache_hits': 1,
+             'authorization_cache_misses': 1,
+             'group_cache_hits': 1,
+             'group_cache_misses': 1})
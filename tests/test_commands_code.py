@@ -4,18 +4,27 @@ import logging
 
 from main import (add_code,
                   add_code_bulk,
+                  export_codes,
+                  import_codes,
                   remove_code,
                   list_code,
                   send_code,
                   my_codes)
-from model import PromoCodeGroup, PromoCode
+from model import PendingMessage, PromoCodeGroup, PromoCode, Redemption
 from constants import DATETIME_FORMAT, LOCAL_TIMEZONE
+from viewer import NEXT_PAGE
 
 from .utils import (DBTestCase,
+                    FakeAttachment,
                     FakeContext,
+                    FakeMessage,
                     FakeGuild2,
                     FakeUser,
                     FakeUser2,
+                    create_sent_code,
+                    deliver_pending,
+                    fake_read_attachment,
+                    is_free,
                     returns_false,
                     returns_true)
 
@@ -101,6 +110,25 @@ class TestAddCodeBulk(DBTestCase):
         for (promo_code, resulting_code) in zip(promo_codes, resulting_codes):
             self.assertEqual(promo_code.code, resulting_code)
 
+    def test_reports_skipped_codes(self):
+        ctx = FakeContext()
+        group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        PromoCode.create(group=group, code='ASDF-1234')
+        asyncio.run(add_code_bulk(
+            ctx,
+            group_name='foo',
+            code_bulk='ASDF-1234 QWER-5678 QWER-5678 BAD_CODE ZXCV-9012'
+        ))
+
+        self.assertEqual(
+            ctx.send_parameters,
+            "Códigos adicionados ao grupo foo\n"
+            "1 código(s) já cadastrado(s) ignorado(s)\n"
+            "1 código(s) repetido(s) ignorado(s)\n"
+            "Códigos inválidos ignorados: BAD_CODE"
+        )
+        self.assertEqual(PromoCode.select().count(), 3)
+
     def test_group_does_not_exist_in_this_guild(self):
         ctx = FakeContext()
         guild2 = FakeGuild2()
@@ -114,6 +142,50 @@ class TestAddCodeBulk(DBTestCase):
                          "Grupo de códigos promocionais não encontrado: foo")
 
 
+class TestImportCodes(DBTestCase):
+    def test_group_does_not_exist(self):
+        ctx = FakeContext()
+        asyncio.run(import_codes(ctx,
+                                 group_name='foo',
+                                 read_attachment=fake_read_attachment))
+
+        self.assertEqual(ctx.send_parameters,
+                         "Grupo de códigos promocionais não encontrado: foo")
+
+    def test_no_attachment(self):
+        ctx = FakeContext()
+        PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        asyncio.run(import_codes(ctx,
+                                 group_name='foo',
+                                 read_attachment=fake_read_attachment))
+
+        self.assertEqual(ctx.send_parameters,
+                         "Anexe um arquivo de texto ou CSV com os códigos")
+
+    def test_imports_counting_duplicates_and_invalid_codes(self):
+        attachments = [
+            FakeAttachment(b'ASDF-1234\nQWER-5678\nASDF-1234\n'),
+            FakeAttachment(b'ZXCV-9012,BAD_CODE,\r\nPOIU-0987',
+                           filename='codes.csv'),
+        ]
+        ctx = FakeContext(message=FakeMessage(attachments))
+        group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        PromoCode.create(group=group, code='POIU-0987')
+        asyncio.run(import_codes(ctx,
+                                 group_name='foo',
+                                 read_attachment=fake_read_attachment))
+
+        self.assertRegex(
+            ctx.send_parameters,
+            r"^Importação para o grupo foo: 3 adicionados, 2 duplicados, "
+            r"1 inválidos \(\d+ códigos/s\)$"
+        )
+        self.assertEqual(
+            sorted(promo_code.code for promo_code in PromoCode.select()),
+            ['ASDF-1234', 'POIU-0987', 'QWER-5678', 'ZXCV-9012']
+        )
+
+
 class TestRemoveCode(DBTestCase):
     def test_code_group_does_not_exist(self):
         ctx = FakeContext()
@@ -194,13 +266,7 @@ class TestListCode(DBTestCase):
         user = FakeUser()
         group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
         sent_at = datetime.now()
-        promo_code = PromoCode.create(
-            group=group,
-            code='ASDF-1234',
-            sent_to_name=user.name,
-            sent_to_id=user.id,
-            sent_at=sent_at
-        )
+        promo_code = create_sent_code(group, 'ASDF-1234', user, sent_at)
         asyncio.run(list_code(ctx, group_name='foo'))
 
         self.assertTrue(ctx.author.send_called)
@@ -213,6 +279,60 @@ class TestListCode(DBTestCase):
             )
         )
 
+    def test_group_has_many_pages_of_codes(self):
+        ctx = FakeContext()
+        group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        for i in range(45):
+            PromoCode.create(group=group, code='CODE-{:02}'.format(i))
+        turns = [NEXT_PAGE, NEXT_PAGE]
+        messages = []
+
+        async def wait_for_page_turn(message):
+            messages.append(message)
+            if not turns:
+                raise asyncio.TimeoutError()
+            return turns.pop(0)
+        asyncio.run(list_code(ctx,
+                              group_name='foo',
+                              wait_for_page_turn=wait_for_page_turn))
+
+        self.assertEqual(ctx.author.send_parameters.count('\n- '), 20)
+        self.assertEqual(
+            messages[-1].content,
+            "Códigos para o grupo foo: \n- CODE-40\n- CODE-41\n- CODE-42"
+            "\n- CODE-43\n- CODE-44\n\nPágina 3"
+        )
+
+
+class TestExportCodes(DBTestCase):
+    def test_group_does_not_exist(self):
+        ctx = FakeContext()
+        asyncio.run(export_codes(ctx, group_name='foo'))
+
+        self.assertEqual(ctx.send_parameters, "Grupo foo não existe")
+
+    def test_exports_csv(self):
+        ctx = FakeContext()
+        user = FakeUser()
+        group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        PromoCode.create(group=group, code='ASDF-1234')
+        create_sent_code(group, 'QWER-5678', user,
+                         datetime(2020, 5, 25, 22, 3, 15))
+        contents = []
+
+        async def send(params, file=None):
+            contents.append((params, file.filename, file.fp.read()))
+        ctx.author.send = send
+        asyncio.run(export_codes(ctx, group_name='foo'))
+
+        self.assertEqual(contents, [(
+            "Códigos do grupo foo (2 códigos)",
+            'foo.csv',
+            b'code,sent_to_id,sent_to_name,sent_at\r\n'
+            b'ASDF-1234,,,\r\n'
+            b'QWER-5678,123,foo,2020-05-25 22:03:15\r\n'
+        )])
+
 
 class TestSendCode(DBTestCase):
     def test_group_does_not_exist(self):
@@ -237,7 +357,7 @@ class TestSendCode(DBTestCase):
         ctx = FakeContext()
         user = FakeUser()
         group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
-        PromoCode.create(group=group, code='ASDF-1234', sent_to_id=user.id)
+        create_sent_code(group, 'ASDF-1234', user)
         asyncio.run(send_code(ctx,
                               group_name='foo',
                               users=[user],
@@ -254,7 +374,7 @@ class TestSendCode(DBTestCase):
         ctx = FakeContext()
         user = FakeUser()
         group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
-        PromoCode.create(group=group, code='ASDF-1234', sent_to_id=user.id)
+        create_sent_code(group, 'ASDF-1234', user)
         promo_code = PromoCode.create(group=group, code='QWER-5678')
         asyncio.run(send_code(ctx,
                               group_name='foo',
@@ -264,9 +384,12 @@ class TestSendCode(DBTestCase):
         self.assertTrue(ctx.author.send_called)
         self.assertEqual(
             ctx.author.send_parameters,
-            "Código {} enviado para o usuário {}".format(promo_code.code,
-                                                         user.name)
+            "Código {} será enviado para o usuário {}".format(
+                promo_code.code, user.name)
         )
+        self.assertFalse(user.send_called)
+
+        deliver_pending(user)
 
         self.assertTrue(user.send_called)
         self.assertEqual(
@@ -287,9 +410,12 @@ class TestSendCode(DBTestCase):
         self.assertTrue(ctx.author.send_called)
         self.assertEqual(
             ctx.author.send_parameters,
-            "Código {} enviado para o usuário {}".format(promo_code.code,
-                                                         user.name)
+            "Código {} será enviado para o usuário {}".format(
+                promo_code.code, user.name)
         )
+        self.assertFalse(user.send_called)
+
+        deliver_pending(user)
 
         self.assertTrue(user.send_called)
         self.assertEqual(
@@ -297,21 +423,44 @@ class TestSendCode(DBTestCase):
             "Olá! Você ganhou um código: {}".format(promo_code.code)
         )
 
-        saved_promo_code = PromoCode.get(group=group, code=promo_code.code)
+        redemption = Redemption.get(code=promo_code.code)
+
+        self.assertEqual(redemption.user_name, user.name)
+        self.assertEqual(redemption.user_id, user.id)
+        self.assertIsNotNone(redemption.redeemed_at)
+        self.assertFalse(is_free(promo_code))
+
+    def test_codes_are_queued_with_the_claim(self):
+        ctx = FakeContext()
+        user = FakeUser()
+        user2 = FakeUser2()
+        group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        PromoCode.create(group=group, code='ASDF-1234')
+        PromoCode.create(group=group, code='QWER-5678')
+        asyncio.run(send_code(ctx,
+                              group_name='foo',
+                              users=[user, user2],
+                              is_authorized_or_owner=returns_false))
 
-        self.assertEqual(saved_promo_code.sent_to_name, user.name)
-        self.assertEqual(saved_promo_code.sent_to_id, user.id)
-        self.assertIsNotNone(saved_promo_code.sent_at)
+        self.assertEqual(
+            ctx.send_parameters,
+            "Código do grupo foo será enviado para o usuário foo\n"
+            "Código do grupo foo será enviado para o usuário eggs"
+        )
+        queued = PendingMessage.select().order_by(PendingMessage.id)
+        self.assertEqual(
+            [(message.recipient_id, message.author_id, message.content)
+             for message in queued],
+            [(user.id, ctx.author.id, "Olá! Você ganhou um código: ASDF-1234"),
+             (user2.id, ctx.author.id,
+              "Olá! Você ganhou um código: QWER-5678")])
 
     def test_group_doesnt_have_codes_available(self):
         ctx = FakeContext()
         user = FakeUser()
         user2 = FakeUser2()
         group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
-        PromoCode.create(group=group,
-                         code='ASDF-1234',
-                         sent_to_name=user.name,
-                         sent_to_id=user.id)
+        create_sent_code(group, 'ASDF-1234', user)
         asyncio.run(send_code(ctx,
                               group_name='foo',
                               users=[user2],
@@ -339,13 +488,7 @@ class TestMyCodes(DBTestCase):
         author = ctx.author
         sent_at = datetime.now()
         group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
-        promo_code = PromoCode.create(
-            group=group,
-            code='ASDF-1234',
-            sent_to_id=author.id,
-            sent_to_name=author.name,
-            sent_at=sent_at
-        )
+        promo_code = create_sent_code(group, 'ASDF-1234', author, sent_at)
         asyncio.run(my_codes(ctx))
 
         self.assertTrue(ctx.author.send_called)
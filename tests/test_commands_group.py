@@ -1,10 +1,16 @@
 import asyncio
 import logging
-
-from main import add_group, remove_group, list_group
+from unittest import mock
+
+from main import (add_group,
+                  remove_group,
+                  list_group,
+                  group_stats,
+                  get_groups,
+                  group_cache)
 from model import PromoCodeGroup, PromoCode
 
-from .utils import DBTestCase, FakeGuild2, FakeContext
+from .utils import DBTestCase, FakeGuild2, FakeContext, RacingStorage
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -114,5 +120,74 @@ class TestListUser(DBTestCase):
         self.assertTrue(ctx.send_called)
         self.assertEqual(
             ctx.send_parameters,
-            "Estes são os grupos de código promocional existentes: \n- foo"
+            "Estes são os grupos de código promocional existentes: "
+            "\n- foo (0 de 0 códigos disponíveis)"
+        )
+
+
+class TestGroupCache(DBTestCase):
+    def test_list_group_refreshes_cache(self):
+        ctx = FakeContext()
+        group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        asyncio.run(list_group(ctx))
+
+        self.assertEqual(group_cache.get(ctx.guild.id), {'foo': group.id})
+
+    def test_read_racing_a_group_change_is_not_cached(self):
+        ctx = FakeContext()
+
+        async def add():
+            group_cache.invalidate(ctx.guild.id)
+        with mock.patch('main.storage', RacingStorage(add)):
+            asyncio.run(list_group(ctx))
+            asyncio.run(get_groups(ctx.guild.id))
+
+        self.assertNotIn(ctx.guild.id, group_cache)
+
+    def test_add_and_remove_group_invalidate_cache(self):
+        ctx = FakeContext()
+        asyncio.run(list_group(ctx))
+        asyncio.run(add_group(ctx, group_name='foo'))
+        asyncio.run(list_group(ctx))
+
+        self.assertEqual(
+            ctx.send_parameters,
+            "Estes são os grupos de código promocional existentes: "
+            "\n- foo (0 de 0 códigos disponíveis)"
+        )
+
+        asyncio.run(remove_group(ctx, group_name='foo'))
+        asyncio.run(list_group(ctx))
+
+        self.assertEqual(ctx.send_parameters,
+                         "Não há grupos de código promocional cadastrados")
+
+
+class TestGroupStats(DBTestCase):
+    def test_group_does_not_exist(self):
+        ctx = FakeContext()
+        asyncio.run(group_stats(ctx, group_name='foo'))
+
+        self.assertEqual(ctx.send_parameters, "Grupo foo não existe")
+
+    def test_counts_follow_codes(self):
+        ctx = FakeContext()
+        group = PromoCodeGroup.create(guild_id=ctx.guild.id, name='foo')
+        PromoCodeGroup.create(guild_id=ctx.guild.id, name='bar')
+        PromoCode.insert_many([{'group': group, 'code': code}
+                               for code in ['A', 'B', 'C', 'D']]).execute()
+        PromoCode.claim(group, [(1, 'spam'), (2, 'eggs')])
+        PromoCode.delete().where(PromoCode.code == 'A').execute()
+        asyncio.run(group_stats(ctx))
+
+        self.assertEqual(ctx.send_parameters,
+                         "foo: 3 códigos, 2 disponíveis, 1 enviados\n"
+                         "bar: 0 códigos, 0 disponíveis, 0 enviados")
+
+        asyncio.run(list_group(ctx))
+        self.assertEqual(
+            ctx.send_parameters,
+            "Estes são os grupos de código promocional existentes: "
+            "\n- foo (2 de 3 códigos disponíveis)"
+            "\n- bar (0 de 0 códigos disponíveis)"
         )
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from peewee import SqliteDatabase
+
+from constants import MODELS
+from db_executor import DBExecutor
+from model import PromoCodeGroup
+
+from .utils import DBTestCase
+
+
+def current_thread_name():
+    return threading.current_thread().name
+
+
+def create_group_and_fail(name):
+    PromoCodeGroup.create(guild_id=1, name=name)
+    raise ValueError(name)
+
+
+class TestDBExecutorInMemory(DBTestCase):
+    def test_runs_inline_for_in_memory_database(self):
+        db_executor = DBExecutor()
+        result = asyncio.run(db_executor.run(current_thread_name))
+
+        self.assertEqual(result, threading.current_thread().name)
+        self.assertEqual(db_executor.stats()['queue_depth'], 0)
+        self.assertEqual(
+            db_executor.stats()['queries']['current_thread_name']['count'],
+            1
+        )
+
+    def test_atomic_rolls_back_on_error(self):
+        db_executor = DBExecutor()
+        with self.assertRaises(ValueError):
+            asyncio.run(db_executor.atomic(create_group_and_fail, 'foo'))
+
+        self.assertEqual(PromoCodeGroup.select().count(), 0)
+
+
+class TestDBExecutorOnDisk(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.test_db = SqliteDatabase(self.path,
+                                      pragmas={'foreign_keys': 1})
+        self.test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+        self.test_db.create_tables(MODELS)
+        self.db_executor = DBExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.db_executor.shutdown()
+        self.test_db.close()
+        os.remove(self.path)
+
+    def test_runs_on_worker_thread(self):
+        result = asyncio.run(self.db_executor.run(current_thread_name))
+
+        self.assertTrue(result.startswith('db'))
+
+    def test_worker_sees_committed_data(self):
+        async def scenario():
+            await self.db_executor.atomic(PromoCodeGroup.create,
+                                          guild_id=1,
+                                          name='foo')
+            return await self.db_executor.run(PromoCodeGroup.get_or_none,
+                                              PromoCodeGroup.name == 'foo')
+
+        group = asyncio.run(scenario())
+
+        self.assertEqual(group.name, 'foo')
+        stats = self.db_executor.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['running'], 0)
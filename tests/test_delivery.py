@@ -0,0 +1,222 @@
+import asyncio
+
+from db_executor import DBExecutor
+from delivery import DeliveryWorker
+from model import PendingMessage, PromoCode, PromoCodeGroup
+import queries
+from sharding import SingleStorage
+
+from .utils import (DBTestCase,
+                    FakeClock,
+                    FakeGuild,
+                    FakeGuild2,
+                    FakeUser,
+                    FakeUser2,
+                    deliver_pending,
+                    is_free)
+
+
+class ClosedDMUser(FakeUser):
+    async def send(self, params, file=None):
+        raise RuntimeError("DMs fechadas")
+
+
+class TestDeliveryWorker(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock(1000.0)
+        self.outcomes = []
+        self.failures = []
+        group = PromoCodeGroup.create(guild_id=FakeGuild.id, name='foo')
+        PromoCode.create(group=group, code='ASDF-1234')
+        self.claims = queries.claim_and_queue_codes(
+            group, [(FakeUser.id, FakeUser.name)], False, FakeGuild.id,
+            321, "Código: {}", self.clock())
+
+    def queue_codes(self, guild_id, users):
+        group, _ = PromoCodeGroup.get_or_create(guild_id=guild_id,
+                                                name='foo')
+        for user in users:
+            PromoCode.create(group=group,
+                             code='CODE-{}-{}'.format(guild_id, user.id))
+        queries.claim_and_queue_codes(
+            group, [(user.id, 'spam') for user in users], False, guild_id,
+            321, "Código: {}", self.clock())
+
+    def deliver(self, *users, **kwargs):
+        async def on_failure(message, error):
+            self.failures.append((message.code, str(error)))
+        return deliver_pending(
+            *users,
+            clock=self.clock,
+            on_failure=on_failure,
+            observe_delivery=lambda outcome, elapsed: self.outcomes.append(
+                (outcome, elapsed)),
+            **kwargs)
+
+    def test_delivered_messages_are_removed(self):
+        user = FakeUser()
+        self.clock.now += 2
+        self.deliver(user)
+
+        self.assertEqual(user.send_parameters, "Código: ASDF-1234")
+        self.assertEqual(PendingMessage.select().count(), 0)
+        self.assertEqual(self.outcomes, [('delivered', 2.0)])
+
+    def test_failed_sends_are_retried_with_backoff(self):
+        self.deliver(ClosedDMUser(), base_delay=5)
+        message = PendingMessage.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(message.next_attempt_at, self.clock() + 5)
+        self.assertEqual(message.last_error, "DMs fechadas")
+
+        self.clock.now += 1
+        self.deliver(ClosedDMUser(), base_delay=5)
+        self.assertEqual(PendingMessage.get().attempts, 1)
+
+        self.clock.now += 4
+        self.deliver(ClosedDMUser(), base_delay=5)
+        message = PendingMessage.get()
+        self.assertEqual(message.attempts, 2)
+        self.assertEqual(message.next_attempt_at, self.clock() + 10)
+        self.assertEqual([outcome for outcome, _ in self.outcomes],
+                         ['retried', 'retried'])
+        self.assertFalse(is_free(PromoCode.get()))
+
+    def test_gives_up_after_max_attempts(self):
+        self.deliver(ClosedDMUser(), base_delay=0, max_attempts=2)
+        self.deliver(ClosedDMUser(), base_delay=0, max_attempts=2)
+
+        self.assertEqual(PendingMessage.select().count(), 0)
+        self.assertTrue(is_free(PromoCode.get()))
+        self.assertEqual(self.failures, [('ASDF-1234', "DMs fechadas")])
+        self.assertEqual([outcome for outcome, _ in self.outcomes],
+                         ['retried', 'failed'])
+
+    def test_unknown_users_are_given_up_on_at_once(self):
+        self.deliver()
+
+        self.assertEqual(PendingMessage.select().count(), 0)
+        self.assertTrue(is_free(PromoCode.get()))
+        self.assertEqual(len(self.failures), 1)
+
+    def test_failing_failure_reports_do_not_stop_the_batch(self):
+        self.queue_codes(FakeGuild.id, [FakeUser2()])
+
+        async def on_failure(message, error):
+            self.failures.append(message.recipient_id)
+            raise RuntimeError("canal apagado")
+        with self.assertLogs(level='ERROR'):
+            deliver_pending(clock=self.clock, on_failure=on_failure)
+
+        self.assertEqual(PendingMessage.select().count(), 0)
+        self.assertEqual(sorted(self.failures), [FakeUser.id, FakeUser2.id])
+
+    def test_failed_user_lookups_are_retried(self):
+        async def resolve_users(user_ids):
+            return {user_id: TimeoutError("timeout") for user_id in user_ids}
+        worker = DeliveryWorker(SingleStorage(DBExecutor()), resolve_users,
+                                base_delay=10, clock=self.clock)
+        worker.notify(FakeGuild.id)
+        asyncio.run(worker.deliver_due())
+
+        message = PendingMessage.get()
+        self.assertEqual(message.last_error, "timeout")
+        self.assertEqual(message.next_attempt_at, self.clock() + 10)
+        self.assertFalse(is_free(PromoCode.get()))
+        self.assertEqual(self.failures, [])
+
+    def test_taken_messages_are_leased(self):
+        messages, next_due = queries.take_due_messages(
+            FakeGuild.id, self.clock(), 10, 60)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(next_due, self.clock() + 60)
+
+        messages, _ = queries.take_due_messages(
+            FakeGuild.id, self.clock() + 59, 10, 60)
+        self.assertEqual(messages, [])
+        messages, _ = queries.take_due_messages(
+            FakeGuild.id, self.clock() + 60, 10, 60)
+        self.assertEqual(len(messages), 1)
+
+    def test_only_the_guilds_messages_are_taken(self):
+        messages, next_due = queries.take_due_messages(
+            FakeGuild2.id, self.clock(), 10, 60)
+        self.assertEqual((messages, next_due), ([], None))
+
+        self.assertEqual(PendingMessage.get().attempts, 0)
+
+    def test_sends_are_bounded_across_guilds(self):
+        sending = []
+        peak = []
+
+        class SlowUser(FakeUser):
+            def __init__(self, user_id):
+                self.id = user_id
+
+            async def send(self, params, file=None):
+                sending.append(params)
+                peak.append(len(sending))
+                await asyncio.sleep(0.01)
+                sending.remove(params)
+
+        users = [SlowUser(1000 + index) for index in range(3)]
+        for guild_id in range(1, 5):
+            self.queue_codes(guild_id, users)
+
+        self.deliver(*users, guild_ids=range(1, 5), concurrency=2)
+
+        self.assertEqual(len(peak), 12)
+        self.assertEqual(max(peak), 2)
+
+    def test_lease_is_renewed_before_a_late_send(self):
+        clock = self.clock
+
+        class SlowUser(FakeUser):
+            async def send(self, params, file=None):
+                clock.now += 40
+        self.queue_codes(FakeGuild.id, [FakeUser2()])
+
+        self.deliver(SlowUser(), FakeUser2(), concurrency=1)
+
+        self.assertEqual(PendingMessage.select().count(), 0)
+        self.assertEqual([outcome for outcome, _ in self.outcomes],
+                         ['delivered', 'delivered'])
+
+    def test_message_taken_over_by_another_worker_is_not_sent(self):
+        clock = self.clock
+        taken = []
+
+        class SlowUser(FakeUser):
+            async def send(self, params, file=None):
+                # the lease runs out and another worker takes the rest
+                clock.now += 61
+                taken.extend(queries.take_due_messages(
+                    FakeGuild.id, clock(), 10, 60)[0])
+        self.queue_codes(FakeGuild.id, [FakeUser2()])
+        user2 = FakeUser2()
+
+        self.deliver(SlowUser(), user2, concurrency=1)
+
+        self.assertFalse(user2.send_called)
+        self.assertIn(FakeUser2.id,
+                      [message.recipient_id for message in taken])
+        self.assertEqual(PendingMessage.get().recipient_id, FakeUser2.id)
+        self.assertEqual(self.outcomes, [('delivered', 61.0)])
+
+    def test_run_recovers_leftover_messages(self):
+        user = FakeUser()
+
+        async def resolve_users(user_ids):
+            return {user_id: user for user_id in user_ids}
+        worker = DeliveryWorker(SingleStorage(DBExecutor()), resolve_users)
+
+        async def run_briefly():
+            task = asyncio.ensure_future(worker.run())
+            while not user.send_called:
+                await asyncio.sleep(0.01)
+            task.cancel()
+        asyncio.run(asyncio.wait_for(run_briefly(), 5))
+
+        self.assertEqual(user.send_parameters, "Código: ASDF-1234")
+        self.assertEqual(worker.guild_ids, set())
@@ -0,0 +1,165 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from dispatcher import CommandDispatcher, QueueFull
+import main
+
+from .utils import FakeContext, FakeGuild, FakeUser2, returns_true
+
+
+class FakeCommand():
+    def __init__(self, name):
+        self.name = name
+
+
+class Recorder():
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def command(self, name, delay=0.01):
+        async def run():
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.events.append(name)
+            await asyncio.sleep(delay)
+            self.running -= 1
+            return name
+        return run
+
+
+class TestCommandDispatcher(unittest.TestCase):
+    def test_reads_run_up_to_concurrency(self):
+        dispatcher = CommandDispatcher(concurrency=3)
+        recorder = Recorder()
+
+        async def run_all():
+            return await asyncio.gather(*[
+                dispatcher.run(1, recorder.command(index))
+                for index in range(10)])
+        results = asyncio.run(run_all())
+
+        self.assertEqual(results, list(range(10)))
+        self.assertEqual(recorder.max_running, 3)
+        self.assertEqual(dispatcher.queues, {})
+
+    def test_writes_run_one_at_a_time_per_guild(self):
+        dispatcher = CommandDispatcher(concurrency=10)
+        recorder = Recorder()
+
+        async def run_all():
+            await asyncio.gather(*[
+                dispatcher.run(1, recorder.command(index), write=True)
+                for index in range(5)])
+        asyncio.run(run_all())
+
+        self.assertEqual(recorder.events, [0, 1, 2, 3, 4])
+        self.assertEqual(recorder.max_running, 1)
+
+    def test_guilds_do_not_wait_for_each_other(self):
+        dispatcher = CommandDispatcher(concurrency=1)
+        recorder = Recorder()
+
+        async def run_all():
+            await asyncio.gather(*[
+                dispatcher.run(guild_id, recorder.command(guild_id))
+                for guild_id in range(4)])
+        asyncio.run(run_all())
+
+        self.assertEqual(recorder.max_running, 4)
+
+    def test_priority_lane_is_served_first(self):
+        dispatcher = CommandDispatcher(concurrency=1)
+        recorder = Recorder()
+
+        async def run_all():
+            await asyncio.gather(
+                dispatcher.run(1, recorder.command('member-1')),
+                dispatcher.run(1, recorder.command('member-2')),
+                dispatcher.run(1, recorder.command('member-3')),
+                dispatcher.run(1, recorder.command('admin'), priority=True))
+        asyncio.run(run_all())
+
+        self.assertEqual(recorder.events,
+                         ['member-1', 'admin', 'member-2', 'member-3'])
+
+    def test_full_lane_refuses_commands(self):
+        dispatcher = CommandDispatcher(concurrency=1, max_queued=2)
+        recorder = Recorder()
+
+        async def run_all():
+            return await asyncio.gather(
+                *[dispatcher.run(1, recorder.command(index))
+                  for index in range(4)],
+                dispatcher.run(1, recorder.command('admin'), priority=True),
+                return_exceptions=True)
+        results = asyncio.run(run_all())
+
+        self.assertEqual(results[:3], [0, 1, 2])
+        self.assertIsInstance(results[3], QueueFull)
+        self.assertEqual(results[4], 'admin')
+        self.assertEqual(dispatcher.stats(),
+                         {'queued': 0, 'running': 0, 'rejected': 1})
+
+    def test_cancelled_commands_leave_the_queue(self):
+        dispatcher = CommandDispatcher(concurrency=1)
+        recorder = Recorder()
+
+        async def run_all():
+            first = asyncio.ensure_future(
+                dispatcher.run(1, recorder.command('first')))
+            waiting = asyncio.ensure_future(
+                dispatcher.run(1, recorder.command('cancelled')))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            await asyncio.gather(first, waiting, return_exceptions=True)
+            await dispatcher.run(1, recorder.command('last'))
+        asyncio.run(run_all())
+
+        self.assertEqual(recorder.events, ['first', 'last'])
+        self.assertEqual(dispatcher.queues, {})
+
+
+class TestDispatch(unittest.TestCase):
+    def dispatch(self, name):
+        ctx = FakeContext()
+        ctx.command = FakeCommand(name)
+        invoked = []
+
+        async def invoke(ctx):
+            invoked.append(ctx.command.name)
+        asyncio.run(main.dispatch(ctx,
+                                  invoke=invoke,
+                                  has_priority=returns_true))
+        return invoked
+
+    def test_commands_are_invoked_through_the_queue(self):
+        self.assertEqual(self.dispatch('send_code'), ['send_code'])
+        self.assertEqual(self.dispatch('list_code'), ['list_code'])
+        self.assertEqual(main.dispatcher.queues, {})
+
+    def test_dm_commands_are_queued_per_author(self):
+        keys = []
+
+        class KeyRecorder(CommandDispatcher):
+            async def run(self, guild_id, function, **kwargs):
+                keys.append(guild_id)
+                return await super().run(guild_id, function, **kwargs)
+
+        async def invoke(ctx):
+            pass
+        contexts = [FakeContext(), FakeContext(), FakeContext(FakeUser2())]
+        for ctx in contexts[1:]:
+            ctx.guild = None
+        with mock.patch.object(main, 'dispatcher', KeyRecorder()):
+            for ctx in contexts:
+                ctx.command = FakeCommand('my_codes')
+                asyncio.run(main.dispatch(ctx,
+                                          invoke=invoke,
+                                          has_priority=returns_true))
+
+        self.assertEqual(keys, [FakeGuild.id,
+                                ('dm', contexts[1].author.id),
+                                ('dm', FakeUser2.id)])
@@ -0,0 +1,103 @@
+import multiprocessing
+import unittest
+
+from launcher import (launch,
+                      parse_shard_ids,
+                      process_environment,
+                      shard_ids_for)
+from tests.utils import FakeGateway
+
+
+class InlineProcess():
+    """Runs the target on start() instead of in a new process."""
+
+    def __init__(self, target, args, name):
+        self.target = target
+        self.args = args
+        self.name = name
+        self.exitcode = None
+
+    def start(self):
+        self.target(*self.args)
+        self.exitcode = 0
+
+    def join(self):
+        pass
+
+
+class InlineContext():
+    Process = InlineProcess
+
+
+def exit_with_shard_count(shard_ids, shard_count, process_index):
+    # pylint: disable=unused-argument
+    raise SystemExit(shard_count - len(shard_ids))
+
+
+class TestParseShardIds(unittest.TestCase):
+    def test_lists_and_ranges(self):
+        self.assertEqual(parse_shard_ids('0, 2,4-6'), [0, 2, 4, 5, 6])
+
+    def test_empty_means_every_shard(self):
+        self.assertIsNone(parse_shard_ids(''))
+
+
+class TestProcessEnvironment(unittest.TestCase):
+    def test_each_process_gets_its_own_metrics_port(self):
+        ports = [process_environment([index], 3, index,
+                                     {'METRICS_PORT': '9100'})['METRICS_PORT']
+                 for index in range(3)]
+
+        self.assertEqual(ports, ['9100', '9101', '9102'])
+
+    def test_metrics_stay_off(self):
+        self.assertEqual(process_environment([0, 2], 3, 0, {}),
+                         {'DISCORD_SHARD_COUNT': '3',
+                          'DISCORD_SHARD_IDS': '0,2'})
+
+
+class TestLaunch(unittest.TestCase):
+    def test_every_shard_belongs_to_one_process(self):
+        slices = [shard_ids_for(index, 3, 8) for index in range(3)]
+
+        self.assertEqual(slices, [[0, 3, 6], [1, 4, 7], [2, 5]])
+
+    def test_gateway_events_reach_one_process_per_guild(self):
+        gateway = FakeGateway(shard_count=8)
+        received = {}
+
+        def connect(shard_ids, shard_count, process_index):
+            self.assertEqual(shard_count, 8)
+            name = 'bot-{}'.format(process_index)
+            received[name] = []
+            gateway.connect(shard_ids, received[name].append)
+
+        exit_codes = launch(3, 8, target=connect, context=InlineContext())
+        # snowflakes about a day apart, with the low worker bits set
+        guild_ids = [197038439483310086 + (index * 86400007 << 22)
+                     for index in range(100)]
+        for guild_id in guild_ids + [None]:
+            gateway.dispatch(guild_id, guild_id)
+
+        self.assertEqual(exit_codes, [0, 0, 0])
+        self.assertEqual(sorted(gateway.handlers), list(range(8)))
+        self.assertTrue(all(received.values()))
+        self.assertEqual(
+            sorted(guild_id for events in received.values()
+                   for guild_id in events if guild_id is not None),
+            guild_ids)
+        self.assertIn(None, received['bot-0'])
+
+    def test_shard_cannot_connect_twice(self):
+        gateway = FakeGateway(shard_count=2)
+        gateway.connect([0], print)
+
+        with self.assertRaises(ValueError):
+            gateway.connect([0, 1], print)
+
+    def test_runs_real_processes(self):
+        exit_codes = launch(2, 5,
+                            target=exit_with_shard_count,
+                            context=multiprocessing.get_context('spawn'))
+
+        self.assertEqual(exit_codes, [2, 3])
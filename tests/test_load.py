@@ -0,0 +1,22 @@
+import os
+import tempfile
+import unittest
+
+from benchmarks.load import constant_latency, run_load
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_commands_go_through_the_bot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            report, api = run_load(os.path.join(directory, 'load.sqlite'),
+                                   codes=300,
+                                   members=3,
+                                   recipients=2,
+                                   duration=0.2,
+                                   latency=constant_latency(1))
+
+        self.assertEqual(sorted(report.latencies), ['my_codes', 'send_code'])
+        self.assertEqual(dict(report.errors), {})
+        # every command answers with at least one message
+        self.assertGreaterEqual(api.sent, report.completed())
+        self.assertIn('comandos/s', report.lines()[0])
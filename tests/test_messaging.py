@@ -0,0 +1,169 @@
+import asyncio
+import unittest
+
+from messaging import Outbox, deliver
+
+
+class SlowDestination():
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, id_):
+        self.id = id_
+        self.received = []
+
+    async def send(self, content):
+        SlowDestination.in_flight += 1
+        SlowDestination.max_in_flight = max(SlowDestination.max_in_flight,
+                                            SlowDestination.in_flight)
+        await asyncio.sleep(0.01)
+        self.received.append(content)
+        SlowDestination.in_flight -= 1
+
+
+class BrokenDestination():
+    id = 1
+
+    async def send(self, content):
+        raise RuntimeError(content)
+
+
+class TestDeliver(unittest.TestCase):
+    def setUp(self):
+        SlowDestination.in_flight = 0
+        SlowDestination.max_in_flight = 0
+
+    def test_respects_concurrency(self):
+        destinations = [SlowDestination(i) for i in range(10)]
+        errors = asyncio.run(deliver(
+            [(destination, 'foo') for destination in destinations],
+            concurrency=3
+        ))
+
+        self.assertEqual(errors, [None] * 10)
+        self.assertEqual(SlowDestination.max_in_flight, 3)
+        for destination in destinations:
+            self.assertEqual(destination.received, ['foo'])
+
+    def test_same_destination_is_sent_in_order(self):
+        destination = SlowDestination(1)
+        asyncio.run(deliver(
+            [(destination, 'foo'), (destination, 'bar'), (destination, 'baz')],
+            concurrency=3
+        ))
+
+        self.assertEqual(destination.received, ['foo', 'bar', 'baz'])
+        self.assertEqual(SlowDestination.max_in_flight, 1)
+
+    def test_failures_are_returned(self):
+        destination = SlowDestination(2)
+        errors = asyncio.run(deliver(
+            [(BrokenDestination(), 'foo'), (destination, 'bar')]
+        ))
+
+        self.assertIsInstance(errors[0], RuntimeError)
+        self.assertIsNone(errors[1])
+        self.assertEqual(destination.received, ['bar'])
+
+    def test_send_durations_are_observed(self):
+        durations = []
+        asyncio.run(deliver(
+            [(BrokenDestination(), 'foo'), (SlowDestination(2), 'bar')],
+            observe=durations.append
+        ))
+
+        self.assertEqual(len(durations), 2)
+        self.assertGreaterEqual(max(durations), 0.01)
+
+    def test_before_send_can_stop_a_send(self):
+        destinations = [SlowDestination(1), SlowDestination(2)]
+
+        async def before_send(index):
+            if index == 0:
+                raise LookupError(index)
+        errors = asyncio.run(deliver(
+            [(destination, 'foo') for destination in destinations],
+            before_send=before_send
+        ))
+
+        self.assertIsInstance(errors[0], LookupError)
+        self.assertIsNone(errors[1])
+        self.assertEqual([destination.received
+                          for destination in destinations], [[], ['foo']])
+
+
+class FakeChannel():
+    def __init__(self, id_):
+        self.id = id_
+
+
+class ChannelContext(SlowDestination):
+    def __init__(self, channel):
+        super().__init__(channel.id)
+        self.channel = channel
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        SlowDestination.in_flight = 0
+        SlowDestination.max_in_flight = 0
+
+    def test_merges_messages_queued_during_a_send(self):
+        outbox = Outbox()
+        channel = FakeChannel(1)
+        contexts = [ChannelContext(channel) for _ in range(4)]
+
+        async def send_all():
+            return await asyncio.gather(*[
+                outbox.send(ctx, 'reply {}'.format(index))
+                for index, ctx in enumerate(contexts)])
+        asyncio.run(send_all())
+
+        self.assertEqual(contexts[0].received,
+                         ['reply 0\nreply 1\nreply 2\nreply 3'])
+        self.assertEqual(outbox.stats(), {'messages': 4, 'requests': 1})
+
+    def test_sends_in_order_up_to_max_length(self):
+        outbox = Outbox(max_length=9)
+        destination = SlowDestination(1)
+
+        async def send_all():
+            first = asyncio.ensure_future(outbox.send(destination, 'a'))
+            await asyncio.sleep(0.001)
+            await asyncio.gather(
+                first,
+                outbox.send(destination, 'bbbb'),
+                outbox.send(destination, 'cccc'),
+                outbox.send(destination, 'dd', merge=False),
+                outbox.send(destination, 'e'))
+        asyncio.run(send_all())
+
+        self.assertEqual(destination.received,
+                         ['a', 'bbbb\ncccc', 'dd', 'e'])
+        self.assertEqual(SlowDestination.max_in_flight, 1)
+
+    def test_destinations_are_not_merged(self):
+        outbox = Outbox()
+        destinations = [SlowDestination(index) for index in range(3)]
+
+        async def send_all():
+            await asyncio.gather(*[outbox.send(destination, 'foo')
+                                   for destination in destinations])
+        asyncio.run(send_all())
+
+        for destination in destinations:
+            self.assertEqual(destination.received, ['foo'])
+        self.assertEqual(SlowDestination.max_in_flight, 3)
+
+    def test_failures_reach_every_merged_sender(self):
+        outbox = Outbox()
+
+        async def send_all():
+            return await asyncio.gather(
+                outbox.send(BrokenDestination(), 'foo'),
+                outbox.send(BrokenDestination(), 'bar'),
+                return_exceptions=True)
+        errors = asyncio.run(send_all())
+
+        self.assertEqual([str(error) for error in errors],
+                         ['foo\nbar', 'foo\nbar'])
@@ -0,0 +1,123 @@
+import asyncio
+import unittest
+
+import aiohttp
+
+from main import stats
+from metrics import Histogram, Metrics
+
+from .utils import FakeClock, FakeContext
+
+
+class FakeCommand():
+    qualified_name = 'send_code'
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.cumulative_counts(),
+                         [(0.1, 2), (1.0, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 3.65)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.75), 1.0)
+
+    def test_empty_quantile(self):
+        self.assertEqual(Histogram().quantile(0.95), 0.0)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = Metrics(clock=self.clock,
+                               gauges=lambda: {'db_queue_depth': 3})
+
+    def invoke(self, duration, send_duration):
+        ctx = FakeContext()
+        ctx.command = FakeCommand()
+
+        async def send_and_wait():
+            await self.metrics.before_invoke(ctx)
+            send = ctx.send
+
+            async def slow_send(content):
+                self.clock.now += send_duration
+                return await send(content)
+            ctx.send = self.metrics.timed(slow_send, 'channel')
+            await ctx.send('foo')
+            self.clock.now += duration - send_duration
+            await self.metrics.after_invoke(ctx)
+        asyncio.run(send_and_wait())
+        return ctx
+
+    def test_invoke_hooks_time_commands_and_sends(self):
+        ctx = self.invoke(duration=0.2, send_duration=0.05)
+
+        self.assertEqual(ctx.send_parameters, 'foo')
+        histogram = self.metrics.commands['send_code']
+        self.assertEqual(histogram.count, 1)
+        self.assertAlmostEqual(histogram.sum, 0.2)
+        self.assertAlmostEqual(self.metrics.sends['channel'].sum, 0.05)
+
+    def test_render_prometheus_text(self):
+        self.invoke(duration=0.2, send_duration=0.05)
+        self.metrics.observe_query('SELECT 1', 0.002)
+        ctx = FakeContext()
+        ctx.command = FakeCommand()
+        self.metrics.observe_error(ctx)
+
+        text = self.metrics.render()
+
+        self.assertIn('promo_bot_command_duration_seconds_bucket'
+                      '{command="send_code",le="0.25"} 1', text)
+        self.assertIn('promo_bot_command_duration_seconds_count'
+                      '{command="send_code"} 1', text)
+        self.assertIn('promo_bot_command_errors_total'
+                      '{command="send_code"} 1', text)
+        self.assertIn('promo_bot_db_query_duration_seconds_count 1', text)
+        self.assertIn('promo_bot_db_queue_depth 3', text)
+
+    def test_dm_deliveries(self):
+        self.metrics.observe_delivery('delivered', 2.0)
+        self.metrics.observe_delivery('retried', 1.0)
+
+        self.assertIn('promo_bot_dm_delivery_seconds_count'
+                      '{outcome="delivered"} 1', self.metrics.render())
+        self.assertIn("DMs (retried): 1, 1.0s após entrar na fila em média",
+                      self.metrics.summary_lines())
+
+    def test_summary(self):
+        self.invoke(duration=0.2, send_duration=0.05)
+
+        self.assertEqual(self.metrics.summary_lines()[0],
+                         "send_code: 1 execuções, média 200.0ms, "
+                         "p95 até 250ms, 0 erros")
+
+    def test_serves_metrics_over_http(self):
+        async def fetch():
+            runner = await self.metrics.serve(port=0)
+            try:
+                host, port = runner.addresses[0][:2]
+                async with aiohttp.ClientSession() as session:
+                    url = 'http://{}:{}/metrics'.format(host, port)
+                    async with session.get(url) as response:
+                        return response.status, await response.text()
+            finally:
+                await runner.cleanup()
+
+        status, text = asyncio.run(fetch())
+
+        self.assertEqual(status, 200)
+        self.assertIn('promo_bot_db_queue_depth 3', text)
+
+
+class TestStatsCommand(unittest.TestCase):
+    def test_shows_summary(self):
+        ctx = FakeContext()
+        asyncio.run(stats(ctx))
+
+        self.assertIn("Banco de dados:", ctx.send_parameters)
@@ -0,0 +1,262 @@
+from unittest import mock
+
+from peewee import SqliteDatabase
+
+from constants import MODELS
+import migrations
+from migrations import (MIGRATIONS,
+                        migrate,
+                        rowid_ranges,
+                        schema_version,
+                        setup_schema)
+
+from .utils import DBTestCase
+
+
+def index_names(database):
+    cursor = database.execute_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")
+    return {name for (name,) in cursor.fetchall()}
+
+
+class TestMigrate(DBTestCase):
+    def old_database(self):
+        """A database with the schema from before the migrations."""
+        old_db = SqliteDatabase(':memory:')
+        old_db.execute_sql(
+            'CREATE TABLE promocodegroup (id INTEGER PRIMARY KEY, '
+            'guild_id INT, name VARCHAR(255))')
+        old_db.execute_sql(
+            'CREATE TABLE promocode (id INTEGER PRIMARY KEY, group_id INT, '
+            'code VARCHAR(255), sent_to_name VARCHAR(255), '
+            'sent_to_id INT, sent_at DATETIME)')
+        return old_db
+
+    def test_old_schema_is_brought_to_latest_version(self):
+        old_db = self.old_database()
+        self.assertEqual(schema_version(old_db), 0)
+        self.assertEqual(migrate(old_db), len(MIGRATIONS))
+        self.assertEqual(migrate(old_db), len(MIGRATIONS))
+
+    def test_old_schema_gets_promo_code_indexes(self):
+        old_db = self.old_database()
+        migrate(old_db, MIGRATIONS[:1])
+
+        self.assertTrue({'promocode_available',
+                         'promocode_group_id_sent_to_id'}
+                        <= index_names(old_db))
+
+    def test_old_schema_gets_group_counters(self):
+        old_db = self.old_database()
+        old_db.execute_sql("INSERT INTO promocodegroup VALUES (1, 1, 'foo')")
+        old_db.execute_sql(
+            "INSERT INTO promocode (group_id, code, sent_to_id) "
+            "VALUES (1, 'A', NULL), (1, 'B', 2), (1, 'C', NULL)")
+        migrate(old_db)
+        old_db.execute_sql(
+            "INSERT INTO promocode (group_id, code) VALUES (1, 'D')")
+        counters = old_db.execute_sql(
+            'SELECT total_codes, available_codes FROM promocodegroup'
+        ).fetchone()
+
+        self.assertEqual(counters, (4, 3))
+
+    def test_old_schema_gets_redemptions(self):
+        old_db = self.old_database()
+        old_db.execute_sql("INSERT INTO promocodegroup VALUES (1, 1, 'foo')")
+        old_db.execute_sql(
+            "INSERT INTO promocode (group_id, code, sent_to_id, sent_at) "
+            "VALUES (1, 'A', NULL, NULL), (1, 'B', 2, '2020-05-25')")
+        migrate(old_db, MIGRATIONS[:3], batch_size=1)
+        # the ledger follows sent_to_* until add_claimed
+        old_db.execute_sql(
+            "UPDATE promocode SET sent_to_id = 4, sent_at = '2020-05-27' "
+            "WHERE code = 'A'")
+        old_db.execute_sql(
+            "UPDATE promocode SET sent_to_id = NULL WHERE code = 'B'")
+        redemptions = old_db.execute_sql(
+            'SELECT code, user_id, redeemed_at, released_at IS NOT NULL '
+            'FROM redemption ORDER BY code'
+        ).fetchall()
+
+        self.assertEqual(redemptions, [('A', 4, '2020-05-27', 0),
+                                       ('B', 2, '2020-05-25', 1)])
+        self.assertIn(
+            'redemption_user_id_group_id_released_at_redeemed_at_code',
+            index_names(old_db))
+
+    def sent_codes_database(self):
+        old_db = self.old_database()
+        old_db.execute_sql("INSERT INTO promocodegroup VALUES (1, 1, 'foo')")
+        old_db.execute_sql(
+            "INSERT INTO promocode (group_id, code, sent_to_id, sent_at) "
+            "VALUES (1, 'A', NULL, NULL), (1, 'B', 2, '2020-05-25'), "
+            "(1, 'C', 3, '2020-05-26')")
+        return old_db
+
+    def test_old_schema_gets_claimed(self):
+        old_db = self.sent_codes_database()
+        migrate(old_db, MIGRATIONS[:4], batch_size=1)
+        # sent_to_* is no longer read or followed
+        old_db.execute_sql(
+            "UPDATE promocode SET claimed = 1 WHERE code = 'A'")
+
+        self.assertEqual(old_db.execute_sql(
+            'SELECT code, claimed, sent_to_id, sent_to_name, sent_at '
+            'FROM promocode ORDER BY code'
+        ).fetchall(), [('A', 1, None, None, None),
+                       ('B', 1, None, None, None),
+                       ('C', 1, None, None, None)])
+        self.assertEqual(old_db.execute_sql(
+            'SELECT code, user_id, released_at IS NOT NULL '
+            'FROM redemption ORDER BY code'
+        ).fetchall(), [('B', 2, 0), ('C', 3, 0)])
+        self.assertEqual(old_db.execute_sql(
+            'SELECT total_codes, available_codes FROM promocodegroup'
+        ).fetchone(), (3, 0))
+        indexes = index_names(old_db)
+        self.assertIn('promocode_unclaimed', indexes)
+        self.assertFalse({'promocode_available',
+                          'promocode_group_id_sent_to_id'} & indexes)
+
+    def test_old_schema_gets_free_codes(self):
+        old_db = self.sent_codes_database()
+        migrate(old_db, MIGRATIONS[:4], batch_size=1)
+        # C was released the way release_codes did it, and B kept its
+        # sent_to_* as an earlier add_claimed left it
+        old_db.execute_sql(
+            "UPDATE redemption SET released_at = '2020-06-01' "
+            "WHERE code = 'C'")
+        old_db.execute_sql(
+            "UPDATE promocode SET claimed = 0 WHERE code = 'C'")
+        old_db.execute_sql(
+            "UPDATE promocode SET sent_to_id = 2 WHERE code = 'B'")
+        migrate(old_db, batch_size=1)
+        old_db.execute_sql(
+            "INSERT INTO promocode (group_id, code) VALUES (1, 'D')")
+        old_db.execute_sql("DELETE FROM promocode WHERE code = 'A'")
+
+        self.assertEqual(old_db.execute_sql(
+            'SELECT code FROM freecode '
+            'JOIN promocode ON promocode.id = promo_code_id ORDER BY code'
+        ).fetchall(), [('C',), ('D',)])
+        self.assertEqual(old_db.execute_sql(
+            'SELECT code, redemptionrelease.released_at '
+            'FROM redemptionrelease JOIN redemption ON id = redemption_id'
+        ).fetchall(), [('C', '2020-06-01')])
+        self.assertEqual(old_db.execute_sql(
+            'SELECT count(*) FROM promocode WHERE sent_to_id IS NOT NULL'
+        ).fetchone(), (0,))
+        self.assertEqual(old_db.execute_sql(
+            'SELECT total_codes, available_codes FROM promocodegroup'
+        ).fetchone(), (3, 2))
+        indexes = index_names(old_db)
+        self.assertIn('redemption_user_id_group_id_redeemed_at_code',
+                      indexes)
+        self.assertFalse(
+            {'promocode_unclaimed',
+             'redemption_user_id_group_id_released_at_redeemed_at_code'}
+            & indexes)
+
+    def test_migrations_finished_by_another_process_are_skipped(self):
+        old_db = self.old_database()
+        old_db.execute_sql("INSERT INTO promocodegroup VALUES (1, 1, 'foo')")
+        migrate(old_db)
+        versions = iter([0])
+        original = migrations.schema_version
+
+        def stale_schema_version(database):
+            # the first read happened before the other process migrated
+            return next(versions, None) or original(database)
+        with mock.patch('migrations.schema_version', stale_schema_version):
+            self.assertEqual(migrate(old_db), len(MIGRATIONS))
+        old_db.execute_sql(
+            "INSERT INTO promocode (group_id, code, sent_to_id) "
+            "VALUES (1, 'A', 2)")
+
+        self.assertNotIn('promocode_available', index_names(old_db))
+        self.assertEqual(old_db.execute_sql(
+            'SELECT total_codes, available_codes FROM promocodegroup'
+        ).fetchone(), (1, 1))
+
+    def test_new_database_starts_at_latest_version(self):
+        new_db = SqliteDatabase(':memory:')
+        with new_db.bind_ctx(MODELS), \
+                mock.patch('migrations.run_migration') as run_migration:
+            self.assertEqual(setup_schema(new_db, MODELS), len(MIGRATIONS))
+
+        run_migration.assert_not_called()
+        self.assertIn('pendingmessage', new_db.get_tables())
+
+    def test_old_database_is_migrated_before_create_tables(self):
+        old_db = self.old_database()
+        old_db.execute_sql("INSERT INTO promocodegroup VALUES (1, 1, 'foo')")
+        old_db.execute_sql(
+            "INSERT INTO promocode (group_id, code, sent_to_id) "
+            "VALUES (1, 'A', NULL), (1, 'B', 2)")
+        indexes_before = []
+        original = migrations.run_migration
+
+        def run_migration(database, *args):
+            indexes_before.append(index_names(database))
+            return original(database, *args)
+        with old_db.bind_ctx(MODELS), \
+                mock.patch('migrations.run_migration', run_migration):
+            self.assertEqual(setup_schema(old_db, MODELS), len(MIGRATIONS))
+
+        self.assertEqual(len(indexes_before), len(MIGRATIONS))
+        # the indexes are left to the batched migrations
+        self.assertNotIn('promocode_available', indexes_before[0])
+        self.assertIn('pendingmessage', old_db.get_tables())
+        self.assertEqual(old_db.execute_sql(
+            'SELECT total_codes, available_codes FROM promocodegroup'
+        ).fetchone(), (2, 1))
+
+    def test_only_newer_migrations_run(self):
+        calls = []
+        migrations = [lambda database: calls.append(1),
+                      lambda database: calls.append(2)]
+        self.test_db.pragma('user_version', 1)
+        migrate(self.test_db, migrations)
+
+        self.assertEqual(calls, [2])
+        self.assertEqual(schema_version(self.test_db), 2)
+
+    def test_batched_migrations_commit_every_batch(self):
+        def backfill(database, batch_size):
+            for first, last in rowid_ranges(database, 'promocodegroup',
+                                            batch_size):
+                yield
+                if first > 2:
+                    raise RuntimeError('interrupted')
+                database.execute_sql(
+                    'UPDATE promocodegroup SET name = upper(name) '
+                    'WHERE id BETWEEN ? AND ?', (first, last))
+        old_db = self.old_database()
+        old_db.execute_sql(
+            "INSERT INTO promocodegroup VALUES "
+            "(1, 1, 'a'), (2, 1, 'b'), (3, 1, 'c'), (4, 1, 'd')")
+
+        with self.assertRaises(RuntimeError):
+            migrate(old_db, [backfill], batch_size=2)
+
+        names = old_db.execute_sql(
+            'SELECT name FROM promocodegroup ORDER BY id').fetchall()
+        self.assertEqual(names, [('A',), ('B',), ('c',), ('d',)])
+        self.assertEqual(schema_version(old_db), 0)
+
+    def test_group_counters_backfill_in_batches(self):
+        old_db = self.old_database()
+        for group_id in range(1, 6):
+            old_db.execute_sql(
+                "INSERT INTO promocodegroup VALUES (?, 1, ?)",
+                (group_id, str(group_id)))
+            old_db.execute_sql(
+                "INSERT INTO promocode (group_id, code) VALUES (?, 'A')",
+                (group_id,))
+        migrate(old_db, batch_size=2)
+
+        counters = old_db.execute_sql(
+            'SELECT total_codes, available_codes FROM promocodegroup'
+        ).fetchall()
+        self.assertEqual(counters, [(1, 1)] * 5)
@@ -0,0 +1,137 @@
+from model import (ALREADY_RECEIVED,
+                   PromoCodeGroup,
+                   PromoCode,
+                   Redemption,
+                   RedemptionRelease)
+from queries import codes_sent_to, release_codes
+
+from .utils import DBTestCase, is_free
+
+
+class TestPromoCodeClaim(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = PromoCodeGroup.create(guild_id=1, name='foo')
+        for code in ['ASDF-1234', 'QWER-5678', 'ZXCV-9012']:
+            PromoCode.create(group=self.group, code=code)
+
+    def test_claims_one_code_per_user_in_order(self):
+        results = PromoCode.claim(self.group, [(1, 'spam'), (2, 'eggs')])
+
+        self.assertEqual([promo_code.code for promo_code in results],
+                         ['ASDF-1234', 'QWER-5678'])
+        self.assertEqual((results[1].user_id, results[1].user_name),
+                         (2, 'eggs'))
+        self.assertIsNotNone(results[1].redeemed_at)
+        self.assertEqual(
+            [(promo_code.code, is_free(promo_code))
+             for promo_code in PromoCode.select().order_by(PromoCode.id)],
+            [('ASDF-1234', False), ('QWER-5678', False), ('ZXCV-9012', True)]
+        )
+
+    def test_stops_when_codes_run_out(self):
+        results = PromoCode.claim(self.group,
+                                  [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')])
+
+        self.assertEqual(len(results), 3)
+
+    def test_once_per_user_skips_previous_and_repeated_users(self):
+        PromoCode.claim(self.group, [(1, 'spam')])
+        results = PromoCode.claim(self.group,
+                                  [(1, 'spam'), (2, 'eggs'), (2, 'eggs')],
+                                  once_per_user=True)
+
+        self.assertEqual(results[0], ALREADY_RECEIVED)
+        self.assertEqual(results[1].code, 'QWER-5678')
+        self.assertEqual(results[2], ALREADY_RECEIVED)
+        self.assertTrue(is_free(PromoCode.get(code='ZXCV-9012')))
+
+    def test_repeated_users_get_codes_without_once_per_user(self):
+        PromoCode.claim(self.group, [(1, 'spam')])
+        results = PromoCode.claim(self.group, [(1, 'spam'), (1, 'spam')])
+
+        self.assertEqual([promo_code.code for promo_code in results],
+                         ['QWER-5678', 'ZXCV-9012'])
+
+    def test_other_groups_are_untouched(self):
+        group2 = PromoCodeGroup.create(guild_id=1, name='bar')
+        PromoCode.create(group=group2, code='ASDF-1234')
+        PromoCode.claim(self.group, [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')])
+
+        self.assertTrue(is_free(PromoCode.get(group=group2)))
+
+
+class TestRedemption(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = PromoCodeGroup.create(guild_id=1, name='foo')
+        for code in ['ASDF-1234', 'QWER-5678']:
+            PromoCode.create(group=self.group, code=code)
+
+    def test_claims_are_recorded(self):
+        PromoCode.claim(self.group, [(1, 'spam'), (2, 'eggs')])
+
+        self.assertEqual(
+            [(redemption.code, redemption.user_id, redemption.user_name,
+              redemption.group_id)
+             for redemption in Redemption.select().order_by(Redemption.id)],
+            [('ASDF-1234', 1, 'spam', self.group.id),
+             ('QWER-5678', 2, 'eggs', self.group.id)])
+        self.assertEqual(
+            Redemption.get(user_id=1).promo_code_id,
+            PromoCode.get(code='ASDF-1234').id)
+
+    def test_released_codes_are_kept_as_released(self):
+        claimed = PromoCode.claim(self.group, [(1, 'spam'), (2, 'eggs')])
+        release_codes([claimed[0].promo_code_id])
+
+        self.assertEqual(
+            [(redemption.user_id, redemption.code)
+             for redemption in Redemption.select().order_by(Redemption.id)],
+            [(1, 'ASDF-1234'), (2, 'QWER-5678')])
+        self.assertEqual(
+            [release.redemption.user_id
+             for release in RedemptionRelease.select()],
+            [1])
+        self.assertEqual(codes_sent_to(1), [])
+        self.assertTrue(is_free(PromoCode.get(code='ASDF-1234')))
+        self.assertEqual(
+            PromoCodeGroup.get_by_id(self.group.id).available_codes, 1)
+
+    def test_released_user_can_claim_again_once(self):
+        claimed = PromoCode.claim(self.group, [(1, 'spam')], True)
+        release_codes([claimed[0].promo_code_id])
+
+        claimed = PromoCode.claim(self.group, [(1, 'spam')], True)
+
+        self.assertEqual(claimed[0].code, 'ASDF-1234')
+        self.assertEqual(PromoCode.claim(self.group, [(1, 'spam')], True),
+                         [ALREADY_RECEIVED])
+        self.assertEqual(Redemption.select().count(), 2)
+
+    def test_removed_code_still_counts_for_once_per_user(self):
+        PromoCode.create(group=self.group, code='ZXCV-9012')
+        PromoCode.claim(self.group, [(1, 'spam')], True)
+        PromoCode.delete().where(PromoCode.code == 'ASDF-1234').execute()
+
+        claimed = PromoCode.claim(self.group, [(1, 'spam'), (2, 'eggs')],
+                                  True)
+
+        self.assertEqual(claimed[0], ALREADY_RECEIVED)
+        self.assertEqual((claimed[1].code, claimed[1].user_id),
+                         ('QWER-5678', 2))
+        self.assertEqual(len(claimed), 2)
+
+    def test_deleted_codes_and_groups_keep_their_history(self):
+        PromoCode.claim(self.group, [(1, 'spam')])
+        PromoCode.delete().where(PromoCode.code == 'ASDF-1234').execute()
+        redemption = Redemption.get()
+        self.assertIsNone(redemption.promo_code_id)
+        self.assertEqual(redemption.group_id, self.group.id)
+
+        self.group.delete_instance()
+
+        redemption = Redemption.get()
+        self.assertIsNone(redemption.group_id)
+        self.assertEqual((redemption.code, redemption.user_id),
+                         ('ASDF-1234', 1))
@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+
+from peewee import SqliteDatabase
+
+from constants import MODELS
+from model import PromoCode, Redemption
+import queries
+
+SEED_ROWS = 1000000
+GROUPS = 100
+
+
+class TestQueryPlans(unittest.TestCase):
+    """Checks with EXPLAIN QUERY PLAN that the hot PromoCode and
+    Redemption queries use an index once the tables are big."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_db = SqliteDatabase(':memory:', pragmas={'foreign_keys': 0})
+        cls.test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+        cls.test_db.connect()
+        cls.test_db.create_tables(MODELS)
+        cls.test_db.execute_sql(
+            'WITH RECURSIVE seq(x) AS ('
+            '  SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?'
+            ') '
+            'INSERT INTO promocode (group_id, code) '
+            'SELECT x % ?, \'CODE-\' || x FROM seq', (SEED_ROWS, GROUPS))
+        # two codes in three were handed out, and a few of those released
+        cls.test_db.execute_sql(
+            'INSERT INTO redemption (promo_code_id, group_id, code, user_id) '
+            'SELECT id, group_id, code, id % 50000 '
+            'FROM promocode WHERE id % 3 != 0')
+        cls.test_db.execute_sql(
+            'DELETE FROM freecode WHERE promo_code_id % 3 != 0')
+        cls.test_db.execute_sql(
+            'INSERT INTO redemptionrelease (redemption_id, released_at) '
+            'SELECT id, \'2021-01-01\' FROM redemption WHERE id % 100 = 0')
+        cls.test_db.execute_sql('ANALYZE')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.test_db.close()
+
+    def setUp(self):
+        # other test cases rebind the models to their own databases
+        self.test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+
+    def query_plan(self, sql, params):
+        cursor = self.test_db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def assert_no_table_scan(self, plan):
+        for line in plan.splitlines():
+            if line.startswith(('SCAN promocode', 'SCAN TABLE promocode')):
+                self.assertIn('INDEX', line, plan)
+
+    def test_send_code_claims_through_free_code_index(self):
+        sql, params = PromoCode._claim_sql(  # pylint: disable=protected-access
+            7, [(1, 'spam'), (2, 'eggs')], True)
+        plan = self.query_plan(sql, params)
+
+        # free codes come from freecode's group index, in id order, and
+        # only the picked ones are looked up in promocode
+        self.assertIn(
+            'SEARCH f USING COVERING INDEX freecode_group_id (group_id=?)',
+            plan)
+        self.assertIn('SEARCH p USING INTEGER PRIMARY KEY (rowid=?)', plan)
+        # the once-per-user check
+        self.assertIn(
+            'SEARCH r USING COVERING INDEX '
+            'redemption_user_id_group_id_redeemed_at_code',
+            plan
+        )
+        self.assert_no_table_scan(plan)
+
+    def executed_sql(self, function, *args, **kwargs):
+        """The (sql, params) of the statements function(*args, **kwargs)
+        runs."""
+        with mock.patch.object(self.test_db, 'execute_sql',
+                               wraps=self.test_db.execute_sql) as execute:
+            function(*args, **kwargs)
+        return [call.args for call in execute.call_args_list]
+
+    def test_list_code_pages_walk_the_group_index(self):
+        pages = {None: 'group_id=?)',
+                 'after': 'group_id=? AND rowid>?)',
+                 'before': 'group_id=? AND rowid<?)'}
+        for page, search in pages.items():
+            kwargs = {} if page is None else {page: 5000}
+            (sql, params), = self.executed_sql(queries.list_codes_page,
+                                               7, **kwargs)
+            plan = self.query_plan(sql, params)
+
+            # ids come in index order, so there's no sort before the LIMIT,
+            # and each code looks up who holds it
+            self.assertEqual(
+                plan.splitlines(),
+                ['SEARCH t1 USING INDEX promocode_group_id (' + search,
+                 'SEARCH t2 USING INDEX redemption_promo_code_id '
+                 '(promo_code_id=?) LEFT-JOIN',
+                 'CORRELATED SCALAR SUBQUERY 1',
+                 'SEARCH t3 USING INTEGER PRIMARY KEY (rowid=?)'])
+
+    def test_my_codes_reads_the_redemption_index_and_releases(self):
+        (sql, params), = self.executed_sql(queries.codes_sent_to, 1234)
+        plan = self.query_plan(sql, params)
+
+        self.assertIn(
+            'USING COVERING INDEX '
+            'redemption_user_id_group_id_redeemed_at_code',
+            plan
+        )
+        # releases are looked up by their primary key
+        self.assertIn('USING INTEGER PRIMARY KEY (rowid=?)', plan)
+
+    def test_group_history_uses_group_time_index(self):
+        sql, params = (Redemption
+                       .select()
+                       .where((Redemption.group == 7)
+                              & (Redemption.redeemed_at >= '2020-01-01'))
+                       .sql())
+        plan = self.query_plan(sql, params)
+
+        self.assertIn('redemption_group_id_redeemed_at', plan)
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from constants import MODELS
+from db_executor import bound_database
+from model import PromoCode
+import queries
+from sharding import ShardRouter, ShardedStorage
+from storage import open_database
+
+from .utils import FakeClock
+
+
+class TestShardRouter(unittest.TestCase):
+    def test_each_thread_uses_its_own_database(self):
+        router = ShardRouter()
+        first = open_database(':memory:')
+        second = open_database(':memory:')
+        seen = {}
+
+        def target():
+            router.use(second)
+            seen['thread'] = router.obj
+        router.use(first)
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+
+        self.assertIs(router.obj, first)
+        self.assertIs(seen['thread'], second)
+        self.assertEqual(router.database, ':memory:')
+
+
+class TestShardedStorage(unittest.TestCase):
+    def setUp(self):
+        self.previous_database = bound_database()
+        self.directory = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.storage = self.make_storage()
+
+    def tearDown(self):
+        self.storage.shutdown()
+        if self.previous_database is not None:
+            self.previous_database.bind(MODELS)
+        self.directory.cleanup()
+
+    def make_storage(self, **kwargs):
+        storage = ShardedStorage(self.directory.name,
+                                 max_workers=2,
+                                 idle_timeout=10,
+                                 clock=self.clock,
+                                 **kwargs)
+        storage.router.bind(MODELS)
+        return storage
+
+    def test_guilds_get_their_own_files(self):
+        async def scenario():
+            await self.storage.run(1, queries.create_group, 1, 'foo')
+            await self.storage.run(2, queries.create_group, 2, 'bar')
+            return (await self.storage.read(1, queries.list_groups, 1),
+                    await self.storage.read(2, queries.list_groups, 1))
+
+        first, second = asyncio.run(scenario())
+
+        self.assertEqual(list(first), ['foo'])
+        self.assertEqual(second, {})
+        self.assertEqual(self.storage.shard_names(),
+                         ['guild-1.sqlite', 'guild-2.sqlite'])
+        self.assertEqual(self.storage.stats()['open_shards'], 2)
+
+    def test_buckets_share_files(self):
+        self.storage.shutdown()
+        self.storage = self.make_storage(buckets=2)
+
+        async def scenario():
+            await self.storage.run(1, queries.create_group, 1, 'foo')
+            await self.storage.run(3, queries.create_group, 3, 'bar')
+            await self.storage.run(2, queries.create_group, 2, 'spam')
+
+        asyncio.run(scenario())
+
+        self.assertEqual(self.storage.shard_names(),
+                         ['bucket-0.sqlite', 'bucket-1.sqlite'])
+
+    def test_read_all_reads_every_shard(self):
+        async def scenario():
+            for guild_id in (1, 2):
+                await self.storage.run(
+                    guild_id, queries.create_group, guild_id, 'foo')
+                groups = await self.storage.read(
+                    guild_id, queries.list_groups, guild_id)
+                await self.storage.run(guild_id, queries.create_code,
+                                       groups['foo'],
+                                       'CODE-{}'.format(guild_id))
+                await self.storage.atomic(guild_id, PromoCode.claim,
+                                          groups['foo'], [(123, 'foo')])
+            return await self.storage.read_all(queries.codes_sent_to, 123)
+
+        results = asyncio.run(scenario())
+
+        self.assertEqual([[code for code, _ in result] for result in results],
+                         [['CODE-1'], ['CODE-2']])
+
+    def test_read_all_leaves_closed_shards_closed(self):
+        async def setup():
+            for guild_id in (1, 2):
+                await self.storage.run(
+                    guild_id, queries.create_group, guild_id, 'foo')
+        asyncio.run(setup())
+        self.storage.shutdown()
+        self.storage = self.make_storage()
+
+        async def scenario():
+            await self.storage.read(2, queries.list_groups, 2)
+            return await self.storage.read_all(queries.list_groups, 1)
+
+        results = asyncio.run(scenario())
+
+        self.assertEqual([list(groups) for groups in results], [['foo'], []])
+        self.assertEqual(sorted(self.storage.shards), ['guild-2.sqlite'])
+
+    def test_read_all_migrates_outdated_shards(self):
+        asyncio.run(self.storage.run(1, queries.create_group, 1, 'foo'))
+        self.storage.shutdown()
+        database = open_database(
+            os.path.join(self.directory.name, 'guild-1.sqlite'))
+        database.pragma('user_version', 2)
+        database.close()
+        self.storage = self.make_storage()
+
+        results = asyncio.run(self.storage.read_all(queries.list_groups, 1))
+
+        self.assertEqual([list(groups) for groups in results], [['foo']])
+        self.assertEqual(sorted(self.storage.shards), ['guild-1.sqlite'])
+
+    def test_idle_shards_are_closed_and_reopened(self):
+        async def scenario():
+            await self.storage.run(1, queries.create_group, 1, 'foo')
+            self.clock.now = 5
+            await self.storage.run(2, queries.create_group, 2, 'bar')
+            self.clock.now = 12
+            self.storage.close_idle()
+            open_shards = sorted(self.storage.shards)
+            groups = await self.storage.read(1, queries.list_groups, 1)
+            return open_shards, groups
+
+        open_shards, groups = asyncio.run(scenario())
+
+        self.assertEqual(open_shards, ['guild-2.sqlite'])
+        self.assertEqual(list(groups), ['foo'])
+        self.assertEqual(sorted(self.storage.shards),
+                         ['guild-1.sqlite', 'guild-2.sqlite'])
+
+    def test_shards_are_created_with_the_latest_schema(self):
+        asyncio.run(self.storage.run(1, queries.create_group, 1, 'foo'))
+        self.storage.shutdown()
+
+        database = open_database(
+            os.path.join(self.directory.name, 'guild-1.sqlite'))
+        try:
+            self.assertGreater(database.pragma('user_version'), 0)
+            self.assertIn('promocode', database.get_tables())
+        finally:
+            database.close()
@@ -0,0 +1,154 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from peewee import OperationalError
+
+from constants import MODELS
+from db_executor import DBExecutor
+from model import PromoCode, PromoCodeGroup, Redemption
+from storage import QUERY_HOOKS, open_database, pragmas_from_env
+
+
+def claim_one_by_one(path, first_user_id, claims):
+    """Claims codes of the 'foo' group from another process, one
+    transaction per claim."""
+    database = open_database(path)
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    group = PromoCodeGroup.get(PromoCodeGroup.name == 'foo')
+    for user_id in range(first_user_id, first_user_id + claims):
+        with database.atomic():
+            PromoCode.claim(group, [(user_id, 'user')])
+    database.close()
+
+
+class TestPragmasFromEnv(unittest.TestCase):
+    def test_defaults_and_overrides(self):
+        pragmas = pragmas_from_env({'SQLITE_SYNCHRONOUS': 'full'})
+
+        self.assertEqual(pragmas['journal_mode'], 'wal')
+        self.assertEqual(pragmas['synchronous'], 'full')
+        self.assertEqual(pragmas['foreign_keys'], '1')
+
+
+class TestSplitSqliteDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.test_db = open_database(
+            os.path.join(self.directory.name, 'test.sqlite'))
+        self.test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+        self.test_db.create_tables(MODELS)
+
+    def tearDown(self):
+        self.test_db.close()
+        self.directory.cleanup()
+
+    def test_transactions_take_the_write_lock_when_they_begin(self):
+        other = sqlite3.connect(self.test_db.database, timeout=0)
+        try:
+            with self.test_db.atomic():
+                with self.assertRaises(sqlite3.OperationalError):
+                    other.execute('BEGIN IMMEDIATE')
+        finally:
+            other.close()
+
+    def test_query_hooks_see_every_statement(self):
+        statements = []
+        QUERY_HOOKS.append(lambda sql, elapsed: statements.append(sql))
+        try:
+            PromoCodeGroup.create(guild_id=1, name='foo')
+        finally:
+            QUERY_HOOKS.pop()
+
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('INSERT'))
+
+    def in_read_only_thread(self, function):
+        result = {}
+
+        def target():
+            self.test_db.mark_read_only()
+            try:
+                result['value'] = function()
+            except OperationalError as error:
+                result['error'] = error
+            finally:
+                self.test_db.close()
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        return result
+
+    def test_writer_uses_wal(self):
+        self.assertEqual(self.test_db.pragma('journal_mode'), 'wal')
+
+    def test_read_only_thread_reads_but_cannot_write(self):
+        PromoCodeGroup.create(guild_id=1, name='foo')
+
+        result = self.in_read_only_thread(
+            lambda: PromoCodeGroup.get(PromoCodeGroup.guild_id == 1).name)
+        self.assertEqual(result, {'value': 'foo'})
+
+        result = self.in_read_only_thread(
+            lambda: PromoCodeGroup.create(guild_id=2, name='bar'))
+        self.assertIn('readonly', str(result['error']))
+
+    def test_executor_routes_reads_and_writes(self):
+        db_executor = DBExecutor(max_workers=2)
+
+        async def scenario():
+            await db_executor.run(PromoCodeGroup.create,
+                                  guild_id=1,
+                                  name='foo')
+            with self.assertRaises(OperationalError):
+                await db_executor.read(PromoCodeGroup.create,
+                                       guild_id=2,
+                                       name='bar')
+            return await db_executor.read(PromoCodeGroup.select().count)
+        try:
+            self.assertEqual(asyncio.run(scenario()), 1)
+        finally:
+            db_executor.shutdown()
+
+
+class TestClaimsAcrossProcesses(unittest.TestCase):
+    def test_processes_never_claim_the_same_code(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shared.sqlite')
+            test_db = open_database(path)
+            test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+            test_db.create_tables(MODELS)
+            group = PromoCodeGroup.create(guild_id=1, name='foo')
+            PromoCode.insert_many(
+                [{'group': group, 'code': 'CODE-{}'.format(index)}
+                 for index in range(150)]).execute()
+            test_db.close()
+
+            context = multiprocessing.get_context('spawn')
+            processes = [context.Process(target=claim_one_by_one,
+                                         args=(path, first_user_id, 100))
+                         for first_user_id in (1000, 2000)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+
+            test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+            claimed = [promo_code_id for (promo_code_id,) in Redemption
+                       .select(Redemption.promo_code)
+                       .tuples()]
+            available = (PromoCodeGroup
+                         .get_by_id(group.id)
+                         .available_codes)
+            test_db.close()
+
+        self.assertEqual([process.exitcode for process in processes],
+                         [0, 0])
+        # 200 claims for 150 codes: every code went to exactly one user
+        self.assertEqual(len(claimed), 150)
+        self.assertEqual(len(set(claimed)), 150)
+        self.assertEqual(available, 0)
@@ -0,0 +1,104 @@
+import asyncio
+from contextlib import nullcontext
+import unittest
+
+import sentry_sdk
+from sentry_sdk.transport import Transport
+
+from db_executor import DBExecutor
+from messaging import deliver
+import queries
+from tracing import (finish_command,
+                     make_traces_sampler,
+                     parse_sample_rates,
+                     span,
+                     start_command)
+
+from .utils import DBTestCase, FakeContext, FakeUser
+
+
+class RecordingTransport(Transport):
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def capture_event(self, event):
+        self.events.append(event)
+
+    def capture_envelope(self, envelope):
+        transaction = envelope.get_transaction_event()
+        if transaction is not None:
+            self.events.append(transaction)
+
+
+class FakeCommand():
+    def __init__(self, qualified_name):
+        self.qualified_name = qualified_name
+
+
+class TestSampling(unittest.TestCase):
+    def test_parse_sample_rates(self):
+        self.assertEqual(parse_sample_rates('send_code=1, my_codes=0.01,'),
+                         {'send_code': 1.0, 'my_codes': 0.01})
+        self.assertEqual(parse_sample_rates(''), {})
+
+    def test_sampler_uses_command_rate(self):
+        sampler = make_traces_sampler(0.1, {'my_codes': 0.01})
+
+        self.assertEqual(sampler({'command': 'my_codes',
+                                  'parent_sampled': None}), 0.01)
+        self.assertEqual(sampler({'command': 'send_code',
+                                  'parent_sampled': None}), 0.1)
+        self.assertTrue(sampler({'command': 'my_codes',
+                                 'parent_sampled': True}))
+
+    def test_span_is_a_no_op_outside_traced_commands(self):
+        self.assertIsInstance(span('db', 'foo'), nullcontext)
+
+
+class TestCommandTransactions(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport = RecordingTransport()
+        self.events = self.transport.events
+        sentry_sdk.init('https://key@sentry.example/1',
+                        transport=self.transport,
+                        traces_sampler=make_traces_sampler(
+                            1.0, {'my_codes': 0}))
+
+    def tearDown(self):
+        sentry_sdk.Hub.current.bind_client(None)
+        super().tearDown()
+
+    def run_command(self, name):
+        ctx = FakeContext()
+        ctx.command = FakeCommand(name)
+
+        async def command():
+            start_command(ctx)
+            await DBExecutor().run(queries.list_groups, ctx.guild.id)
+            await deliver([(FakeUser(), 'foo')])
+            await ctx.send('bar')
+            finish_command(ctx)
+        asyncio.run(command())
+        return ctx
+
+    def test_db_work_and_sends_are_spans(self):
+        ctx = self.run_command('send_code')
+
+        self.assertEqual(ctx.send_parameters, 'bar')
+        transactions = [event for event in self.events
+                        if event.get('type') == 'transaction']
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(transactions[0]['transaction'], 'send_code')
+        self.assertEqual(
+            [(child['op'], child['description'])
+             for child in transactions[0]['spans']],
+            [('db', 'list_groups'),
+             ('discord.send', 'dm'),
+             ('discord.send', 'channel')])
+
+    def test_unsampled_commands_send_nothing(self):
+        self.run_command('my_codes')
+
+        self.assertEqual(self.events, [])
@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+
+from user_resolver import UserResolver
+
+from .utils import FakeUser, FakeUser2, not_found
+
+
+class CountingFetch():
+    def __init__(self, users, error=None):
+        self.users = {user.id: user for user in users}
+        self.error = error
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, user_id):
+        self.calls.append(user_id)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if self.error is not None:
+            raise self.error
+        if user_id not in self.users:
+            raise not_found()
+        return self.users[user_id]
+
+
+def no_cached_user(user_id):  # pylint: disable=unused-argument
+    return None
+
+
+class TestUserResolver(unittest.TestCase):
+    def test_prefers_client_cache(self):
+        user = FakeUser()
+        fetch_user = CountingFetch([])
+        resolver = UserResolver(lambda user_id: user, fetch_user)
+        result = asyncio.run(resolver.resolve(user.id))
+
+        self.assertIs(result, user)
+        self.assertEqual(fetch_user.calls, [])
+
+    def test_fetches_concurrently_once(self):
+        users = [FakeUser(), FakeUser2()]
+        fetch_user = CountingFetch(users)
+        resolver = UserResolver(no_cached_user, fetch_user, concurrency=2)
+        result = asyncio.run(resolver.resolve_many([123, 321, 123]))
+        asyncio.run(resolver.resolve_many([123, 321]))
+
+        self.assertEqual(result, {123: users[0], 321: users[1]})
+        self.assertEqual(fetch_user.calls, [123, 321])
+        self.assertEqual(fetch_user.max_in_flight, 2)
+
+    def test_unknown_users_are_none(self):
+        resolver = UserResolver(no_cached_user, CountingFetch([]))
+        self.assertIsNone(asyncio.run(resolver.resolve(1)))
+
+    def test_failed_fetches_are_errors_and_not_cached(self):
+        error = TimeoutError()
+        fetch_user = CountingFetch([FakeUser()], error)
+        resolver = UserResolver(no_cached_user, fetch_user)
+
+        self.assertIs(asyncio.run(resolver.resolve(123)), error)
+        fetch_user.error = None
+        self.assertEqual(asyncio.run(resolver.resolve(123)).id, 123)
+        self.assertEqual(fetch_user.calls, [123, 123])
@@ -7,8 +7,12 @@ from utils import (validate_group_name,
                    parse_codes_in_bulk,
                    validate_code,
                    sqlite_datetime_hack,
-                   send_long_message_array)
-from tests.utils import ReceivesMessages
+                   send_long_message_array,
+                   send_lines,
+                   paginate,
+                   count_pages,
+                   stream_tokens)
+from tests.utils import FakeAttachment, ReceivesMessages, fake_read_attachment
 
 
 class TestValidateGroupName(unittest.TestCase):
@@ -31,9 +35,49 @@ class TestParseCodesInBulk(unittest.TestCase):
         result = ['ASDF-1234',
                   'QWER-5678',
                   'ZXCV-9012',
-                  'POIU-0987',
-                  'ÇLKJ-7654']
-        self.assertEqual(parse_codes_in_bulk(code_bulk), result)
+                  'POIU-0987']
+        parsed = parse_codes_in_bulk(code_bulk)
+        self.assertEqual(parsed.codes, result)
+        self.assertEqual(parsed.invalid, ['ÇLKJ-7654'])
+        self.assertEqual(parsed.repeated, 0)
+
+    def test_ignores_separators_at_the_edges(self):
+        parsed = parse_codes_in_bulk(' ,ASDF-1234\n')
+        self.assertEqual(parsed.codes, ['ASDF-1234'])
+        self.assertEqual(parsed.invalid, [])
+
+    def test_removes_repeated_codes(self):
+        parsed = parse_codes_in_bulk('ASDF-1234 QWER-5678 ASDF-1234 ASDF-1234')
+        self.assertEqual(parsed.codes, ['ASDF-1234', 'QWER-5678'])
+        self.assertEqual(parsed.repeated, 2)
+
+    def test_splits_ascii_like_code_token(self):
+        code_bulk = 'ASDF-1234\tQWER_5678;ZXCV-9012\x00POIU-0987'
+        parsed = parse_codes_in_bulk(code_bulk)
+        self.assertEqual(parsed.codes,
+                         ['ASDF-1234', 'ZXCV-9012', 'POIU-0987'])
+        self.assertEqual(parsed.invalid, ['QWER_5678'])
+
+    def test_agrees_with_validate_code(self):
+        for token in ['ASDF-1234', 'asdf_1234', 'ÇLKJ', '１２３', '-', 'ß']:
+            parsed = parse_codes_in_bulk(token)
+            self.assertEqual(bool(parsed.codes), validate_code(token), token)
+
+
+class TestStreamTokens(unittest.TestCase):
+    def tokens(self, content, chunk_size):
+        async def collect():
+            chunks = fake_read_attachment(FakeAttachment(content), chunk_size)
+            return [token async for token in stream_tokens(chunks)]
+        return asyncio.run(collect())
+
+    def test_tokens_split_across_chunks(self):
+        content = 'ASDF-1234 QWER-5678,ZXCV-9012\nÇLKJ-7654\n'.encode()
+        for chunk_size in range(1, len(content) + 1):
+            self.assertEqual(
+                self.tokens(content, chunk_size),
+                ['ASDF-1234', 'QWER-5678', 'ZXCV-9012', 'ÇLKJ-7654']
+            )
 
 
 class TestSQLiteDatetimeHack(unittest.TestCase):
@@ -72,3 +116,37 @@ class TestSendLongMessageArray(unittest.TestCase):
         ))
         mock.assert_any_await("aaaaaaaaaaaaaaaaa\n\nPage 1/2")
         mock.assert_any_await("bbbbbbbbbbbbbbbbb\n\nPage 2/2")
+
+
+class TestPaginate(unittest.TestCase):
+    def test_pages_fit_page_size(self):
+        lines = ['x' * (i % 7 + 1) for i in range(1000)]
+        pages = list(paginate(lines, page_size=50))
+
+        self.assertTrue(all(len(page) <= 50 for page in pages))
+        self.assertEqual("\n".join(pages), "\n".join(lines))
+        self.assertEqual(count_pages(iter(lines), page_size=50), len(pages))
+
+    def test_accepts_generators(self):
+        pages = list(paginate((str(i) for i in range(5)), page_size=3))
+        self.assertEqual(pages, ['0\n1', '2\n3', '4'])
+
+    def test_rejects_lines_bigger_than_page(self):
+        with self.assertRaises(Exception):
+            list(paginate(['abc'], page_size=2))
+
+
+class TestSendLines(unittest.TestCase):
+    def test_single_page_has_no_footer(self):
+        mock = AsyncMock(return_value=None)
+        asyncio.run(send_lines(mock, lambda: ['foo', 'bar']))
+        mock.assert_awaited_once_with("foo\nbar")
+
+    def test_pages_are_numbered(self):
+        mock = AsyncMock(return_value=None)
+        asyncio.run(send_lines(mock,
+                               lambda: (str(i) for i in range(5)),
+                               page_size=3))
+        self.assertEqual(mock.await_count, 3)
+        mock.assert_any_await("0\n1\n\nPage 1/3")
+        mock.assert_any_await("4\n\nPage 3/3")
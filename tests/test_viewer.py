@@ -0,0 +1,130 @@
+import asyncio
+import unittest
+
+from viewer import KeysetPager, NEXT_PAGE, PREVIOUS_PAGE, run_pager
+
+from .utils import FakeSentMessage
+
+ROWS = [(i, 'CODE-{}'.format(i)) for i in range(1, 8)]
+
+
+async def fetch_rows(after=None, before=None, limit=20):
+    if before is not None:
+        return [row for row in ROWS if row[0] < before][-limit:]
+    after = 0 if after is None else after
+    return [row for row in ROWS if row[0] > after][:limit]
+
+
+def make_pager(rows_per_page=3, page_size=1980):
+    return KeysetPager(fetch_rows,
+                       lambda row: '- ' + row[1],
+                       'Header',
+                       rows_per_page=rows_per_page,
+                       page_size=page_size)
+
+
+def scripted_page_turns(*emojis):
+    remaining = list(emojis)
+
+    async def wait_for_page_turn(message):  # pylint: disable=unused-argument
+        if not remaining:
+            raise asyncio.TimeoutError()
+        return remaining.pop(0)
+    return wait_for_page_turn
+
+
+class TestKeysetPager(unittest.TestCase):
+    def test_single_page_has_no_footer(self):
+        pager = make_pager(rows_per_page=10)
+        content = asyncio.run(pager.first_page())
+
+        self.assertEqual(content, '\n'.join(
+            ['Header'] + ['- CODE-{}'.format(i) for i in range(1, 8)]))
+        self.assertFalse(pager.has_next)
+
+    def test_walks_forward_and_back(self):
+        pager = make_pager()
+
+        async def walk():
+            return [await pager.first_page(),
+                    await pager.next_page(),
+                    await pager.next_page(),
+                    await pager.previous_page()]
+        pages = asyncio.run(walk())
+
+        self.assertEqual(pages[0],
+                         'Header\n- CODE-1\n- CODE-2\n- CODE-3\n\nPágina 1')
+        self.assertEqual(pages[2], 'Header\n- CODE-7\n\nPágina 3')
+        self.assertEqual(pages[3], pages[1])
+        self.assertTrue(pager.has_previous)
+        self.assertTrue(pager.has_next)
+
+    def test_pages_fit_page_size(self):
+        pager = make_pager(rows_per_page=5, page_size=40)
+        content = asyncio.run(pager.first_page())
+
+        self.assertLessEqual(len(content), 40)
+        self.assertTrue(pager.has_next)
+
+    def test_rows_deleted_while_open_keep_the_page(self):
+        rows = list(ROWS)
+
+        async def fetch_remaining(after=None, before=None, limit=20):
+            if before is not None:
+                return [row for row in rows if row[0] < before][-limit:]
+            after = 0 if after is None else after
+            return [row for row in rows if row[0] > after][:limit]
+        pager = KeysetPager(fetch_remaining, str, 'Header', rows_per_page=3)
+
+        async def walk():
+            await pager.first_page()
+            await pager.next_page()
+            del rows[:]
+            return [await pager.next_page(), await pager.previous_page()]
+
+        self.assertEqual(asyncio.run(walk()), [None, None])
+        self.assertEqual(pager.page_number, 2)
+        self.assertFalse(pager.has_next)
+        self.assertFalse(pager.has_previous)
+
+    def test_empty(self):
+        async def no_rows(**kwargs):  # pylint: disable=unused-argument
+            return []
+        pager = KeysetPager(no_rows, str, 'Header')
+        self.assertIsNone(asyncio.run(pager.first_page()))
+
+
+class TestRunPager(unittest.TestCase):
+    def test_edits_message_on_page_turns(self):
+        pager = make_pager()
+        message = FakeSentMessage(asyncio.run(pager.first_page()))
+        asyncio.run(run_pager(pager,
+                              message,
+                              scripted_page_turns(PREVIOUS_PAGE,
+                                                  NEXT_PAGE,
+                                                  NEXT_PAGE,
+                                                  NEXT_PAGE)))
+
+        self.assertEqual(message.reactions, [PREVIOUS_PAGE, NEXT_PAGE])
+        self.assertEqual(message.content, 'Header\n- CODE-7\n\nPágina 3')
+
+    def test_single_page_gets_no_reactions(self):
+        pager = make_pager(rows_per_page=10)
+        message = FakeSentMessage(asyncio.run(pager.first_page()))
+        asyncio.run(run_pager(pager, message, scripted_page_turns()))
+
+        self.assertEqual(message.reactions, [])
+
+    def test_page_turns_to_deleted_rows_leave_the_message(self):
+        pager = make_pager()
+        message = FakeSentMessage(asyncio.run(pager.first_page()))
+        content = message.content
+
+        async def deleted(**kwargs):  # pylint: disable=unused-argument
+            return []
+        pager.fetch_rows = deleted
+        asyncio.run(run_pager(pager,
+                              message,
+                              scripted_page_turns(NEXT_PAGE, NEXT_PAGE)))
+
+        self.assertEqual(message.content, content)
@@ -1,17 +1,41 @@
+import asyncio
+from datetime import datetime, timezone
 import unittest
 
+import discord
 from peewee import SqliteDatabase
 
+from cache import clear_caches
 from constants import MODELS
+from db_executor import DBExecutor
+from delivery import DeliveryWorker
+from model import FreeCode, PromoCode, Redemption
+from sharding import SingleStorage
+
+
+class FakeSentMessage():
+    def __init__(self, content):
+        self.id = id(self)
+        self.content = content
+        self.reactions = []
+
+    async def edit(self, content):
+        self.content = content
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
 
 
 class ReceivesMessages():
     send_called = False
     send_parameters = None
+    send_file = None
 
-    async def send(self, params):
+    async def send(self, params, file=None):
         self.send_called = True
         self.send_parameters = params
+        self.send_file = file
+        return FakeSentMessage(params)
 
 
 class FakeUser(ReceivesMessages):
@@ -34,16 +58,124 @@ class FakeGuild2():
     name = 'spam'
 
 
+class FakeClock():
+    """A clock that only moves when a test sets `now`."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeAttachment():
+    def __init__(self, content, filename='codes.txt'):
+        self.content = content
+        self.filename = filename
+        self.url = 'https://cdn.example/' + filename
+
+
+class FakeMessage():
+    def __init__(self, attachments=None):
+        self.attachments = [] if attachments is None else attachments
+
+
 class FakeContext(ReceivesMessages):
-    def __init__(self, author=None, guild=None):
+    def __init__(self, author=None, guild=None, message=None):
         self.author = FakeUser() if author is None else author
         self.guild = FakeGuild() if guild is None else guild
+        self.message = FakeMessage() if message is None else message
+
+
+class FakeGateway():
+    """Sends each guild's events to whoever connected with the guild's
+    shard, the way Discord's gateway does. DMs go to shard 0."""
+
+    def __init__(self, shard_count):
+        self.shard_count = shard_count
+        self.handlers = {}
+
+    def connect(self, shard_ids, handler):
+        for shard_id in shard_ids:
+            if shard_id in self.handlers:
+                raise ValueError(
+                    'Shard {} is already connected'.format(shard_id))
+            self.handlers[shard_id] = handler
+
+    def dispatch(self, guild_id, event):
+        # the sharding formula from Discord's gateway docs
+        shard_id = (0 if guild_id is None
+                    else (guild_id >> 22) % self.shard_count)
+        return self.handlers[shard_id](event)
+
+
+def is_free(promo_code):
+    """Whether the code is in the pool send_code claims from."""
+    return FreeCode.get_or_none(FreeCode.promo_code == promo_code) is not None
+
+
+def create_sent_code(group, code, user, sent_at=None):
+    """Creates a code of the group that was already handed out to user."""
+    sent_at = datetime.now(timezone.utc) if sent_at is None else sent_at
+    promo_code = PromoCode.create(group=group, code=code)
+    FreeCode.delete_by_id(promo_code.id)
+    Redemption.create(promo_code=promo_code,
+                      group=group,
+                      code=code,
+                      user_id=user.id,
+                      user_name=user.name,
+                      redeemed_at=sent_at)
+    return promo_code
+
+
+class FakeResponse():
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+
+def not_found():
+    """The error fetch_user raises for users Discord doesn't know."""
+    return discord.NotFound(FakeResponse(404, 'Not Found'), 'Unknown User')
 
 
 async def fake_fetch_user(user_id):  # pylint: disable=unused-argument
     return FakeUser()
 
 
+async def fake_read_attachment(attachment, chunk_size=7):
+    for start in range(0, len(attachment.content), chunk_size):
+        yield attachment.content[start:start + chunk_size]
+
+
+def deliver_pending(*users, guild_ids=(FakeGuild.id,), **kwargs):
+    """Runs a DeliveryWorker over the queued messages, sending them to
+    the given users."""
+    users_by_id = {user.id: user for user in users}
+
+    async def resolve_users(user_ids):
+        return {user_id: users_by_id.get(user_id) for user_id in user_ids}
+    worker = DeliveryWorker(SingleStorage(DBExecutor()), resolve_users,
+                            **kwargs)
+    for guild_id in guild_ids:
+        worker.notify(guild_id)
+    asyncio.run(worker.deliver_due())
+    return worker
+
+
+class RacingStorage():
+    """Runs during_read() while a read is in flight."""
+
+    def __init__(self, during_read):
+        self.during_read = during_read
+
+    async def read(self, guild_id, function, *args):
+        # pylint: disable=unused-argument
+        result = function(*args)
+        await self.during_read()
+        return result
+
+
 async def returns_true(*args):  # pylint: disable=unused-argument
     return True
 
@@ -64,6 +196,9 @@ class DBTestCase(unittest.TestCase):
         self.test_db.connect()
         self.test_db.create_tables(MODELS)
 
+        # Caches outlive the database, so start every test with them empty.
+        clear_caches()
+
     def tearDown(self):
         # Not strictly necessary since SQLite in-memory databases only live
         # for the duration of the connection, and in the next step we close
@@ -0,0 +1,110 @@
+"""Sentry setup and per-command performance tracing.
+
+Every sampled command gets a Sentry transaction, and DB work and Discord
+sends inside it become child spans. Nothing here imports or calls into
+Sentry unless init() ran, which main only does when SENTRY_URL is set:
+span() then returns a no-op context manager."""
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+# the transaction of the command running in the current task
+_transaction = ContextVar('command_transaction', default=None)
+
+
+def parse_sample_rates(value):
+    """Parses "send_code=1,my_codes=0.01" into {command: rate}."""
+    rates = {}
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        command, _, rate = part.partition('=')
+        rates[command.strip()] = float(rate)
+    return rates
+
+
+def make_traces_sampler(default_rate, command_rates):
+    """Samples each command at its own rate, or at default_rate."""
+    def traces_sampler(sampling_context):
+        if sampling_context.get('parent_sampled') is not None:
+            return sampling_context['parent_sampled']
+        return command_rates.get(sampling_context.get('command'),
+                                 default_rate)
+    return traces_sampler
+
+
+def init(dsn,
+         environment,
+         traces_sample_rate=0.1,
+         command_sample_rates=None,
+         error_sample_rate=1.0):
+    import sentry_sdk  # pylint: disable=import-outside-toplevel
+    sentry_sdk.init(dsn,
+                    environment=environment,
+                    sample_rate=error_sample_rate,
+                    traces_sampler=make_traces_sampler(
+                        traces_sample_rate, command_sample_rates or {}))
+
+
+@contextmanager
+def _child_span(transaction, op, description):
+    child = transaction.start_child(op=op, description=description)
+    try:
+        yield child
+    finally:
+        child.finish()
+
+
+def span(op, description):
+    """Times the block as a child span of the current command, if it is
+    being traced.
+
+    Spans are never entered into the Sentry scope, which is shared by
+    every command running concurrently on the loop."""
+    transaction = _transaction.get()
+    if transaction is None:
+        return nullcontext()
+    return _child_span(transaction, op, description)
+
+
+def traced(send, description):
+    """Wraps an async send function in a discord.send span."""
+    async def traced_send(*args, **kwargs):
+        with span('discord.send', description):
+            return await send(*args, **kwargs)
+    return traced_send
+
+
+def start_command(ctx):
+    """Starts the command's transaction. Call it from the bot's
+    before_invoke hook, so it runs in the command's task."""
+    import sentry_sdk  # pylint: disable=import-outside-toplevel
+    name = ctx.command.qualified_name
+    transaction = sentry_sdk.start_transaction(
+        op='discord.command',
+        name=name,
+        custom_sampling_context={'command': name})
+    if not transaction.sampled:
+        return
+    transaction.set_tag('guild_id', getattr(ctx.guild, 'id', None))
+    _transaction.set(transaction)
+    ctx.send = traced(ctx.send, 'channel')
+
+
+def finish_command(ctx):
+    transaction = _transaction.get()
+    if transaction is None:
+        return
+    failed = getattr(ctx, 'command_failed', False)
+    transaction.set_status('internal_error' if failed else 'ok')
+    transaction.finish()
+    _transaction.set(None)
+
+
+def capture_command_error(ctx, error):
+    import sentry_sdk  # pylint: disable=import-outside-toplevel
+    sentry_sdk.add_breadcrumb(
+        category='discord.command_name',
+        message='Error on command %s' % ctx.command.qualified_name,
+        level='info'
+    )
+    sentry_sdk.capture_exception(error)
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+
+import discord
+
+from cache import TTLCache
+
+
+class UserResolver():
+    """Turns Discord user ids into User objects.
+
+    The client's own cache (get_user) is tried first, then a TTL cache of
+    earlier REST lookups, and only the remaining ids are fetched, at most
+    `concurrency` at a time."""
+
+    def __init__(self, get_user, fetch_user, ttl=3600, concurrency=5):
+        self.get_user = get_user
+        self.fetch_user = fetch_user
+        self.concurrency = concurrency
+        self.cache = TTLCache(ttl=ttl)
+
+    async def resolve_many(self, user_ids, fetch_user=None):
+        """Returns a {user_id: User} dict. Users Discord doesn't know are
+        mapped to None, and users whose fetch failed otherwise (e.g. a
+        timeout or a 5xx) to the error, which isn't cached."""
+        fetch_user = self.fetch_user if fetch_user is None else fetch_user
+        users = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            user = self.get_user(user_id) or self.cache.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = user
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(user_id):
+            async with semaphore:
+                try:
+                    return await fetch_user(user_id)
+                except discord.NotFound:
+                    return None
+                except Exception as error:  # pylint: disable=broad-except
+                    logging.warning("Não foi possível buscar o usuário %s: %s",
+                                    user_id, error)
+                    return error
+
+        fetched = await asyncio.gather(*[fetch(user_id)
+                                         for user_id in missing])
+        for user_id, user in zip(missing, fetched):
+            if user is not None and not isinstance(user, Exception):
+                self.cache.set(user_id, user)
+            users[user_id] = user
+        return users
+
+    async def resolve(self, user_id, fetch_user=None):
+        return (await self.resolve_many([user_id], fetch_user))[user_id]
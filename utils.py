@@ -1,17 +1,92 @@
+from collections import namedtuple
 from datetime import datetime
+import codecs
 import re
 
+import aiohttp
+
+CODE_SEPARATOR = re.compile(r'[^\w-]+')
+CODE_TOKEN = re.compile(r'[\w-]+')
+CODE_PATTERN = re.compile(r'[a-zA-Z0-9-]+')
+# maps the ASCII characters CODE_SEPARATOR matches to spaces
+ASCII_SEPARATORS = str.maketrans({
+    character: ' ' for character in map(chr, range(128))
+    if CODE_SEPARATOR.fullmatch(character)
+})
+
+ParsedCodes = namedtuple('ParsedCodes', ['codes', 'invalid', 'repeated'])
+
 
 def validate_group_name(group_name):
     return re.match('^[a-zA-Z0-9-_]+$', group_name) is not None
 
 
 def validate_code(code):
-    return re.match('^[a-zA-Z0-9-]+$', code) is not None
+    return CODE_PATTERN.fullmatch(code) is not None
+
+
+def _split_valid_codes(tokens, invalid):
+    """Yields the valid tokens, appending the others to invalid."""
+    for token in tokens:
+        # tokens only hold \w and dashes, so this is validate_code without
+        # a regex call per token
+        if token.isascii() and '_' not in token:
+            yield token
+        else:
+            invalid.append(token)
 
 
 def parse_codes_in_bulk(code_bulk):
-    return re.split('[^\w-]+', code_bulk)  # noqa W605
+    """Splits codes separated by anything that is not a letter, a number or
+    a dash.
+
+    Returns a ParsedCodes with the valid codes (without repetitions, in the
+    order they first appear), the invalid tokens and how many repeated
+    codes were dropped."""
+    invalid = []
+    if code_bulk.isascii():
+        # same tokens as CODE_TOKEN, without a regex match per token
+        tokens = code_bulk.translate(ASCII_SEPARATORS).split()
+        valid = tokens if '_' not in code_bulk else list(
+            _split_valid_codes(tokens, invalid))
+    else:
+        tokens = CODE_TOKEN.findall(code_bulk)
+        valid = list(_split_valid_codes(tokens, invalid))
+    # a set is cheaper than dict.fromkeys when nothing repeats
+    if len(set(valid)) == len(valid):
+        codes = valid
+    else:
+        codes = list(dict.fromkeys(valid))
+    return ParsedCodes(codes=codes,
+                       invalid=invalid,
+                       repeated=len(tokens) - len(invalid) - len(codes))
+
+
+async def read_attachment(attachment, chunk_size=65536):
+    """Downloads a discord.Attachment, yielding it in byte chunks."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+
+async def stream_tokens(chunks, encoding='utf-8'):
+    """Splits an async stream of byte chunks into codes the same way
+    parse_codes_in_bulk does, without holding more than one chunk."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    remainder = ''
+    async for chunk in chunks:
+        pieces = CODE_SEPARATOR.split(remainder + decoder.decode(chunk))
+        # the last piece may continue in the next chunk
+        remainder = pieces.pop()
+        for piece in pieces:
+            if piece:
+                yield piece
+    remainder += decoder.decode(b'', final=True)
+    for piece in CODE_SEPARATOR.split(remainder):
+        if piece:
+            yield piece
 
 
 def sqlite_datetime_hack(datetime_or_str):
@@ -20,6 +95,52 @@ def sqlite_datetime_hack(datetime_or_str):
     return datetime_or_str
 
 
+def _split_pages(lines, page_size):
+    """Groups lines into lists whose newline-joined length fits page_size.
+
+    Only the current page is kept in memory."""
+    page = []
+    length = -1
+    for line in lines:
+        if len(line) > page_size:
+            raise Exception("Message can't have pieces bigger than chunk_size")
+        if page and length + 1 + len(line) > page_size:
+            yield page
+            page = []
+            length = -1
+        page.append(line)
+        length += 1 + len(line)
+    if page:
+        yield page
+
+
+def paginate(lines, page_size=1980):
+    """Yields the lines grouped in pages of at most page_size characters."""
+    for page in _split_pages(lines, page_size):
+        yield "\n".join(page)
+
+
+def count_pages(lines, page_size=1980):
+    """Same as len(list(paginate(lines))), without joining any page."""
+    return sum(1 for _ in _split_pages(lines, page_size))
+
+
+async def send_lines(send_function, make_lines, page_size=1980):
+    """Sends lines as a paginated message.
+
+    make_lines returns a fresh iterable of lines on every call: it is
+    walked once to count the pages and once more to send them, so the whole
+    message is never built. A single page is sent without the page
+    footer, which page_size leaves room for."""
+    total_pages = count_pages(make_lines(), page_size)
+    if total_pages == 1:
+        for page in paginate(make_lines(), page_size):
+            await send_function(page)
+        return
+    for i, page in enumerate(paginate(make_lines(), page_size)):
+        await send_function(f'{page}\n\nPage {i+1}/{total_pages}')
+
+
 async def send_long_message_array(send_function,
                                   message,
                                   split_character="\n",
@@ -29,23 +150,5 @@ async def send_long_message_array(send_function,
     if len(message) < chunk_size:
         await send_function(message)
         return
-
-    chunks = []
-    current_chunk = ""
-
-    for piece in message.split(split_character):
-        if len(piece) > chunk_size:
-            raise Exception("Message can't have pieces bigger than chunk_size")
-        if (len(piece) + len(current_chunk)) > chunk_size:
-            chunks.append(current_chunk)
-            current_chunk = piece + "\n"
-        else:
-            current_chunk += piece + "\n"
-
-    if len(current_chunk) > 0:
-        chunks.append(current_chunk)
-
-    total_pages = len(chunks)
-
-    for i, chunk in enumerate(chunks):
-        await send_function(f'{chunk}\nPage {i+1}/{total_pages}')
+    pieces = message.split(split_character)
+    await send_lines(send_function, lambda: pieces, page_size=chunk_size)
@@ -0,0 +1,117 @@
+import asyncio
+
+PREVIOUS_PAGE = '⬅️'
+NEXT_PAGE = '➡️'
+PAGE_TURNS = (PREVIOUS_PAGE, NEXT_PAGE)
+
+
+class KeysetPager():
+    """Pages through rows ordered by an increasing id (the first column).
+
+    fetch_rows(after=None, before=None, limit=n) must return the rows with
+    id > after (or id < before) closest to that id, in id order. Only one
+    page of rows is fetched and rendered at a time."""
+
+    def __init__(self,
+                 fetch_rows,
+                 render_line,
+                 header,
+                 rows_per_page=20,
+                 page_size=1980):
+        self.fetch_rows = fetch_rows
+        self.render_line = render_line
+        self.header = header
+        self.rows_per_page = rows_per_page
+        self.page_size = page_size
+        self.page_number = 0
+        self.first_id = None
+        self.last_id = None
+        self.has_previous = False
+        self.has_next = False
+
+    def _fit(self, rows, from_end=False):
+        """Renders as many rows as fit in a page, keeping the ones next to
+        the cursor. Returns the rendered rows and their lines."""
+        budget = self.page_size - len(self._footer()) - len(self.header)
+        ordered = reversed(rows) if from_end else rows
+        kept = []
+        for row in ordered:
+            line = self.render_line(row)
+            budget -= len(line) + 1
+            if budget < 0 and kept:
+                break
+            kept.append((row, line))
+        if from_end:
+            kept.reverse()
+        return kept
+
+    def _footer(self):
+        return "\n\nPágina {}".format(self.page_number)
+
+    def _render(self, kept):
+        self.first_id = kept[0][0][0]
+        self.last_id = kept[-1][0][0]
+        text = "\n".join([self.header] + [line for _, line in kept])
+        if self.page_number == 1 and not self.has_next:
+            return text
+        return text + self._footer()
+
+    async def first_page(self):
+        """Returns the first page, or None if there are no rows at all."""
+        rows = await self.fetch_rows(limit=self.rows_per_page + 1)
+        if not rows:
+            return None
+        self.page_number = 1
+        kept = self._fit(rows[:self.rows_per_page])
+        self.has_previous = False
+        self.has_next = len(rows) > len(kept)
+        return self._render(kept)
+
+    async def next_page(self):
+        """Returns the next page, or None if its rows were all deleted
+        since. The current page is then kept, as the last one."""
+        rows = await self.fetch_rows(after=self.last_id,
+                                     limit=self.rows_per_page + 1)
+        if not rows:
+            self.has_next = False
+            return None
+        self.page_number += 1
+        kept = self._fit(rows[:self.rows_per_page])
+        self.has_previous = True
+        self.has_next = len(rows) > len(kept)
+        return self._render(kept)
+
+    async def previous_page(self):
+        """Like next_page, going back."""
+        rows = await self.fetch_rows(before=self.first_id,
+                                     limit=self.rows_per_page + 1)
+        if not rows:
+            self.has_previous = False
+            return None
+        self.page_number -= 1
+        kept = self._fit(rows[-self.rows_per_page:], from_end=True)
+        self.has_previous = len(rows) > len(kept)
+        self.has_next = True
+        return self._render(kept)
+
+
+async def run_pager(pager, message, wait_for_page_turn):
+    """Turns the pages of an already sent message while its reader reacts
+    with PAGE_TURNS, until wait_for_page_turn times out."""
+    if not pager.has_next:
+        return
+    for emoji in PAGE_TURNS:
+        await message.add_reaction(emoji)
+    while True:
+        try:
+            emoji = await wait_for_page_turn(message)
+        except asyncio.TimeoutError:
+            return
+        if emoji == NEXT_PAGE and pager.has_next:
+            content = await pager.next_page()
+        elif emoji == PREVIOUS_PAGE and pager.has_previous:
+            content = await pager.previous_page()
+        else:
+            continue
+        if content is not None:
+            await message.edit(content=content)